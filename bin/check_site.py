@@ -21,7 +21,18 @@ import re
 import sys
 import time
 
+from gevent import monkey
+monkey.patch_all()
+
+from webtoolbox.audit import CachingAudit
+from webtoolbox.client import add_client_options, client_options
+from webtoolbox.distributed import Coordinator, Shard, SQLiteExchange, save_state
+from webtoolbox.frontier import Frontier, load_crawl_times, parse_order, save_crawl_times
+from webtoolbox.pageweight import NetworkProfile, PageWeightAnalysis
 from webtoolbox.spider import Spider
+from webtoolbox.throttle import RetryPolicy
+from webtoolbox.urls import DEFAULT_STRIP_PARAMS, TrapDetector, URLCanonicalizer
+from webtoolbox.red_analysis import REDProcessor, ResultCache
 
 # Used to process the string report returned by tidylib:
 TIDY_RE = re.compile("line (?P<line>\d+) column (?P<column>\d+) - (?P<level>\w+): (?P<message>.*)$",
@@ -36,10 +47,10 @@ class SpiderReport(object):
         "title": "Spider Report"
     }
 
-    messages = defaultdict(dict)
-    pages = set()
-    resources = set()
-    media = set()
+    messages = None
+    pages = None
+    resources = None
+    media = None
 
     # Severity levels, used to simplify sorting:
     SEVERITY_LEVELS = {
@@ -53,6 +64,14 @@ class SpiderReport(object):
     # Used to avoid problems with dict.keys() not being stable:
     REPORT_ORDER = ('error', 'warning', 'bad', 'good', 'info')
 
+    def __init__(self):
+        self.messages = defaultdict(dict)
+        self.pages = set()
+        self.resources = set()
+        self.media = set()
+        #: (label, value) pairs displayed at the top of the report:
+        self.summary = []
+
     def add(self, url=None, category=None, severity=None, title=None, details=None):
         if not severity in self.SEVERITY_LEVELS:
             raise ValueError("%s is not a valid severity level" % severity)
@@ -66,6 +85,19 @@ class SpiderReport(object):
 
         tgt['urls'].add(url)
 
+    def merge(self, other):
+        """Add another report's messages and crawled URLs; the first details for a title win"""
+
+        for severity, categories in other.messages.items():
+            for category, titles in categories.items():
+                for title, message in titles.items():
+                    for url in message['urls']:
+                        self.add(url, category, severity, title, message['details'])
+
+        self.pages.update(other.pages)
+        self.resources.update(other.resources)
+        self.media.update(other.media)
+
     def save(self, format="html", output=sys.stdout):
         if format == "html":
             self.generate_html(output)
@@ -88,16 +120,28 @@ class SpiderReport(object):
             pages=self.pages,
             media=self.media,
             resources=self.resources,
-            severity_levels=self.REPORT_ORDER,
+            severity_levels=self.SEVERITY_LEVELS,
+            report_order=self.REPORT_ORDER,
+            summary=self.summary,
             **self.extra_context
         ))
 
 
 class QASpider(Spider):
-    def __init__(self, validate_html=False, log_name="QASpider", **kwargs):
+    def __init__(self, validate_html=False, audit_caching=True, network_profile=None, log_name="QASpider",
+                 **kwargs):
         super(QASpider, self).__init__(log_name=log_name, **kwargs)
         self.report = SpiderReport()
 
+        self.caching_audit = CachingAudit(self.report) if audit_caching else None
+        if self.caching_audit is not None:
+            self.response_processors.append(self.caching_audit)
+
+        self.page_weight = PageWeightAnalysis(network_profile, canonicalizer=self.canonicalizer) if network_profile else None
+        if self.page_weight is not None:
+            self.response_processors.append(self.page_weight.process_response)
+            self.tree_processors.append(self.page_weight.process_tree)
+
         if validate_html:
             self.html_processors.append(self.validate_html)
 
@@ -127,6 +171,58 @@ class QASpider(Spider):
             elif element.tag in ('img', 'embed', 'object', 'audio', 'video'):
                 self.report.media.add(link)
 
+    def get_state(self):
+        state = super(QASpider, self).get_state()
+        state.update(report=self.report, caching_audit=self.caching_audit, page_weight=self.page_weight)
+        return state
+
+    def merge_state(self, state):
+        super(QASpider, self).merge_state(state)
+
+        self.report.merge(state["report"])
+
+        if self.caching_audit is not None and state["caching_audit"] is not None:
+            self.caching_audit.merge(state["caching_audit"])
+
+        if self.page_weight is not None and state["page_weight"] is not None:
+            self.page_weight.merge(state["page_weight"])
+
+    def report_duplicate_content(self):
+        """Report URLs which return the same or nearly the same HTML and return summary pairs"""
+
+        fingerprints = self.content_fingerprints
+
+        duplicate_groups = fingerprints.duplicate_groups()
+        for urls in duplicate_groups:
+            for url in urls[1:]:
+                self.report.add(url, "Duplicate Content", "warning", "Identical HTML to %s" % urls[0],
+                                "%d URLs return exactly the same page" % len(urls))
+
+        clusters = fingerprints.near_duplicate_clusters()
+        for urls in clusters:
+            for url in urls[1:]:
+                self.report.add(url, "Duplicate Content", "info", "Nearly identical HTML to %s" % urls[0],
+                                "%d URLs return pages whose text is almost the same" % len(urls))
+
+        return [
+            ("URLs duplicating another page", sum(len(urls) - 1 for urls in duplicate_groups)),
+            ("Duplicate pages not parsed", self.duplicates_skipped),
+            ("Near-duplicate clusters", len(clusters)),
+        ]
+
+    def report_crawl_traps(self):
+        """Report the URLs which weren't crawled because they looked like traps and return summary pairs"""
+
+        if self.trap_detector is None:
+            return []
+
+        for reason, (count, examples) in self.trap_detector.rejected.items():
+            for url in examples:
+                self.report.add(url, "Crawl Traps", "warning", reason,
+                                "%d URLs were not crawled; examples are listed" % count)
+
+        return [("URLs not crawled as likely traps", self.trap_detector.rejected_count)]
+
     def update_resource_report(self, url, headers):
         """
         Since we can't tell whether the contents of a link point to a page or
@@ -141,7 +237,7 @@ class QASpider(Spider):
 
         if content_type.startswith("text/html"):
             self.report.pages.add(url)
-        else:
+        elif url not in self.report.resources:
             self.report.media.add(url)
 
 
@@ -196,14 +292,40 @@ def main():
     parser.add_option("-o", "--report", "--output", dest="report_file", default=sys.stdout, help='Save report to a file instead of stdout')
     parser.add_option("--follow-offsite-redirects", action="store_true", default=False, help="Follow redirects which lead to outside servers to check for 404s")
     parser.add_option("--validate-html", action="store_true", default=False, help="Validate HTML using tidylib")
+    parser.add_option("--no-caching-audit", dest="audit_caching", action="store_false", default=True, help="Don't report the cacheability and compression of each response")
     parser.add_option("--skip-media", action="store_true", default=False, help="Skip media files: <img>, <object>, etc.")
     parser.add_option("--skip-resources", action="store_true", default=False, help="Skip resources: <script>, <link>")
+    parser.add_option("--process-duplicates", dest="skip_duplicate_content", action="store_false", default=True, help="Parse and validate pages whose HTML is identical to a page already processed")
+    parser.add_option("--strip-param", dest="strip_params", action="append", default=[], metavar="NAME", help="Remove this query parameter from URLs in addition to common tracking and session parameters; wildcards are allowed and the option can be repeated")
+    parser.add_option("--keep-param-order", action="store_true", default=False, help="Don't sort query parameters when comparing URLs")
+    parser.add_option("--max-urls-per-pattern", type="int", default=0, help="Stop queuing URLs which only differ in numbers or query values after this many. This truncates sites with more pages than that matching a pattern such as /article/N, so it's only for calendars or faceted search (default: no limit)")
+    parser.add_option("--max-path-depth", type="int", default=16, help="Don't queue URLs with more path segments than this (0 for no limit, default=%default)")
+    parser.add_option("--max-urls", type="int", help="Stop after requesting this many URLs, most important first; with --workers this applies to each worker")
+    parser.add_option("--max-time", type="float", help="Stop sending requests after this many seconds")
+    parser.add_option("--workers", type="int", default=1, help="Crawl using this many processes, each responsible for the URLs on a share of the hosts (default=%default)")
+    parser.add_option("--priority", default=",".join(Frontier().order), help="Crawl URLs in order of these comma-separated criteria: type (pages, then resources, then media), depth, inlinks and staleness (default=%default)")
+    parser.add_option("--crawl-history", help="Crawl the URLs not crawled for the longest time first using the crawl times saved in this file, and update it")
+    parser.add_option("--retries", type="int", default=2, help="Retry timeouts, connection errors and 5xx or 429 responses this many times (default=%default)")
+    parser.add_option("--backoff", type="float", default=1.0, help="Base delay in seconds for exponential backoff between retries (default=%default)")
+    parser.add_option("--no-throttle", dest="throttle_hosts", action="store_false", default=True, help="Don't reduce concurrency or pause requests when a host is slow or failing")
     parser.add_option("--skip-link-re", type="string", help="Skip links whose URL matches the specified regular expression")
     parser.add_option("--save-page-list", dest="page_list", help='Save a list of URLs for HTML pages in the specified file')
     parser.add_option("--save-resource-list", dest="resource_list", help='Save a list of URLs for pages resources in the specified file')
-    parser.add_option("--language", default="en", help="Report using a different language than '%default'")
+    parser.add_option("--network-profile", default="3g", help="Estimate page load times using one of 3g, 4g, cable, fiber or KBITS_PER_SECOND/RTT_MS (default=%default)")
+    parser.add_option("--no-page-weight", dest="page_weight", action="store_false", default=True, help="Don't estimate page weights and load times")
+    parser.add_option("--save-page-weights", dest="page_weights_file", help="Save the size, request count and estimated load times of each page as TSV in the specified file")
+    parser.add_option("--red", action="store_true", default=False, help="Add RED's cacheability analysis of every response to the report")
+    parser.add_option("--red-concurrency", type="int", default=1, help="Run RED in this many worker processes (default=%default)")
+    parser.add_option("--red-cache", help="Save RED results in this file and reuse them for URLs which haven't changed")
+    parser.add_option("--language", default="en", help="Report RED messages using a different language than '%default'")
     parser.add_option("-l", "--log", dest="log_file", help='Specify a location other than stderr', default=None)
     parser.add_option("-v", "--verbosity", action="count", default=0, help="Log level")
+    # Used by --workers to start each worker:
+    parser.add_option("--shard", type="int", help=optparse.SUPPRESS_HELP)
+    parser.add_option("--shards", type="int", help=optparse.SUPPRESS_HELP)
+    parser.add_option("--exchange", help=optparse.SUPPRESS_HELP)
+    parser.add_option("--results", help=optparse.SUPPRESS_HELP)
+    add_client_options(parser)
 
     (options, urls) = parser.parse_args()
 
@@ -212,13 +334,27 @@ def main():
     if not urls:
         parser.error("You must provide at least one URL to start spidering")
 
+    try:
+        network_profile = NetworkProfile.parse(options.network_profile) if options.page_weight else None
+        priority = parse_order(options.priority)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    crawl_times = {}
+    if options.crawl_history and os.path.exists(options.crawl_history):
+        with open(options.crawl_history) as f:
+            crawl_times = load_crawl_times(f)
+
     try:
         import jinja2
     except ImportError:
         logging.critical("You requested an HTML report but Jinja2 could not be imported. Try `pip install jinja2`")
         sys.exit(42)
 
-    if not isinstance(options.report_file, file):
+    worker = options.shard is not None
+
+    # Workers hand their results to the process which started them:
+    if not worker and not isinstance(options.report_file, file):
         if ".htm" in options.report_file and options.report_format != "html":
             logging.warning("Output file appears to be HTML but format is %s - should it be html?", options.report_format)
         options.report_file = file(os.path.expanduser(options.report_file), "w")
@@ -231,13 +367,55 @@ def main():
             logging.critical("Cannot perform HTML validation. Try `pip install pytidylib` or see http://countergram.com/software/pytidylib")
             sys.exit(42)
 
+    if worker:
+        shard = Shard(options.shard, options.shards, SQLiteExchange(options.exchange))
+        log_name = "QASpider[%d]" % options.shard
+    else:
+        shard = None
+        log_name = "QASpider"
+
     spider = QASpider(validate_html=options.validate_html,
+                      audit_caching=options.audit_caching,
+                      network_profile=network_profile,
                       max_simultaneous_connections=options.max_connections,
                       default_request_timeout=options.timeout,
+                      client_options=client_options(options),
+                      canonicalizer=URLCanonicalizer(strip_params=DEFAULT_STRIP_PARAMS + tuple(options.strip_params),
+                                                     sort_params=not options.keep_param_order),
+                      trap_detector=TrapDetector(max_depth=options.max_path_depth,
+                                                 max_urls_per_pattern=options.max_urls_per_pattern),
+                      frontier=Frontier(order=priority, last_crawled=crawl_times),
+                      retry_policy=RetryPolicy(retries=options.retries, backoff=options.backoff),
+                      shard=shard,
+                      log_name=log_name,
                       debug=options.debug)
     spider.skip_media = options.skip_media
     spider.skip_resources = options.skip_resources
     spider.follow_offsite_redirects = options.follow_offsite_redirects
+    spider.skip_duplicate_content = options.skip_duplicate_content
+    spider.max_urls = options.max_urls
+    spider.max_time = options.max_time
+    spider.throttle_hosts = options.throttle_hosts
+
+    coordinator = options.workers > 1 and not worker
+
+    if options.red and not coordinator:
+        try:
+            import red
+        except ImportError as exc:
+            logging.critical("Couldn't import red: %s", exc)
+            logging.critical("Cannot perform RED analysis. Install redbot from http://mnot.github.com/redbot/")
+            sys.exit(42)
+
+        red_cache = options.red_cache
+        # Workers would overwrite each other's results in a shared file:
+        if red_cache and worker:
+            red_cache = "%s.%d" % (red_cache, options.shard)
+
+        red_processor = REDProcessor(spider.report, language=options.language,
+                                     cache=ResultCache(red_cache) if red_cache else None,
+                                     concurrency=options.red_concurrency)
+        spider.response_processors.append(red_processor)
 
     if options.skip_link_re:
         i = options.skip_link_re
@@ -249,7 +427,26 @@ def main():
         spider.skip_link_re = re.compile(i, re.IGNORECASE)
 
     start = time.time()
-    spider.run(urls)
+
+    if coordinator:
+        command = [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:]
+
+        try:
+            for state in Coordinator(options.workers).run(command):
+                spider.merge_state(state)
+        except RuntimeError as exc:
+            logging.critical("%s", exc)
+            sys.exit(1)
+    else:
+        spider.run(urls)
+
+        if options.red:
+            red_processor.join()
+
+        if worker:
+            save_state(spider.get_state(), options.results)
+            return
+
     end = time.time()
 
     if not spider.completed:
@@ -265,8 +462,40 @@ def main():
         urls_error=spider.errors,
     )
 
+    if coordinator:
+        spider.report.summary.append(("Crawl workers", options.workers))
+
+    if spider.request_queue:
+        spider.report.summary.append(("URLs not crawled within --max-urls or --max-time", len(spider.request_queue)))
+
+    if spider.retried:
+        spider.report.summary.append(("Requests retried", spider.retried))
+
+    paused_hosts = sorted(host for host, throttle in spider.host_throttles.items() if throttle.trips)
+    if paused_hosts:
+        spider.report.summary.append(("Hosts paused after repeated failures", ", ".join(paused_hosts)))
+
+    spider.report.summary.extend(spider.report_duplicate_content())
+    spider.report.summary.extend(spider.report_crawl_traps())
+
+    if spider.caching_audit is not None:
+        spider.report.summary.extend(spider.caching_audit.summary())
+
+    if spider.page_weight is not None:
+        page_weights = spider.page_weight.analyze()
+        spider.report.summary.extend(spider.page_weight.update_report(spider.report, page_weights))
+
+        if options.page_weights_file:
+            with open(options.page_weights_file, "w") as f:
+                spider.page_weight.save(page_weights, f)
+
     spider.report.save(format=options.report_format, output=options.report_file)
 
+    if options.crawl_history:
+        crawl_times.update(spider.crawl_times)
+        with open(options.crawl_history, "w") as f:
+            save_crawl_times(crawl_times, f)
+
     if options.page_list:
         save_url_list(options.page_list, sorted(spider.report.pages))
 
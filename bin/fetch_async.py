@@ -1,19 +1,47 @@
 #!/usr/bin/env python
 # encoding: utf-8
-"""Download many URLs in parallel"""
+"""
+Download many URLs in parallel
+
+Reads "URL [FILENAME]" lines from stdin. Interrupted downloads are resumed
+using HTTP Range requests and files which are already complete are skipped.
+
+With --content-store, each distinct body is stored once under its SHA-256
+digest and linked to the requested filename so duplicate URLs such as CDN
+aliases only use disk space once.
+"""
 
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+from gevent import monkey
+monkey.patch_all()
+
+import errno
+import hashlib
+import json
 import logging
 import os
+import random
 import re
+import shutil
+import socket
+import ssl
 import sys
-import urllib
-from multiprocessing.pool import ThreadPool
+import threading
+import time
 from warnings import warn
 
-import requests
+try:
+    import http.client as httplib
+    from urllib.parse import quote
+except ImportError:
+    import httplib
+    from urllib import quote
+
+from gevent.pool import Pool
+
+from webtoolbox.client import HTTPClient, RequestError, add_client_options, client_options
 
 if sys.version_info < (2, 7, 9):
     print('This script requires Python >= 2.7.9 for the PEP-466 SSL improvements', file=sys.stderr)
@@ -21,66 +49,584 @@ if sys.version_info < (2, 7, 9):
 
 DEFAULT_CHUNK_SIZE = 1024 * 1024
 
+CONTENT_RANGE_RE = re.compile(r'^bytes (?P<start>\d+)-(?P<end>\d+)/(?P<length>\d+|\*)$')
 
-def retrieve_file(url, filename, chunk_size=DEFAULT_CHUNK_SIZE, remove_on_error=True):
-    """Save the contents of a URL to the provided filename"""
+#: Responses with these status codes are worth retrying:
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
 
-    logging.debug('Retrieving %s to %s', url, filename)
+# These are only available on Python 3.3+ and some platforms:
+posix_fallocate = getattr(os, 'posix_fallocate', None)
+posix_fadvise = getattr(os, 'posix_fadvise', None)
+# Python 2's HTTPResponse can't read into a buffer, so each chunk is copied:
+response_readinto = hasattr(httplib.HTTPResponse, 'readinto')
 
-    resp = requests.get(url, stream=True)
-    resp.raise_for_status()
 
-    if filename is None:
-        filename = '/dev/null'
+def log_unavailable_features():
+    """Log the optimizations which this Python or platform can't provide"""
 
-    try:
-        with open(filename, 'wb') as f:
-            for chunk in resp.iter_content(chunk_size=chunk_size):
-                f.write(chunk)
+    unavailable = []
 
-    except Exception as exc:
-        logging.error('Error while retrieving %s to %s: %s', url, filename, exc, exc_info=True)
+    if posix_fallocate is None:
+        unavailable.append('preallocating files (os.posix_fallocate)')
+    if posix_fadvise is None:
+        unavailable.append('dropping written files from the page cache (os.posix_fadvise)')
+    if not response_readinto:
+        unavailable.append('reading responses into reusable buffers (HTTPResponse.readinto)')
 
-        if remove_on_error:
-            os.unlink(filename)
+    if unavailable:
+        logging.info('Not available on Python %s: %s', sys.version.split()[0], '; '.join(unavailable))
 
-        raise
+#: errno values which mean the connection failed rather than the local disk.
+# On Python 3 socket.error is OSError, so disk errors look the same otherwise:
+NETWORK_ERRNOS = frozenset(getattr(errno, i) for i in ('ECONNRESET', 'ECONNREFUSED', 'ECONNABORTED',
+                                                        'ETIMEDOUT', 'EHOSTUNREACH', 'EHOSTDOWN',
+                                                        'ENETUNREACH', 'ENETDOWN', 'ENETRESET', 'EPIPE')
+                           if hasattr(errno, i))
 
-    resp.close()
 
-    return resp.status_code, resp.elapsed.total_seconds(), url, filename
+def is_network_error(exc):
+    """Return True if retrying might fix exc, False for local file errors such as ENOSPC or EACCES"""
 
+    if isinstance(exc, (RequestError, httplib.HTTPException, socket.timeout, socket.gaierror,
+                        socket.herror, ssl.SSLError)):
+        return True
 
-def safe_retrieve_file(args):
-    # Trivial wrapper to add logging around downloads and deal with the Pool API
-    # not supporting multiple arguments:
+    return isinstance(exc, EnvironmentError) and exc.errno in NETWORK_ERRNOS
 
-    url, filename = args
 
-    try:
-        return retrieve_file(url, filename)
-    except Exception as exc:
-        logging.error('Unable to retrieve %s: %s', url, exc)
+class RetryableError(RequestError):
+    def __init__(self, message, retry_after=None):
+        super(RetryableError, self).__init__(message)
+        self.retry_after = retry_after
 
 
-def fetch_urls(url_iterator, download_root=None, concurrency=2, chunk_size=DEFAULT_CHUNK_SIZE):
-    pool = ThreadPool(processes=concurrency)
+class PermanentError(Exception):
+    """A failure which retrying will not fix, such as an HTTP 404"""
 
-    if download_root is not None:
-        iterable = ((i, os.path.join(download_root, j)) for i, j in url_iterator)
-    else:
-        iterable = ((i, None) for i, j in url_iterator)
 
-    for i in pool.imap_unordered(safe_retrieve_file, iterable):
-        if not i:
-            continue
+class BufferPool(object):
+    """
+    Reusable receive buffers so each chunk is read directly into memory
+    which was allocated once rather than into a new bytes object
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.free = []
+
+    def get(self):
+        return self.free.pop() if self.free else bytearray(self.size)
+
+    def put(self, buf):
+        self.free.append(buf)
+
+
+class DownloadState(object):
+    """
+    Records the validators for each file so later runs can skip unchanged
+    files and safely resume partial downloads
+
+    The state is kept in a JSON file at the root of the download tree and
+    is rewritten atomically every ``save_interval`` updates.
+    """
+
+    FILENAME = '.fetch_async.json'
+
+    def __init__(self, download_root, save_interval=100):
+        self.path = os.path.join(download_root, self.FILENAME)
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.pending = 0
+
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except IOError:
+            self.entries = {}
+        except ValueError as exc:
+            logging.warning('Ignoring corrupt download state %s: %s', self.path, exc)
+            self.entries = {}
+
+    def get(self, filename):
+        return self.entries.get(filename, {})
+
+    def update(self, filename, **info):
+        with self.lock:
+            self.entries.setdefault(filename, {}).update(info)
+            self.pending += 1
+            save = self.pending >= self.save_interval
+
+        if save:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            self.pending = 0
+            data = json.dumps(self.entries, indent=1, sort_keys=True)
 
-        status_code, elapsed_time, url, local_filename = i
+        temp_path = '%s.tmp' % self.path
+        with open(temp_path, 'w') as f:
+            f.write(data)
+        os.rename(temp_path, self.path)
 
-        logging.info('HTTP %d (%0.2fs) %s', status_code, elapsed_time, url)
+    def write_manifest(self, path):
+        """Write a tab-separated URL, digest, size and filename listing of stored files"""
 
-    pool.close()
-    pool.join()
+        with self.lock:
+            entries = sorted((info['url'], info['digest'], info.get('size'), filename)
+                             for filename, info in self.entries.items() if info.get('digest'))
+
+        temp_path = '%s.tmp' % path
+        with open(temp_path, 'w') as f:
+            for url, digest, size, filename in entries:
+                f.write('%s\t%s\t%s\t%s\n' % (url, digest, size, filename))
+        os.rename(temp_path, path)
+
+
+class ContentStore(object):
+    """
+    Stores each distinct body once under ``ROOT/ab/cd/abcd…`` and links it
+    to every filename which was downloaded with the same content
+
+    Hardlinks are used by default so the store can be deleted without
+    breaking the downloaded tree; if the store is on another filesystem
+    symlinks are used instead. Either way, the linked files share storage
+    and must not be modified in place.
+    """
+
+    HASH = 'sha256'
+
+    def __init__(self, root, link_mode='hard'):
+        self.root = root
+        self.link_mode = link_mode
+
+        self.stored = 0
+        self.deduplicated = 0
+        self.bytes_deduplicated = 0
+
+    def new_hash(self):
+        return hashlib.new(self.HASH)
+
+    def hash_file(self, filename, hasher, length, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Hash the first ``length`` bytes of a partial download before it is resumed"""
+
+        with open(filename, 'rb') as f:
+            while length > 0:
+                chunk = f.read(min(chunk_size, length))
+                if not chunk:
+                    raise IOError('%s is shorter than expected' % filename)
+                hasher.update(chunk)
+                length -= len(chunk)
+
+    def object_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def add(self, filename, digest):
+        """
+        Move a completed file into the store, or remove it if the content is
+        already there, and return the stored path and whether it was new
+        """
+
+        path = self.object_path(digest)
+
+        if os.path.exists(path):
+            self.deduplicated += 1
+            self.bytes_deduplicated += os.path.getsize(filename)
+            os.unlink(filename)
+            return path, False
+
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                if not os.path.isdir(parent):
+                    raise
+
+        # shutil.move renames when possible and copies across filesystems:
+        shutil.move(filename, path)
+        self.stored += 1
+        return path, True
+
+    def link(self, path, filename):
+        """Atomically replace filename with a link to a stored object"""
+
+        temp_filename = '%s.link' % filename
+        if os.path.lexists(temp_filename):
+            os.unlink(temp_filename)
+
+        if self.link_mode == 'hard':
+            try:
+                os.link(path, temp_filename)
+            except OSError as exc:
+                if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                logging.warning('Unable to hardlink %s (%s); using symlinks instead', path, exc)
+                self.link_mode = 'symlink'
+
+        if self.link_mode == 'symlink':
+            os.symlink(os.path.relpath(path, os.path.dirname(filename) or '.'), temp_filename)
+
+        os.rename(temp_filename, filename)
+
+
+class Downloader(object):
+    """
+    Retrieves URLs using a shared connection pool with as many simultaneous
+    downloads as there are greenlets in the pool
+
+    Each file is written to ``FILENAME.part`` and renamed once complete. If
+    a ``.part`` file exists when a download starts, the remaining bytes are
+    requested with a ``Range`` header and ``If-Range`` so a changed file is
+    transparently downloaded from the beginning.
+
+    ``skip_existing`` controls how completed files are checked:
+
+    ``etag``
+        Make a conditional request using the saved ``ETag`` or
+        ``Last-Modified`` values, falling back to ``size`` if neither is known
+    ``size``
+        Make a HEAD request and skip the file if ``Content-Length`` matches
+    ``never``
+        Always download the file again
+
+    If a :class:`ContentStore` is provided, bodies are hashed as they are
+    received and each completed file is moved into the store, or discarded
+    if the store already has that content, and linked back into place. The
+    state file then doubles as a manifest mapping each URL to its digest.
+
+    Bodies are read into reusable buffers and written with ``os.write``.
+    Files with a known length are preallocated to avoid fragmentation. If
+    ``download_root`` is None the bodies are read and discarded without
+    any disk I/O. ``fsync`` controls durability:
+
+    ``none``
+        Leave writeback to the operating system
+    ``file``
+        Flush each file before it is renamed into place
+    ``batch``
+        Flush completed files ``fsync_batch`` at a time, which lets the
+        kernel write them back in the background between flushes. Flushed
+        pages are then dropped from the page cache where supported.
+    """
+
+    MANIFEST_FILENAME = '.fetch_async-manifest.tsv'
+
+    def __init__(self, client, download_root=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 retries=3, backoff=1.0, skip_existing='etag', preallocate=True,
+                 fsync='none', fsync_batch=100, store=None):
+        self.client = client
+        self.download_root = download_root
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.skip_existing = skip_existing
+        self.preallocate = preallocate and posix_fallocate is not None
+        self.fsync = fsync
+        self.fsync_batch = fsync_batch
+        self.store = store
+
+        self.buffers = BufferPool(chunk_size)
+        self.unsynced = []
+
+        self.state = DownloadState(download_root) if download_root else None
+
+        self.downloaded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes_received = 0
+        self.start_time = None
+
+    def fetch_all(self, url_iterator, concurrency=8):
+        pool = Pool(concurrency)
+        self.start_time = time.time()
+
+        try:
+            for url, filename in url_iterator:
+                if self.download_root is not None:
+                    filename = os.path.join(self.download_root, filename)
+                else:
+                    filename = None
+
+                # This will block until a slot is available:
+                pool.spawn(self.safe_retrieve_file, url, filename)
+
+            pool.join()
+        finally:
+            self.sync_files()
+
+            if self.state:
+                self.state.save()
+
+                if self.store:
+                    self.state.write_manifest(os.path.join(self.download_root, self.MANIFEST_FILENAME))
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start_time if self.start_time else 0.0
+
+    @property
+    def throughput(self):
+        """Aggregate download rate in MB/s"""
+        return self.bytes_received / (1024 * 1024) / self.elapsed if self.elapsed else 0.0
+
+    def safe_retrieve_file(self, url, filename):
+        # Trivial wrapper to add logging and retries around downloads:
+
+        for attempt in range(self.retries + 1):
+            try:
+                return self.retrieve_file(url, filename)
+            except (RequestError, PermanentError, httplib.HTTPException, EnvironmentError) as exc:
+                retry_after = getattr(exc, 'retry_after', None)
+
+                if isinstance(exc, EnvironmentError) and not is_network_error(exc):
+                    logging.error('Unable to save %s to %s: %s', url, filename, exc)
+                    self.failed += 1
+                    return
+
+                if attempt >= self.retries or not is_network_error(exc):
+                    logging.error('Unable to retrieve %s: %s', url, exc)
+                    self.failed += 1
+                    return
+
+                # Exponential backoff with full jitter unless the server told us how long to wait:
+                delay = retry_after or random.uniform(0, self.backoff * 2 ** attempt)
+                logging.warning('Retrying %s in %0.1f seconds after error: %s', url, delay, exc)
+                time.sleep(delay)
+
+    def _state_key(self, filename):
+        return os.path.relpath(filename, self.download_root)
+
+    def is_complete(self, url, filename):
+        """Return True if an existing local file appears to match the remote resource"""
+
+        if self.skip_existing == 'never' or not os.path.exists(filename):
+            return False
+
+        local_size = os.path.getsize(filename)
+        saved = self.state.get(self._state_key(filename))
+
+        if self.skip_existing == 'etag' and (saved.get('etag') or saved.get('last_modified')):
+            headers = {}
+            if saved.get('etag'):
+                headers['If-None-Match'] = saved['etag']
+            if saved.get('last_modified'):
+                headers['If-Modified-Since'] = saved['last_modified']
+
+            resp = self.client.head(url, headers=headers)
+            return resp.status_code == 304 and saved.get('size') == local_size
+
+        resp = self.client.head(url)
+        return resp.ok and resp.headers.get('Content-Length') == str(local_size)
+
+    def retrieve_file(self, url, filename):
+        """Save the contents of a URL to the provided filename"""
+
+        if filename is not None and self.is_complete(url, filename):
+            logging.info('Skipping unchanged %s', filename)
+            self.skipped += 1
+            return
+
+        logging.debug('Retrieving %s to %s', url, filename)
+
+        headers = {}
+        offset = 0
+
+        if filename is not None:
+            part_filename = '%s.part' % filename
+
+            parent = os.path.dirname(filename)
+            if parent and not os.path.isdir(parent):
+                try:
+                    os.makedirs(parent)
+                except OSError:
+                    # Another greenlet may have created it first:
+                    if not os.path.isdir(parent):
+                        raise
+
+            if os.path.exists(part_filename):
+                offset = os.path.getsize(part_filename)
+
+            saved = self.state.get(self._state_key(filename))
+
+            # A preallocated file which was never truncated to the received
+            # length means the process was killed and we can't trust it:
+            if saved.get('length') and offset >= saved['length']:
+                offset = 0
+
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+                # Without a validator we can't be sure the partial file is
+                # from the same version of the resource:
+                if saved.get('etag'):
+                    headers['If-Range'] = saved['etag']
+                elif saved.get('last_modified'):
+                    headers['If-Range'] = saved['last_modified']
+                else:
+                    del headers['Range']
+                    offset = 0
+
+        resp = self.client.get(url, headers=headers, stream=True)
+
+        try:
+            if resp.status_code in RETRY_STATUS_CODES:
+                retry_after = resp.headers.get('Retry-After', '')
+                raise RetryableError('HTTP %d %s' % (resp.status_code, resp.reason),
+                                     retry_after=int(retry_after) if retry_after.isdigit() else None)
+            elif resp.status_code >= 400:
+                raise PermanentError('HTTP %d %s' % (resp.status_code, resp.reason))
+
+            if resp.status_code == 206:
+                m = CONTENT_RANGE_RE.match(resp.headers.get('Content-Range', ''))
+                if not m or int(m.group('start')) != offset:
+                    raise RetryableError('Unexpected Content-Range %r for offset %d'
+                                         % (resp.headers.get('Content-Range'), offset))
+                logging.info('Resuming %s at byte %d', url, offset)
+            else:
+                offset = 0
+
+            expected = resp.headers.get('Content-Length')
+            expected = int(expected) if expected and expected.isdigit() else None
+
+            if filename is None:
+                received = self.discard_body(resp)
+            else:
+                self.state.update(self._state_key(filename), url=url,
+                                  etag=resp.headers.get('ETag'),
+                                  last_modified=resp.headers.get('Last-Modified'),
+                                  length=offset + expected if expected is not None else None)
+
+                hasher = None
+                if self.store:
+                    hasher = self.store.new_hash()
+                    if offset:
+                        self.store.hash_file(part_filename, hasher, offset, self.chunk_size)
+
+                received = self.write_body(resp, part_filename, offset, expected, hasher=hasher)
+
+                size = offset + received
+                if expected is not None and received != expected:
+                    raise RetryableError('Incomplete download: received %d of %d bytes'
+                                         % (received, expected))
+
+                if self.store:
+                    digest = hasher.hexdigest()
+                    stored_path, new = self.store.add(part_filename, digest)
+                    self.store.link(stored_path, filename)
+                    self.state.update(self._state_key(filename), size=size, digest=digest)
+                    synced = [stored_path, filename] if new else [filename]
+                else:
+                    os.rename(part_filename, filename)
+                    self.state.update(self._state_key(filename), size=size)
+                    synced = [filename]
+
+                if self.fsync == 'batch':
+                    self.unsynced.extend(synced)
+                    if len(self.unsynced) >= self.fsync_batch:
+                        self.sync_files()
+                elif self.fsync == 'file':
+                    for i in synced:
+                        self.sync_directory(os.path.dirname(i))
+        finally:
+            resp.close()
+
+        self.downloaded += 1
+
+        logging.info('HTTP %d (%0.2fs, %d bytes) %s', resp.status_code, resp.elapsed or 0.0, received, url)
+        logging.debug('%s: %r', url, resp.timings)
+
+        return resp.status_code, resp.elapsed, url, filename
+
+    def read_chunks(self, resp):
+        """Yield memoryviews of received data which are only valid until the next iteration"""
+
+        if resp.headers.get('Content-Encoding', 'identity') != 'identity':
+            # readinto returns the raw bytes, which we'd have to decode:
+            for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                self.bytes_received += len(chunk)
+                yield memoryview(chunk)
+            return
+
+        buf = self.buffers.get()
+        view = memoryview(buf)
+
+        try:
+            while True:
+                count = resp.readinto(view)
+                if not count:
+                    break
+                self.bytes_received += count
+                yield view[:count]
+        finally:
+            self.buffers.put(buf)
+
+    def discard_body(self, resp):
+        return sum(len(chunk) for chunk in self.read_chunks(resp))
+
+    def write_body(self, resp, filename, offset, expected=None, hasher=None):
+        received = 0
+
+        # O_APPEND can't be used to resume because writes would land after
+        # the preallocated space:
+        flags = os.O_WRONLY | os.O_CREAT | (0 if offset else os.O_TRUNC)
+        fd = os.open(filename, flags, 0o644)
+
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+
+            if self.preallocate and expected:
+                try:
+                    posix_fallocate(fd, offset, expected)
+                except OSError as exc:
+                    logging.debug('Unable to preallocate %s: %s', filename, exc)
+
+            for chunk in self.read_chunks(resp):
+                if hasher is not None:
+                    hasher.update(chunk)
+
+                written = 0
+                while written < len(chunk):
+                    written += os.write(fd, chunk[written:])
+                received += written
+
+            if self.fsync == 'file':
+                os.fsync(fd)
+        finally:
+            # Preallocation extends the file so it must be truncated to what we
+            # actually received or a later resume would skip the missing bytes:
+            if self.preallocate and expected and received != expected:
+                os.ftruncate(fd, offset + received)
+
+            os.close(fd)
+
+        return received
+
+    def sync_files(self):
+        """Flush the pending batch of completed files and their directories"""
+
+        unsynced, self.unsynced = self.unsynced, []
+
+        for filename in unsynced:
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+                if posix_fadvise is not None:
+                    # The data is on disk so don't let it evict more useful pages:
+                    posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+        for directory in set(os.path.dirname(i) for i in unsynced):
+            self.sync_directory(directory)
+
+    def sync_directory(self, directory):
+        """Make completed renames durable"""
+
+        fd = os.open(directory or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
 
 def configure_logging(verbosity=0):
@@ -102,6 +648,7 @@ def configure_logging(verbosity=0):
         stdout_handler = logging.StreamHandler(stream=sys.stdout)
         stdout_handler.setLevel(desired_level)
         logging.getLogger().addHandler(stdout_handler)
+        logging.getLogger().setLevel(desired_level)
     else:
         logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
 
@@ -117,7 +664,7 @@ def stdin_url_iterator():
             url, filename = m.groups()
 
             if not filename:
-                filename = urllib.quote(url)
+                filename = quote(url)
 
             yield url, filename
 
@@ -141,12 +688,61 @@ if __name__ == '__main__':
     dl_opts.add_argument('--concurrency', type=int, default=8,
                          help='Number of concurrent requests')
 
+    dl_opts.add_argument('--retries', type=int, default=3,
+                         help='Retry failed downloads this many times')
+
+    dl_opts.add_argument('--backoff', type=float, default=1.0,
+                         help='Base delay in seconds for exponential backoff between retries')
+
+    dl_opts.add_argument('--skip-existing', choices=('etag', 'size', 'never'), default='etag',
+                         help='How to decide whether an existing file is already complete')
+
+    dl_opts.add_argument('--no-preallocate', dest='preallocate', action='store_false', default=True,
+                         help='Do not preallocate disk space for files with a known size')
+
+    dl_opts.add_argument('--fsync', choices=('none', 'file', 'batch'), default='none',
+                         help='Flush downloads to disk after each file or in batches')
+
+    dl_opts.add_argument('--fsync-batch', type=int, default=100,
+                         help='Number of files to flush at a time with --fsync=batch')
+
+    dl_opts.add_argument('--content-store',
+                         help='Store each distinct body once under its digest in this directory'
+                              ' and link it to the requested filenames')
+
+    dl_opts.add_argument('--link-mode', choices=('hard', 'symlink'), default='hard',
+                         help='How to link files to the content store')
+
+    add_client_options(parser)
+
     args = parser.parse_args()
 
     if args.download_root and not os.path.isdir(args.download_root):
         parser.error('Invalid storage location: %s' % args.download_root)
 
+    if args.content_store and not args.download_root:
+        parser.error('--content-store requires --download-root')
+
     configure_logging(args.verbose)
+    log_unavailable_features()
+
+    client = HTTPClient(max_redirects=30, **client_options(args))
+
+    downloader = Downloader(client, download_root=args.download_root, chunk_size=args.chunk_size,
+                            retries=args.retries, backoff=args.backoff,
+                            skip_existing=args.skip_existing, preallocate=args.preallocate,
+                            fsync=args.fsync, fsync_batch=args.fsync_batch,
+                            store=ContentStore(args.content_store, link_mode=args.link_mode) if args.content_store else None)
+
+    downloader.fetch_all(stdin_url_iterator(), concurrency=args.concurrency)
+
+    print('Downloaded {0} files ({1} skipped, {2} failed): {3:0.1f} MB in {4:0.1f} seconds ({5:0.2f} MB/s)'.format(
+          downloader.downloaded, downloader.skipped, downloader.failed,
+          downloader.bytes_received / (1024 * 1024), downloader.elapsed, downloader.throughput),
+          file=sys.stderr)
 
-    fetch_urls(stdin_url_iterator(), args.download_root,
-               chunk_size=args.chunk_size, concurrency=args.concurrency)
+    if downloader.store:
+        print('Stored {0} new objects; {1} duplicates saved {2:0.1f} MB'.format(
+              downloader.store.stored, downloader.store.deduplicated,
+              downloader.store.bytes_deduplicated / (1024 * 1024)),
+              file=sys.stderr)
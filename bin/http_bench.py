@@ -6,38 +6,272 @@ High-performance server-crushing tool
 Usage:
 
 http_bench.py url_or_file [url_or_file2 …]
+
+Files may contain plain URLs or weighted URL templates - see
+webtoolbox.urlmix for the format.
+
+By default each URL is retrieved --repeat times as quickly as possible. Load
+profiles can be selected instead:
+
+    --duration=60                   run for a fixed number of seconds
+    --rate=200                      hold a constant arrival rate (req/s)
+    --ramp=50:500:50                step the rate (or --ramp-mode=concurrency)
+    --find-capacity --max-p99=250   search for the highest rate with p99 < 250ms
+
+When a rate is set, latencies are also reported corrected for coordinated
+omission: measured from when each request should have been sent according
+to the schedule rather than when a free connection allowed it to be sent.
 """
 
+from __future__ import division, print_function
+
 import logging
 import optparse
 import os
-import random
 import sys
 import time
 
 try:
-    from requests import async, session
+    from gevent import monkey
+    monkey.patch_all()
+
+    import gevent
+    from gevent.pool import Pool
 except ImportError:
-    print >>sys.stderr, "Unable to import requests.async. Do you have requests and gevent installed?"
+    print("Unable to import gevent. Do you have gevent installed?", file=sys.stderr)
     raise
 
-__version__ = "0.2"
+from webtoolbox.client import HTTPClient, RequestError, Timings, add_client_options, client_options
+from webtoolbox.stats import LatencyHistogram
+from webtoolbox.urlmix import RequestMix
+
+__version__ = "0.3"
 
 
 class StatsProcessor(object):
-    total = 0
-    errors = 0
-    good_urls = set()
-    bad_urls = set()
+    def __init__(self, label=""):
+        self.label = label
+        self.total = 0
+        self.errors = 0
+        self.good_urls = set()
+        self.bad_urls = set()
+        self.latency = LatencyHistogram()
+        #: Only populated for fixed-rate phases, see :class:`LoadRunner`
+        self.corrected_latency = LatencyHistogram()
+        #: Time spent in each phase of a request, e.g. DNS, connect or TTFB:
+        self.phase_latency = dict((i, LatencyHistogram()) for i in Timings.PHASES)
+        self.elapsed = 0.0
 
-    def __call__(self, response):
+    def __call__(self, url, ok, elapsed, corrected_elapsed=None, timings=None):
         self.total += 1
+        self.latency.record(elapsed)
+
+        if corrected_elapsed is not None:
+            self.corrected_latency.record(corrected_elapsed)
 
-        if not response.ok:
+        if timings is not None:
+            for phase, histogram in self.phase_latency.items():
+                value = getattr(timings, phase)
+                if value is not None:
+                    histogram.record(value)
+
+        if not ok:
             self.errors += 1
-            self.bad_urls.add(response.request.url)
+            self.bad_urls.add(url)
+        else:
+            self.good_urls.add(url)
+
+    @property
+    def rate(self):
+        return self.total / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def error_rate(self):
+        return self.errors / self.total if self.total else 0.0
+
+    @property
+    def p99(self):
+        """The 99th percentile latency, corrected if possible"""
+        if self.corrected_latency.count:
+            return self.corrected_latency.percentile(99)
+        else:
+            return self.latency.percentile(99)
+
+    def report(self):
+        lines = ["{label}{total} requests ({errors} errors) in {elapsed:0.2f} seconds ({rate:0.1f} req/s)".format(
+                 label="%s: " % self.label if self.label else "",
+                 total=self.total, errors=self.errors, elapsed=self.elapsed, rate=self.rate)]
+
+        histograms = [("raw", self.latency)]
+        if self.corrected_latency.count:
+            histograms.append(("corrected", self.corrected_latency))
+
+        for name, histogram in histograms:
+            lines.append("    {name:>9} latency ms: p50={p50:0.1f} p90={p90:0.1f} p99={p99:0.1f}"
+                         " p99.9={p99_9:0.1f} max={max:0.1f}".format(name=name, **histogram.summary()))
+
+        lines.append("    phase means ms: %s (%d new connections)" % (
+            " ".join("%s=%0.1f" % (phase, self.phase_latency[phase].mean * 1000) for phase in Timings.PHASES),
+            self.phase_latency["connect"].count))
+
+        return "\n".join(lines)
+
+
+class LoadRunner(object):
+    """
+    Issues requests for URLs from a (possibly infinite) iterator in phases
+
+    Each phase either runs closed-loop, starting a new request as soon as
+    one of ``concurrency`` slots is free, or open-loop at a target arrival
+    rate with ``concurrency`` as an upper bound on outstanding requests.
+
+    Open-loop phases record a second, corrected latency measured from each
+    request's intended start time. Without it, a server stall which fills
+    every slot would delay the requests which should have been sent during
+    the stall and their time spent waiting would never be counted.
+    """
+
+    def __init__(self, client, urls):
+        self.client = client
+        self.urls = urls
+
+    def fetch(self, url, stats, intended_start=None):
+        start = time.time()
+        timings = None
+
+        try:
+            response = self.client.get(url)
+            ok = response.ok
+            timings = response.timings
+        except RequestError as exc:
+            logging.warning("Unable to retrieve %s: %s", url, exc)
+            ok = False
+
+        end = time.time()
+
+        stats(url, ok, end - start,
+              corrected_elapsed=None if intended_start is None else end - intended_start,
+              timings=timings)
+
+    def run_phase(self, concurrency, rate=None, duration=None, label=""):
+        stats = StatsProcessor(label=label)
+        pool = Pool(concurrency)
+
+        start_time = time.time()
+        deadline = start_time + duration if duration else None
+
+        logging.info("Starting phase %s: concurrency=%d rate=%s duration=%s",
+                     label, concurrency, rate or "unlimited", duration or "unlimited")
+
+        for i, url in enumerate(self.urls):
+            if rate:
+                intended_start = start_time + i / rate
+                delay = intended_start - time.time()
+                if delay > 0:
+                    gevent.sleep(delay)
+            else:
+                intended_start = None
+
+            if deadline is not None and time.time() >= deadline:
+                break
+
+            # This will block until a slot is available:
+            pool.spawn(self.fetch, url, stats, intended_start)
+
+        pool.join()
+
+        stats.elapsed = time.time() - start_time
+
+        return stats
+
+
+def parse_ramp(value):
+    try:
+        start, stop, step = map(float, value.split(":"))
+    except ValueError:
+        raise ValueError("Ramps must be specified as START:STOP:STEP, not %s" % value)
+
+    if step <= 0 or stop < start:
+        raise ValueError("Invalid ramp %s: STOP must be >= START and STEP must be positive" % value)
+
+    steps = []
+    current = start
+    while current <= stop + 1e-9:
+        steps.append(current)
+        current += step
+
+    return steps
+
+
+def run_ramp(runner, options):
+    results = []
+
+    for value in parse_ramp(options.ramp):
+        if options.ramp_mode == "concurrency":
+            stats = runner.run_phase(int(value), rate=options.rate,
+                                     duration=options.step_duration,
+                                     label="concurrency=%d" % value)
         else:
-            self.good_urls.add(response.request.url)
+            stats = runner.run_phase(options.max_requests, rate=value,
+                                     duration=options.step_duration,
+                                     label="rate=%g" % value)
+
+        print(stats.report())
+        results.append(stats)
+
+    return results
+
+
+def find_capacity(runner, options):
+    """
+    Return the highest arrival rate which meets the latency and error limits
+
+    The rate is doubled until a step fails and the last passing and first
+    failing rates are then bisected until they're within 5% of each other.
+    """
+
+    results = []
+
+    def acceptable(rate):
+        stats = runner.run_phase(options.max_requests, rate=rate,
+                                 duration=options.step_duration,
+                                 label="rate=%0.1f" % rate)
+        results.append(stats)
+
+        passed = (stats.p99 * 1000 <= options.max_p99
+                  and stats.error_rate <= options.max_error_rate
+                  # If we couldn't issue requests fast enough the result is meaningless:
+                  and stats.rate >= rate * 0.9)
+
+        print("%s [%s]" % (stats.report(), "pass" if passed else "FAIL"))
+
+        return passed
+
+    low, high = 0.0, None
+    rate = options.rate or 10.0
+
+    while high is None:
+        if acceptable(rate):
+            low = rate
+            rate *= 2
+        else:
+            high = rate
+
+    while high - low > max(low * 0.05, 1):
+        rate = (low + high) / 2
+
+        if acceptable(rate):
+            low = rate
+        else:
+            high = rate
+
+    if low:
+        print("Capacity: {0:0.1f} req/s with p99 <= {1:g}ms and error rate <= {2:0.1%}".format(
+            low, options.max_p99, options.max_error_rate))
+    else:
+        print("Unable to find any rate with p99 <= {0:g}ms".format(options.max_p99))
+
+    return results
 
 
 def main(argv=None):
@@ -52,13 +286,48 @@ def main(argv=None):
                          help="Set the number of simultaneous requests")
     cmdparser.add_option("--repeat", type="int", default=1,
                          help="Retrieve the provided URLs n times")
+    cmdparser.add_option("--requests", type="int",
+                         help="Make this many requests rather than --repeat times the number of URLs")
     cmdparser.add_option("--random", action="store_true", default=False,
-                         help="Randomize the URLs before processing")
+                         help="Pick URLs randomly rather than in order. Weighted URLs are always picked randomly")
+    cmdparser.add_option("--base-url", type="string",
+                         help="Resolve relative URLs, such as paths from log_to_tsv, against this URL")
+
+    profile_options = optparse.OptionGroup(cmdparser, "Load Profiles")
+    profile_options.add_option("--duration", type="float",
+                               help="Run for this many seconds, repeating URLs as necessary")
+    profile_options.add_option("--rate", type="float",
+                               help="Start requests at this constant rate (req/s) rather than as fast as possible")
+    profile_options.add_option("--ramp", type="string", metavar="START:STOP:STEP",
+                               help="Run a series of steps at increasing rate or concurrency")
+    profile_options.add_option("--ramp-mode", choices=("rate", "concurrency"), default="rate",
+                               help="Whether --ramp changes the arrival rate or concurrency (default=%default)")
+    profile_options.add_option("--step-duration", type="float", default=30,
+                               help="Seconds to run each ramp or capacity search step (default=%default)")
+    profile_options.add_option("--find-capacity", action="store_true", default=False,
+                               help="Search for the highest rate which meets --max-p99 and --max-error-rate")
+    profile_options.add_option("--max-p99", type="float", default=500,
+                               help="Capacity search: 99th percentile latency limit in ms (default=%default)")
+    profile_options.add_option("--max-error-rate", type="float", default=0.01,
+                               help="Capacity search: maximum fraction of failed requests (default=%default)")
+    cmdparser.add_option_group(profile_options)
+
+    add_client_options(cmdparser)
+
     (options, args) = cmdparser.parse_args()
 
     if not args:
         cmdparser.error("You must provide at least one URL to retrieve!")
 
+    if options.ramp and options.find_capacity:
+        cmdparser.error("--ramp and --find-capacity cannot be combined")
+
+    if options.ramp:
+        try:
+            parse_ramp(options.ramp)
+        except ValueError as exc:
+            cmdparser.error(str(exc))
+
     if options.verbosity > 1:
         log_level = logging.DEBUG
     elif options.verbosity:
@@ -69,41 +338,55 @@ def main(argv=None):
     logging.basicConfig(format="%(asctime)s [%(levelname)s]: %(message)s",
                         level=log_level)
 
-    stats = StatsProcessor()
-
-    urls = list()
+    mix = RequestMix(base_url=options.base_url)
 
     for arg in args:
         # Is it a file?
-        if os.path.exists(arg):
-            urls.extend(l.strip() for l in file(sys.argv[1]))
-        else:
-            urls.append(arg)
-
-    if options.repeat > 1:
-        urls = urls * options.repeat
+        try:
+            if os.path.exists(arg):
+                mix.load(arg)
+            else:
+                mix.add(arg)
+        except (IOError, ValueError) as exc:
+            cmdparser.error("Unable to load %s: %s" % (arg, exc))
 
-    if options.random:
-        random.shuffle(urls)
+    # Anything other than the classic fixed list needs an endless supply of URLs:
+    if options.duration or options.ramp or options.find_capacity:
+        count = None
+    elif options.requests:
+        count = options.requests
+    else:
+        count = len(mix) * options.repeat
 
-    # Now that we're done changing it, we'll load the URL queue into the fetcher:
-    start_time = time.time()
+    # Unlike the spiders, the connection pool should never be a bottleneck:
+    max_concurrency = options.max_requests
+    if options.ramp and options.ramp_mode == "concurrency":
+        max_concurrency = max(max_concurrency, int(parse_ramp(options.ramp)[-1]))
+    options.pool_size = max(options.pool_size, max_concurrency)
 
-    with session(hooks={"response": stats}, config={"max_redirects": 1}) as s:
-        async.map([async.get(u, session=s) for u in urls], size=options.max_requests)
+    with HTTPClient(max_redirects=1, **client_options(options)) as client:
+        runner = LoadRunner(client, mix.generate(count=count, randomize=options.random))
 
-    elapsed = time.time() - start_time
+        if options.ramp:
+            results = run_ramp(runner, options)
+        elif options.find_capacity:
+            results = find_capacity(runner, options)
+        else:
+            stats = runner.run_phase(options.max_requests, rate=options.rate,
+                                     duration=options.duration)
+            results = [stats]
 
-    print "Retrieved {total} URLs ({bad} errors) in {elapsed:0.2f} seconds ({rate:0.1f} req/s)".format(
-        bad=stats.errors, elapsed=elapsed, rate=stats.total / elapsed, total=stats.total)
+            print("Retrieved {total} URLs ({bad} errors) in {elapsed:0.2f} seconds ({rate:0.1f} req/s)".format(
+                bad=stats.errors, elapsed=stats.elapsed, rate=stats.rate, total=stats.total))
+            print(stats.report())
 
     if options.save_bad_urls:
-        with open(options.save_bad_urls, "wb") as f:
-            f.write("\n".join(stats.bad_urls))
+        with open(options.save_bad_urls, "w") as f:
+            f.write("\n".join(set().union(*(i.bad_urls for i in results))))
 
     if options.save_good_urls:
         with open(options.save_good_urls, "w") as f:
-            f.write("\n".join(stats.good_urls))
+            f.write("\n".join(set().union(*(i.good_urls for i in results))))
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -7,65 +7,35 @@ Usage:
 
 %prog --server=mytestserver log1 [log2.gz log3.zip...]
 
-Log files can be compressed with gzip or zip - they'll be silently
-decompressed as needed.
+Log files can be compressed with gzip, bzip2, xz, zstd or zip - they'll be
+silently decompressed as needed. Use - to read from stdin.
 
-BUG: Currently only one IIS log flavor is supported!
+--since and --until replay part of a log. Uncompressed logs are indexed so
+only the lines near that time range are read. The format of each file is detected from its first
+lines unless --log-format is used.
 """
 import optparse
 import logging
 import sys
 import os
 import time
-import re
-import gzip
-import zipfile
+import itertools
 import urllib
-import datetime
 from collections import deque
-from functools import partial
 
-from requests import async
+from gevent import monkey
+monkey.patch_all()
 
+from gevent.pool import Pool
 
-__version__ = "0.2"
+from webtoolbox.client import HTTPClient, RequestError, add_client_options, client_options
+from webtoolbox.logs import ALIASES, FORMATS, LogReader, detect_format, get_format
+from webtoolbox.logs.filters import LogFilter, parse_time
+from webtoolbox.logs.index import TimestampIndex
+from webtoolbox.logs.readers import is_splittable
 
-# FIXME: This is currently based on IIS log lines like this:
-# date time c-ip cs-username s-ip s-port cs-method cs-uri-stem cs-uri-query sc-status sc-bytes cs-bytes cs(User-Agent) cs(Referer)
-# This should be refactored into a module, include support for other
-# webservers and - ideally - autodetect the flavor and even validate the IIS
-# regexp against the embedded header IIS puts in its log files.
-
-IIS_LOG_RE = re.compile(r"""
-    ^(?P<year>\d{4})\-(?P<month>\d{2})\-(?P<day>\d{2})\s+
-    (?P<hour>\d{2})\:(?P<minute>\d{2})\:(?P<second>\d{2})\s+
-    (?P<c_ip>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s+
-    (?P<cs_username>.+?)\s+
-    (?P<s_ip>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s+
-    (?P<s_port>\d{1,3})\s+
-    (?P<cs_method>.+?)\s+
-    (?P<cs_uri_stem>.+?)\s+
-    (?P<cs_uri_query>.+?)\s+
-    (?P<sc_status>\d{1,3})\s+
-    (?P<sc_bytes>\d+)\s+
-    (?P<cs_bytes>\d+)\s+
-    (?P<csUser_Agent>.+?)\s+
-    (?P<csReferer>.+)
-""".strip(), re.IGNORECASE and re.VERBOSE)
-
-APACHE_LOG_RE = re.compile(r"""
-    ^(?P<c_ip>[^ ]+)\s
-    (?P<cs_username>[^ ]+?)\s
-    ([^ ]+)\s+
-    \[(?P<day>\d{2})/(?P<month_name>[^/]+)/(?P<year>\d{4})\:(?P<hour>\d{2})\:(?P<minute>\d{2})\:(?P<second>\d{2}) (?P<tz_offset>[^]]+)\]\s
-    "(?P<cs_method>[^ ]+)\s
-    (?P<cs_uri_stem>[^ ]+)\s
-    (?P<protocol>[^"]+)"\s
-    (?P<sc_status>\d{1,3})\s+
-    (?P<sc_bytes>\d+)\s*
-    (?P<cs_uri_query>.*?)\s*
-""".strip(), re.IGNORECASE and re.VERBOSE)
 
+__version__ = "0.2"
 
 class LogReplayer(object):
     total = 0
@@ -78,42 +48,69 @@ class LogReplayer(object):
 
     start_time = None
 
-    def __init__(self, format=None, server=None, time_factor=1, max_clients=10, max_connections=6):
-        if format == "iis":
-            self.LOG_RE = IIS_LOG_RE
-        else:
-            self.LOG_RE = APACHE_LOG_RE
+    def __init__(self, format="auto", server=None, time_factor=1, max_clients=10, max_connections=6,
+                 client_options=None, log_filter=None, use_index=True):
+        self.format = format
+        self.log_filter = log_filter if log_filter else None
+        self.use_index = use_index
 
         if not server.startswith("http://"):
             server = "http://%s" % server
 
         self.base_url = server
         self.time_factor = time_factor
+        self.max_connections = max_connections
+
+        self.client = HTTPClient(**(client_options or {}))
+        self.pool = Pool(max_connections)
 
     def log_iterator(self):
         for filename in self.log_files:
-            if filename.endswith(".gz"):
-                f = gzip.open(filename)
-            elif filename.endswith(".zip"):
-                f = zipfile.ZipFile(filename, mode="r").open()
+            log_filter = self.log_filter
+
+            # gevent has replaced threads with greenlets so a reader thread wouldn't help:
+            lines = LogReader(filename, threaded=False).iter_lines()
+
+            head = list(itertools.islice(lines, 100))
+            lines = itertools.chain(head, lines)
+
+            if self.format == "auto":
+                log_format = detect_format(head)
             else:
-                f = file(filename)
+                # Reading from an indexed byte range would miss the directives
+                # at the start of the file:
+                log_format = get_format(self.format)
+                log_format.read_directives("\n".join(head))
+
+            logging.info("Replaying %s as %s", filename, log_format.name)
+
+            if (self.use_index and log_filter is not None and (log_filter.since or log_filter.until)
+                    and is_splittable(filename)):
+                index = TimestampIndex.load_or_build(filename, log_format)
+                start, end = index.byte_range(log_filter.since, log_filter.until)
+                logging.info("Reading bytes %d-%d of %s", start, end, filename)
+                lines = LogReader(filename, threaded=False, start=start, end=end).iter_lines()
+
+            for l in lines:
+                if log_filter is not None and not log_filter.accept_line(l, log_format):
+                    continue
 
-            for l in f:
-                m = self.LOG_RE.match(l)
+                entry = log_format.parse(l)
 
-                if not m:
+                if entry is None:
                     logging.debug("Skipping noise line %s", l.strip())
                     continue
 
-                l_time = datetime.datetime(int(m.group("year")), int(m.group("month")), int(m.group("day")),
-                                           int(m.group("hour")), int(m.group("minute")), int(m.group("second")))
+                if log_filter is not None and not log_filter.accept(entry):
+                    continue
+
+                timestamp, method, status_code, path, query_string = entry[:5]
 
-                url = m.group("cs_uri_stem")
-                if m.group("cs_uri_query") != "-":
-                    url += "?" + m.group("cs_uri_query")
+                url = path
+                if query_string:
+                    url += "?" + query_string
 
-                yield l_time, urllib.basejoin(self.base_url, url), int(m.group("sc_status"))
+                yield timestamp, urllib.basejoin(self.base_url, url), status_code
 
     def run(self):
         self.start_time = time.time()
@@ -132,40 +129,49 @@ class LogReplayer(object):
             delta_time = timestamp - virtual_time
 
             # TODO: The max drift should be a command-line option:
-            if delta_time.seconds >= 1:
+            if delta_time >= 1:
                 if accumulator:
                     self.issue_requests(accumulator)
 
-                logging.info("Sleeping until simulated time %s", timestamp)
-                # … and we're throwing all of that nice asynchronous goodness away for a
-                # little while:
-                time.sleep(delta_time.seconds / self.time_factor)
+                logging.info("Sleeping until simulated time %s", time.ctime(timestamp))
+                # time.sleep has been patched by gevent so requests which are
+                # already in progress will continue while we wait:
+                time.sleep(delta_time / self.time_factor)
 
             virtual_time = timestamp
 
             if len(accumulator) > self.max_connections:
                 self.issue_requests(accumulator)
 
+        self.issue_requests(accumulator)
+        self.pool.join()
+
         self.elapsed = time.time() - self.start_time
 
     def issue_requests(self, reqs):
+        while reqs:
+            url, status_code = reqs.popleft()
+            # This will block until a connection is available:
+            self.pool.spawn(self.replay_request, url, status_code)
+
+    def replay_request(self, url, status_code):
         self.total += 1
 
-        async.map([async.get(url, partial(self.response_handler, status_code=status_code))
-                    for url, status_code in reqs],
-                  size=self.max_connections)
+        try:
+            response = self.client.get(url)
+        except RequestError as exc:
+            logging.warning("Unable to retrieve %s: %s", url, exc)
+            self.errors += 1
+            return
 
-    def response_handler(self, response, status_code):
-        url = response.request.url
+        logging.debug("%s: %r", url, response.timings)
 
-        if response.code != status_code:
-            logging.warning("URL %s returned %s, not expected %s", url, response.code, status_code)
+        if response.status_code != status_code:
+            logging.warning("URL %s returned %s, not expected %s", url, response.status_code, status_code)
             self.errors += 1
 
         self.completed += 1
 
-        self.load_next_url()
-
 
 def main(argv=None):
     cmdparser = optparse.OptionParser(__doc__.strip(), version="log_replay %s" % __version__)
@@ -174,9 +180,23 @@ def main(argv=None):
     cmdparser.add_option("--max-clients", type="int", default=10, help="Set the number of simultaneous clients")
     cmdparser.add_option("--factor", type="int", default=1, help="Replay logs at this factor of realtime (default=%default)")
     cmdparser.add_option("--server", help="Set the server used for each URL")
-    cmdparser.add_option("--log-format", default="apache", choices=("apache", "iis"))
+    cmdparser.add_option("--log-format", default="auto", choices=("auto", ) + tuple(FORMATS) + tuple(ALIASES),
+                         help="Log format (default: detected from the start of each file)")
+    cmdparser.add_option("--since", help="Only replay requests at or after this time (ISO 8601, UTC by default)")
+    cmdparser.add_option("--until", help="Only replay requests before this time")
+    cmdparser.add_option("--path-re", help="Only replay requests whose path matches this regular expression")
+    cmdparser.add_option("--no-index", dest="use_index", default=True, action="store_false",
+                         help="Do not create or use a LOG.tsidx timestamp index to find the time range")
+    add_client_options(cmdparser)
     (options, args) = cmdparser.parse_args()
 
+    try:
+        log_filter = LogFilter(since=parse_time(options.since) if options.since else None,
+                               until=parse_time(options.until) if options.until else None,
+                               path_re=options.path_re)
+    except ValueError as exc:
+        cmdparser.error(str(exc))
+
     if not args:
         cmdparser.error("You must provide at least one file containing the log lines to replay")
 
@@ -197,10 +217,13 @@ def main(argv=None):
                            server=options.server,
                            max_connections=options.max_connections,
                            max_clients=options.max_clients,
-                           time_factor=options.factor)
+                           time_factor=options.factor,
+                           client_options=client_options(options),
+                           log_filter=log_filter,
+                           use_index=options.use_index)
 
     for arg in args:
-        if not os.path.exists(arg):
+        if arg != "-" and not os.path.exists(arg):
             cmdparser.error("%s doesn't exist" % arg)
 
     replayer.log_files = args
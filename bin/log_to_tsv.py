@@ -2,139 +2,418 @@
 # encoding: utf-8
 """
 Convert various webserver log formats to tab-separated values with output control
+
+The format of each file is detected from its first lines unless --log-format
+is used. Uncompressed logs are split into line-aligned byte ranges which are
+parsed in parallel by --jobs worker processes. Output is written as each range
+finishes unless --ordered is used. Compressed logs (gzip, bzip2, xz, zstd or
+every member of a ZIP archive) and stdin ("-") are decompressed on a separate
+thread and parsed in blocks.
+
+--aggregate writes bounded-memory summaries instead of every entry: the top
+paths as a URL mix for http_bench, requests per --bucket seconds, status ×
+method counts and the approximate number of distinct user-agents.
+
+--since and --until use a sparse timestamp index, saved beside uncompressed
+logs as LOG.tsidx, to read only the part of the file which covers that time.
+
+--output-format=arrow or parquet writes typed, dictionary-encoded columns using
+pyarrow. If pyarrow isn't installed, or with --output-format=npz, the columns
+are saved with numpy.savez_compressed instead.
 """
 
 import argparse
+import copy
+import itertools
 import logging
-import sys
+import multiprocessing
 import os
-import re
-import gzip
-import zipfile
-import datetime
-from collections import namedtuple
+import queue
+import sys
+from array import array
+from collections import deque
 from urllib.parse import urljoin
 
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from webtoolbox.logs import ALIASES, FORMATS, LogEntry, detect_format, get_format
+from webtoolbox.logs.aggregate import LogSummary
+from webtoolbox.logs.filters import LogFilter, parse_time
+from webtoolbox.logs.index import TimestampIndex
+from webtoolbox.logs.readers import DEFAULT_BLOCK_SIZE, LogReader, is_splittable
+
 
 __version__ = "1.0"
 
 
-MONTH_NAMES = {
-    'Jan': 1,
-    'Feb': 2,
-    'Mar': 3,
-    'Apr': 4,
-    'May': 5,
-    'Jun': 6,
-    'Jul': 7,
-    'Aug': 8,
-    'Sep': 9,
-    'Oct': 10,
-    'Nov': 11,
-    'Dec': 12
+#: Uncompressed files are split into ranges of roughly this many bytes:
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+#: Columnar writers buffer this many rows before writing a record batch:
+DEFAULT_BATCH_SIZE = 64 * 1024
+
+#: --aggregate choices and the LogSummary methods which write them:
+AGGREGATIONS = {
+    'paths': 'write_paths',
+    'time': 'write_time_buckets',
+    'status': 'write_status_methods',
+    'user-agents': 'write_user_agents',
 }
 
-LogEntry = namedtuple('LogEntry', ['timestamp', 'method', 'status', 'path', 'query_string', 'user_agent'])
+OUTPUT_EXTENSIONS = {
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.parquet': 'parquet',
+    '.npz': 'npz',
+}
+
+
+def split_file(log_filename, chunk_size=DEFAULT_CHUNK_SIZE, start=0, end=None):
+    """Return (start, end) byte ranges which each begin at the start of a line"""
 
+    size = os.path.getsize(log_filename) if end is None else end
+    ranges = []
 
-def core_log_iterator(LOG_RE, log_filename):
-    if log_filename.endswith(".gz"):
-        f = gzip.open(log_filename, mode='rt')
-    elif log_filename.endswith(".zip"):
-        f = zipfile.ZipFile(log_filename, mode='r').open()
+    with open(log_filename, mode='rb') as f:
+        while start < size:
+            f.seek(start + chunk_size)
+            f.readline()
+            range_end = min(f.tell(), size)
+            ranges.append((start, range_end))
+            start = range_end
+
+    return ranges
+
+
+def parse_task(task):
+    """
+    Worker entry point: parse a block of text or a byte range of an
+    uncompressed file
+    """
+
+    log_format, log_filter, label, source = task
+
+    if isinstance(source, str):
+        text = source
     else:
-        f = open(log_filename, mode='r')
+        log_filename, start, end = source
+        with open(log_filename, mode='rb') as f:
+            f.seek(start)
+            text = f.read(end - start).decode('utf-8', errors='replace')
 
-    try:
-        for line_number, line in enumerate(f):
-            m = LOG_RE.match(line)
+    return log_format.parse_lines(text.split('\n'), label, log_filter=log_filter)
+
+
+def get_file_format(log_filename, format_name='auto', lines=None):
+    """
+    Return the requested format or the one detected from the start of the
+    file, with the directives from the start of the file applied either way
+    """
+
+    if lines is None:
+        lines = list(itertools.islice(LogReader(log_filename, threaded=False).iter_lines(), 100))
+    else:
+        lines = lines[:100]
+
+    if format_name != 'auto':
+        log_format = get_format(format_name)
+        log_format.read_directives('\n'.join(lines))
+    else:
+        log_format = detect_format(lines)
+
+    logging.info("Parsing %s as %s", log_filename, log_format.name)
+
+    return log_format
+
+
+def iter_tasks(filenames, format_name='auto', chunk_size=DEFAULT_CHUNK_SIZE, log_filter=None, use_index=True):
+    """
+    Uncompressed files are split into byte ranges which the workers read
+    themselves. If a time range was requested, only the part of the file
+    which the sparse timestamp index says could contain it is read.
+
+    Compressed files and stdin are decompressed by a reader thread in this
+    process and sent to the workers as blocks of text. The format is
+    detected again for each member of a ZIP archive.
+    """
+
+    if log_filter is not None and not log_filter:
+        log_filter = None
+
+    for filename in filenames:
+        if is_splittable(filename):
+            log_format = get_file_format(filename, format_name)
+
+            start, end = 0, None
+            if use_index and log_filter is not None and (log_filter.since or log_filter.until):
+                index = TimestampIndex.load_or_build(filename, log_format)
+                start, end = index.byte_range(log_filter.since, log_filter.until)
+                logging.info("Reading bytes %d-%d of %s", start, end, filename)
+
+            for range_start, range_end in split_file(filename, chunk_size, start, end):
+                yield log_format, log_filter, '%s@%d' % (filename, range_start), (filename, range_start, range_end)
+            continue
+
+        reader = LogReader(filename, block_size=min(chunk_size, DEFAULT_BLOCK_SIZE))
+        log_format = None
+        current_member = None
+
+        for block_number, (member, block) in enumerate(reader.iter_blocks(members=True)):
+            name = filename if member is None else '%s:%s' % (filename, member)
+
+            if log_format is None or member != current_member:
+                log_format = get_file_format(name, format_name, lines=block.split('\n'))
+                current_member = member
+
+            # The task is pickled later, on another thread, so it gets a copy
+            # which the directives in this block can't change:
+            yield copy.copy(log_format), log_filter, '%s#%d' % (name, block_number), block
+
+            # Later blocks must use the columns declared in this one:
+            log_format.read_directives(block)
+
+
+def parallel_map(pool, func, tasks, ordered=True, max_pending=8):
+    """
+    Like Pool.imap, but without reading more than ``max_pending`` tasks
+    ahead so streamed input isn't buffered in memory faster than the
+    workers can parse it
+    """
+
+    if ordered:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(func, (task, )))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        return
+
+    results = queue.Queue()
+    pending = 0
+
+    def next_result():
+        result = results.get()
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    for task in tasks:
+        pool.apply_async(func, (task, ), callback=results.put, error_callback=results.put)
+        pending += 1
+        if pending >= max_pending:
+            yield next_result()
+            pending -= 1
+
+    while pending:
+        yield next_result()
+        pending -= 1
+
+
+def get_log_batches(filenames, format_name='auto', jobs=1, ordered=True, chunk_size=DEFAULT_CHUNK_SIZE,
+                    log_filter=None, use_index=True):
+    """
+    Yield lists of parsed rows, with fields in LogEntry order, from each
+    line-aligned range or block of each file
+
+    With more than one job the ranges are parsed by a pool of worker
+    processes and batches are returned in completion order unless
+    ``ordered`` is set.
+    """
+
+    tasks = iter_tasks(filenames, format_name, chunk_size, log_filter=log_filter, use_index=use_index)
+
+    if jobs <= 1:
+        for task in tasks:
+            yield parse_task(task)
+        return
+
+    with multiprocessing.Pool(jobs) as pool:
+        yield from parallel_map(pool, parse_task, tasks, ordered=ordered, max_pending=2 * jobs)
+
+
+def get_log_entries(filenames, format_name='auto', **kwargs):
+    for batch in get_log_batches(filenames, format_name, **kwargs):
+        for row in batch:
+            yield LogEntry._make(row)
+
+
+class TSVWriter(object):
+    def __init__(self, stream, fields, headers=True):
+        self.stream = stream
+        self.fields = fields
+
+        if headers:
+            self.stream.write('\t'.join(fields) + '\n')
+
+    def write_rows(self, rows):
+        if rows:
+            self.stream.write('\n'.join('\t'.join(map(str, row)) for row in rows))
+            self.stream.write('\n')
+
+    def close(self):
+        self.stream.flush()
 
-            if not m:
-                logging.debug("Skipping noise line %d: %s", line_number, line.strip())
-                continue
 
-            groups = m.groupdict()
+class ColumnarWriter(object):
+    """
+    Buffers rows into typed columns and writes them every ``batch_size`` rows
 
-            if 'month_name' in groups:
-                month = MONTH_NAMES[groups['month_name']]
+    Timestamps are stored as int64 seconds and status codes as uint16. The
+    low-cardinality strings in DICTIONARY_FIELDS are stored as int32 codes
+    into a dictionary which is shared by every batch in the file.
+    """
+
+    DICTIONARY_FIELDS = ('method', 'path', 'user_agent')
+
+    def __init__(self, filename, fields, batch_size=DEFAULT_BATCH_SIZE):
+        self.filename = filename
+        self.fields = fields
+        self.batch_size = batch_size
+        self.rows = 0
+
+        self.dictionaries = {i: {} for i in fields if i in self.DICTIONARY_FIELDS}
+        self.columns = self.new_columns()
+
+    def new_columns(self):
+        columns = []
+        for field in self.fields:
+            if field == 'timestamp':
+                columns.append(array('q'))
+            elif field == 'status':
+                columns.append(array('H'))
+            elif field in self.dictionaries:
+                columns.append(array('i'))
             else:
-                month = int(groups["month"])
+                columns.append([])
+        return columns
+
+    def write_rows(self, rows):
+        for i, (field, column) in enumerate(zip(self.fields, self.columns)):
+            if field == 'timestamp':
+                column.extend(int(row[i]) for row in rows)
+            elif field in self.dictionaries:
+                codes = self.dictionaries[field]
+                column.extend(codes.setdefault(row[i], len(codes)) for row in rows)
+            else:
+                column.extend(row[i] for row in rows)
+
+        self.rows += len(rows)
+
+        if self.rows >= self.batch_size:
+            self.flush()
 
-            l_time = datetime.datetime(int(groups["year"]), month, int(groups["day"]),
-                                       int(groups["hour"]), int(groups["minute"]), int(groups["second"]))
+    def flush(self):
+        if self.rows:
+            self.write_columns(self.columns)
+            self.columns = self.new_columns()
+            self.rows = 0
 
-            path = groups["request_path"]
+    def write_columns(self, columns):
+        raise NotImplementedError
 
-            if "uri_query" in groups:
-                qs = groups["uri_query"]
-            elif '?' in path:
-                path, qs = path.split('?', 1)
+    def close(self):
+        self.flush()
+
+    def dictionary_values(self, field):
+        # Codes are assigned in insertion order, which dicts preserve:
+        return list(self.dictionaries[field])
+
+
+class ArrowWriter(ColumnarWriter):
+    """Writes an Arrow IPC file, or Parquet if ``parquet`` is set, using pyarrow"""
+
+    def __init__(self, filename, fields, batch_size=DEFAULT_BATCH_SIZE, parquet=False):
+        super().__init__(filename, fields, batch_size=batch_size)
+
+        types = []
+        for field in fields:
+            if field == 'timestamp':
+                types.append(pyarrow.int64())
+            elif field == 'status':
+                types.append(pyarrow.uint16())
+            elif field in self.dictionaries:
+                types.append(pyarrow.dictionary(pyarrow.int32(), pyarrow.string()))
             else:
-                qs = ''
+                types.append(pyarrow.string())
 
-            yield LogEntry(
-                timestamp=l_time.timestamp(), method=groups['method'], status=int(groups["status_code"]),
-                path=path, query_string=qs, user_agent=groups['user_agent']
-            )
-    finally:
-        f.close()
-
-
-def iis_log_iterator(log_filename):
-    # FIXME: This is currently based on IIS log lines like this:
-    # date time c-ip cs-username s-ip s-port cs-method cs-uri-stem cs-uri-query sc-status sc-bytes cs-bytes cs(User-Agent) cs(referer)
-    # This should be refactored into a module, include support for other
-    # webservers and - ideally - autodetect the flavor and even validate the IIS
-    # regexp against the embedded header IIS puts in its log files.
-
-    IIS_LOG_RE = re.compile(r"""
-        ^(?P<year>\d{4})\-(?P<month>\d{2})\-(?P<day>\d{2})\s+
-        (?P<hour>\d{2})\:(?P<minute>\d{2})\:(?P<second>\d{2})\s+
-        (?P<client_ip>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s+
-        (?P<username>.+?)\s+
-        (?P<server_ip>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s+
-        (?P<server_port>\d{1,3})\s+
-        (?P<method>.+?)\s+
-        (?P<request_path>.+?)\s+
-        (?P<uri_query>.+?)\s+
-        (?P<status_code>\d{1,3})\s+
-        (?P<response_bytes>\d+)\s+
-        (?P<cs_bytes>\d+)\s+
-        (?P<user_agent>.+?)\s+
-        (?P<csreferer>.+)
-    """.strip(), re.IGNORECASE and re.VERBOSE)
-
-    yield from core_log_iterator(IIS_LOG_RE, log_filename)
-
-
-def apache_log_iterator(log_filename):
-    APACHE_LOG_RE = re.compile(r"""
-        ^
-        (?P<c_virtualhost>([^:]+:\d+|))\s
-        (?P<client_ip>[^ ]+)\s
-        (?P<username>[^ ]+?)\s
-        ([^ ]+)\s+
-        \[(?P<day>\d{2})/(?P<month_name>[^/]+)/(?P<year>\d{4})\:(?P<hour>\d{2})\:(?P<minute>\d{2})\:(?P<second>\d{2}) (?P<tz_offset>[^]]+)\]\s
-        "(?P<method>[^ ]+)\s
-        (?P<request_path>[^ ]+)\s
-        (?P<protocol>[^"]+)"\s
-        (?P<status_code>\d{1,3})\s+
-        (?P<response_bytes>\d+)\s*
-        "(?P<referer>.*?)"\s*
-        "(?P<user_agent>.*?)"
-    """.strip(), re.IGNORECASE and re.VERBOSE)
-
-    yield from core_log_iterator(APACHE_LOG_RE, log_filename)
-
-
-def get_log_entries(filenames, flavor):
-    if flavor == 'iis':
-        log_iterator = iis_log_iterator
-    else:
-        log_iterator = apache_log_iterator
+        self.schema = pyarrow.schema(list(zip(fields, types)))
 
-    for filename in filenames:
-        yield from log_iterator
+        if parquet:
+            self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        else:
+            # Each batch only needs to carry the dictionary values added since the last one:
+            options = pyarrow.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+            self.writer = pyarrow.ipc.new_file(filename, self.schema, options=options)
+
+    def write_columns(self, columns):
+        arrays = []
+        for field, column, arrow_type in zip(self.fields, columns, self.schema.types):
+            if field in self.dictionaries:
+                arrays.append(pyarrow.DictionaryArray.from_arrays(
+                    pyarrow.array(column, type=pyarrow.int32()),
+                    pyarrow.array(self.dictionary_values(field), type=pyarrow.string())))
+            else:
+                arrays.append(pyarrow.array(column, type=arrow_type))
+
+        batch = pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+        if isinstance(self.writer, pyarrow.parquet.ParquetWriter):
+            self.writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        super().close()
+        self.writer.close()
+
+
+class NumpyWriter(ColumnarWriter):
+    """
+    Saves the columns with numpy.savez_compressed
+
+    The format can't be appended to so batches are concatenated in memory
+    and written when the writer is closed. Every string column is
+    dictionary-encoded as ``FIELD`` codes and ``FIELD_values`` so the file
+    can be loaded without pickle.
+    """
+
+    def __init__(self, filename, fields, batch_size=DEFAULT_BATCH_SIZE):
+        super().__init__(filename, fields, batch_size=batch_size)
+
+        for field in fields:
+            if field not in ('timestamp', 'status'):
+                self.dictionaries.setdefault(field, {})
+        self.columns = self.new_columns()
+
+        self.batches = {i: [] for i in fields}
+
+    def write_columns(self, columns):
+        for field, column in zip(self.fields, columns):
+            self.batches[field].append(numpy.frombuffer(column, dtype=column.typecode))
+
+    def close(self):
+        super().close()
+
+        arrays = {}
+        for field in self.fields:
+            chunks = self.batches[field]
+            arrays[field] = numpy.concatenate(chunks) if chunks else numpy.array([], dtype='i4')
+            if field in self.dictionaries:
+                arrays['%s_values' % field] = numpy.array(self.dictionary_values(field), dtype=str)
+
+        numpy.savez_compressed(self.filename, **arrays)
 
 
 def configure_logging(verbosity=0):
@@ -156,16 +435,35 @@ def configure_logging(verbosity=0):
         stdout_handler = logging.StreamHandler(stream=sys.stdout)
         stdout_handler.setLevel(desired_level)
         logging.getLogger().addHandler(stdout_handler)
+        logging.getLogger().setLevel(desired_level)
     else:
         logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
 
 
 def main(argv=None):
-    parser = argparse.ArgumentParser(__doc__.strip())
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('--verbosity', '--verbose', '-v', default=0, action='count')
-    parser.add_argument('--log-format', default="apache", choices=("apache", "iis"))
-
-    parser.add_argument('--no-headers', default=False, help='Do not include a header row')
+    parser.add_argument('--log-format', default="auto", choices=("auto", ) + tuple(FORMATS) + tuple(ALIASES),
+                        help='Log format (default: detected from the start of each file)')
+
+    parser.add_argument('--no-headers', default=False, action='store_true', help='Do not include a header row')
+
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes used to parse logs')
+    parser.add_argument('--ordered', default=False, action='store_true',
+                        help='Write entries in log order even when parsing in parallel')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE // (1024 * 1024),
+                        help='Size in megabytes of the ranges uncompressed logs are split into')
+
+    filter_options = parser.add_argument_group('Filters')
+    filter_options.add_argument('--since', type=parse_time,
+                                help='Only include requests at or after this time (ISO 8601, UTC by default)')
+    filter_options.add_argument('--until', type=parse_time,
+                                help='Only include requests before this time')
+    filter_options.add_argument('--path-re', help='Only include requests whose path matches this regular expression')
+    filter_options.add_argument('--no-index', dest='use_index', default=True, action='store_false',
+                                help='Do not create or use a LOG.tsidx timestamp index to find the time range')
 
     # TODO: add less-common fields:
     output_options = parser.add_argument_group('Output Options')
@@ -176,6 +474,25 @@ def main(argv=None):
         '--base-url', type=str,
         help='Create a URL field by joining the specified base URL with the logged path and querystring')
 
+    output_options.add_argument('--output', '-o',
+                                help='Write to this file instead of standard output')
+    output_options.add_argument('--output-format', choices=('tsv', 'arrow', 'parquet', 'npz'),
+                                help='Output format (default: based on the --output extension or tsv)')
+    output_options.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                                help='Number of rows in each columnar record batch')
+
+    aggregate_options = parser.add_argument_group('Aggregation')
+    aggregate_options.add_argument('--aggregate', action='append', choices=tuple(AGGREGATIONS),
+                                   help='Write a summary instead of every entry. May be repeated.'
+                                        ' "paths" produces a URL mix file for http_bench.')
+    aggregate_options.add_argument('--top', type=int, default=100,
+                                   help='Number of paths to include with --aggregate=paths')
+    aggregate_options.add_argument('--aggregate-query-strings', default=False, action='store_true',
+                                   help='Count each distinct query string as a separate path'
+                                        ' with --aggregate=paths')
+    aggregate_options.add_argument('--bucket', type=int, default=60,
+                                   help='Seconds in each --aggregate=time interval')
+
     parser.add_argument('log_files', metavar='LOG_FILE', nargs='+')
     args = parser.parse_args()
 
@@ -184,10 +501,9 @@ def main(argv=None):
 
     configure_logging(args.verbosity)
 
-    if args.log_format == 'iis':
-        log_iterator = iis_log_iterator
-    else:
-        log_iterator = apache_log_iterator
+    for arg in args.log_files:
+        if arg != '-' and not os.path.exists(arg):
+            parser.error("%s doesn't exist" % arg)
 
     expected_fields = [i for i in LogEntry._fields if getattr(args, i)]
 
@@ -199,18 +515,79 @@ def main(argv=None):
     else:
         base_url = None
 
-    if not args.no_headers:
-        print(*expected_fields, sep='\t')
+    log_filter = LogFilter(since=args.since, until=args.until, path_re=args.path_re)
+
+    # Summaries are always text so none of the output columns or formats apply:
+    if args.aggregate:
+        summary = LogSummary(top=args.top, bucket_size=args.bucket,
+                             include_query_string=args.aggregate_query_strings)
+
+        for batch in get_log_batches(args.log_files, args.log_format, jobs=args.jobs, ordered=False,
+                                     chunk_size=args.chunk_size * 1024 * 1024,
+                                     log_filter=log_filter, use_index=args.use_index):
+            summary.add_rows(batch)
+
+        stream = open(args.output, 'w') if args.output else sys.stdout
+        try:
+            for i, aggregation in enumerate(args.aggregate):
+                if i:
+                    stream.write('\n')
+                getattr(summary, AGGREGATIONS[aggregation])(stream)
+        finally:
+            if stream is sys.stdout:
+                stream.flush()
+            else:
+                stream.close()
+        return
 
-    for arg in args.log_files:
-        if not os.path.exists(arg):
-            parser.error("%s doesn't exist" % arg)
-        else:
-            for log_entry in log_iterator(arg):
-                fields = [getattr(log_entry, i) for i in expected_fields if i != 'URL']
+    output_format = args.output_format
+    if not output_format:
+        extension = os.path.splitext(args.output or '')[1].lower()
+        output_format = OUTPUT_EXTENSIONS.get(extension, 'tsv')
+
+    if output_format != 'tsv':
+        if not args.output:
+            parser.error("--output is required for %s output" % output_format)
+
+        if not expected_fields:
+            expected_fields = list(LogEntry._fields)
+
+        if output_format in ('arrow', 'parquet') and pyarrow is None:
+            args.output = '%s.npz' % os.path.splitext(args.output)[0]
+            logging.warning("pyarrow is not installed: saving %s output as %s", output_format, args.output)
+            output_format = 'npz'
+
+        if output_format == 'npz' and numpy is None:
+            parser.error("%s output requires pyarrow or numpy" % (args.output_format or output_format))
+
+    if output_format == 'tsv':
+        stream = open(args.output, 'w') if args.output else sys.stdout
+        writer = TSVWriter(stream, expected_fields, headers=not args.no_headers)
+    elif output_format == 'npz':
+        writer = NumpyWriter(args.output, expected_fields, batch_size=args.batch_size)
+    else:
+        writer = ArrowWriter(args.output, expected_fields, batch_size=args.batch_size,
+                             parquet=output_format == 'parquet')
+
+    field_indexes = [LogEntry._fields.index(i) for i in expected_fields if i != 'URL']
+    path_index = LogEntry._fields.index('path')
+    qs_index = LogEntry._fields.index('query_string')
+
+    batches = get_log_batches(args.log_files, args.log_format, jobs=args.jobs, ordered=args.ordered,
+                              chunk_size=args.chunk_size * 1024 * 1024,
+                              log_filter=log_filter, use_index=args.use_index)
+
+    try:
+        for batch in batches:
+            rows = []
+            for row in batch:
+                fields = [row[i] for i in field_indexes]
                 if base_url:
-                    fields.append(urljoin(base_url, '%s?%s' % (log_entry.path, log_entry.query_string)))
-                print(*fields, sep='\t')
+                    fields.append(urljoin(base_url, '%s?%s' % (row[path_index], row[qs_index])))
+                rows.append(fields)
+            writer.write_rows(rows)
+    finally:
+        writer.close()
 
 
 if __name__ == "__main__":
@@ -8,48 +8,34 @@ Usage:
 
     %prog http://example.com
 
+The site is crawled once by webtoolbox.spider.Spider and each response is
+analyzed by RED without requesting it again. With --cache the RED results are saved and reused on the next
+run for any URL whose validators and caching headers haven't changed, which
+avoids all of RED's extra requests for that URL.
 """
 
 
-from red import ResourceExpertDroid
-from link_parse import HTMLLinkParser
-
 import os
 import sys
 import optparse
 import logging
 import re
-from urlparse import urlparse
 from collections import defaultdict
 from cgi import escape
 
-try:
-    import tidylib
-except ImportError:
-    pass
-
+from gevent import monkey
+monkey.patch_all()
 
-class HTMLAccumulator(object):
-    content = u""
-    http_enc = "latin-1"
-
-    def feed(self, response, fragment):
-        """Used as a body processor to collect the entire document for HTML validation"""
-        http_enc = response.parsed_hdrs['content-type'][1].get('charset', self.http_enc)
-        try:
-            if not isinstance(fragment, unicode):
-                fragment = unicode(fragment, http_enc, 'strict')
-            self.content += fragment
-        except UnicodeError, e:
-            logging.warning("Couldn't decode fragment: %s" % e)
+from webtoolbox.client import add_client_options, client_options
+from webtoolbox.spider import Spider
+from webtoolbox.red_analysis import REDProcessor, ResultCache
 
-    def __str__(self):
-        return self.content
+# Used to process the string report returned by tidylib:
+TIDY_RE = re.compile("line (?P<line>\d+) column (?P<column>\d+) - (?P<level>\w+): (?P<message>.*)$", re.MULTILINE)
 
 
 class SpiderReport(object):
     """Represents information which applies to one or more URIs"""
-    messages  = defaultdict(dict)
     pages     = None
     resources = None
 
@@ -69,6 +55,7 @@ class SpiderReport(object):
         self.severity = severity
         self.title    = title
         self.details  = details
+        self.messages = defaultdict(dict)
 
     def add(self, uri=None, category=None, severity=None, title=None, details=None):
         if not severity in self.SEVERITY_LEVELS:
@@ -153,7 +140,7 @@ class SpiderReport(object):
                 summaries = categories[category]
                 print >> output, "\t%s:" % category
 
-                for summary, data in summaries.items():
+                for summary, data in sorted(summaries.items()):
                     print >> output, "\t\t%s: %d pages" % (summary, len(data['uris']))
                     print >> output, "\t\t\t%s" % "\n\t\t\t".join(sorted(data['uris']))
                     print >> output
@@ -161,120 +148,72 @@ class SpiderReport(object):
             print >> output
 
 
-class REDSpider(object):
-    pages        = set()
-    resources    = set()
-    tidy_re      = re.compile("line (?P<line>\d+) column (?P<column>\d+) - (?P<level>\w+): (?P<message>.*)$", re.MULTILINE)
-    skip_link_re = re.compile("^$") # URLs which match won't be spidered
-
-    def __init__(self, uris, language="en", validate_html=False, skip_media=False, skip_resources=False):
-        self.allowed_hosts  = [urlparse(u)[1] for u in uris]
-        self.language       = language
-        self.skip_media     = skip_media
-        self.skip_resources = skip_resources
-        self.uris           = uris
-        self.validate_html  = validate_html
-
-        self.report = SpiderReport()
-
-    def run(self):
-        for uri in self.uris:
-            self.pages.add(uri)
+class REDSpider(Spider):
+    """
+    Crawls a site with :class:`webtoolbox.spider.Spider` and reports RED's
+    analysis of every page and resource
 
-            link_parser = HTMLLinkParser(uri, self.process_link)
-            body_procs = [ link_parser.feed ]
+    Each URL is fetched once by the spider for link walking and HTML
+    validation. RED runs in up to ``concurrency`` worker processes using
+    :class:`webtoolbox.red_analysis.REDProcessor`.
+    """
 
-            if self.validate_html:
-                html_body = HTMLAccumulator()
-                body_procs.append(html_body.feed)
+    def __init__(self, language="en", validate_html=False, concurrency=1, per_host=2, cache=None,
+                 log_name="red_spider", **kwargs):
+        super(REDSpider, self).__init__(log_name=log_name, **kwargs)
 
-            logging.debug("Processing page: %s", uri)
+        self.pages     = set()
+        self.resources = set()
+        self.failed    = set()
 
-            red = ResourceExpertDroid(uri, status_cb=logging.debug, body_procs=body_procs)
-
-            for m in red.messages:
-                self.report_red_message(m, uri)
-
-            # Avoid HTML validation for pages which didn't load correctly. RED normally
-            # reports an error in this case so we'll leave the general server
-            # failure message in the report but avoid further reporting
-
-            if red.res_status in ("301", "302"):
-                self.process_link(red.parsed_hdrs['location'], '<HTTP Redirect>', '')
-                continue
-            elif red.res_status == "200":
-                # We only validate pages which loaded successfully:
-                if red.res_complete and self.validate_html and red.parsed_hdrs['content-type'][0] == 'text/html':
-                    self.report_tidy_messages(uri, html_body.content)
-
-            errs = not red.res_complete or any([ m for m in red.messages if m.level in ['error', 'bad']])
+        self.report = SpiderReport()
 
-            if errs:
-                logging.warn("Found problems in: %s", uri)
-            else:
-                logging.info("Processed page: %s", uri)
+        self.red = REDProcessor(self.report, language=language, cache=cache,
+                                concurrency=concurrency, per_host=per_host)
 
+        self.response_processors.append(self.record_url)
+        self.response_processors.append(self.red)
 
-        assert len(self.uris) <= len(self.pages)
+        if validate_html:
+            self.html_processors.append(self.validate_html)
 
-        for uri in self.resources:
-            red = ResourceExpertDroid(uri, status_cb=logging.info)
+    def run(self, urls):
+        super(REDSpider, self).run(urls)
 
-            for m in red.messages:
-                self.report_red_message(m, uri)
+        self.red.join()
 
         # Convenience copies for reporting:
         self.report.pages = self.pages
         self.report.resources = self.resources
 
-    def report_tidy_messages(self, uri, html):
-        (cleaned_html, warnings) = tidylib.tidy_document(html)
+    def process_response(self, response):
+        super(REDSpider, self).process_response(response)
 
-        for warn_match in self.tidy_re.finditer(warnings):
-            sev = "error" if warn_match.group("level").lower() == "error" else "warning"
-            self.report.add(severity=sev, category="HTML", title=warn_match.group("message"), uri=uri)
-
-    def report_red_message(self, msg, uri):
-        """Unpacks a message as returned in ResourceExpertDroid.messages"""
-
-        title   = self.get_loc(msg.summary) % msg.vars
-        details = self.get_loc(msg.text) % msg.vars
-
-        if title.startswith("The resource last changed"):
+        if response.ok or response.url in self.failed:
             return
 
-        self.report.add(uri=uri, category=msg.category, severity=msg.level, title=title, details=details)
-
-    def get_loc(self, red_dict):
-        """Return the preferred language version of a message returned by RED"""
-        return red_dict.get(self.language, red_dict['en'])
+        self.failed.add(response.url)
 
-    def process_link(self, link, tag, title):
-        link_parts = urlparse(link)
-
-        if link_parts.netloc and not link_parts.netloc in self.allowed_hosts:
-            logging.debug("Skipping external resource: %s", link)
-            return
+        if response.error is not None:
+            self.report.add(response.url, "General", "error", "Unable to retrieve resource", str(response.error))
+        else:
+            self.report.add(response.url, "General", "error",
+                            "The server returned HTTP %s" % response.status_code, None)
 
-        if self.skip_link_re.match(link):
-            logging.debug("Link matched skip_link_re - skipping %s", link)
-            return
+    def record_url(self, request, response):
+        if response.headers.get("Content-Type", "").startswith("text/html"):
+            self.pages.add(response.url)
+        else:
+            self.resources.add(response.url)
 
-        if not link_parts.scheme.startswith("http"):
-            logging.debug("Skipping non-HTTP link: %s", link)
-            return
+    def validate_html(self, url, html):
+        import tidylib
 
-        # <HTTP Redirect> is used when we encounter 301/302 redirects:
-        if tag in ['a', 'frame', 'iframe', '<HTTP Redirect>']:
-            if not link in self.pages:
-                self.uris.append(link)
-                self.pages.add(link)
-        else:
-            if tag in ['script', 'link'] and self.skip_resources:
-                return
+        (cleaned_html, warnings) = tidylib.tidy_document(html, {"char-encoding": "utf8"})
 
-            if not self.skip_media:
-                self.resources.add(link)
+        for warn_match in TIDY_RE.finditer(warnings):
+            sev = "error" if warn_match.group("level").lower() == "error" else "warning"
+            self.report.add(severity=sev, category="HTML", title=warn_match.group("message"), uri=url)
 
 
 def save_uri_list(fn, data):
@@ -321,6 +260,8 @@ def configure_logging(options):
 def main():
     parser = optparse.OptionParser(__doc__.strip())
 
+    parser.add_option("--max-connections", type="int", default=2, help="Set the number of simultaneous connections used by the spider (default=%default)")
+    parser.add_option("--timeout", type="int", default=15, help="Set the number of seconds to wait for a request to load (default=%default)")
     parser.add_option("--format", dest="report_format", default="text", help='Generate the report as HTML or text')
     parser.add_option("-o", "--report", "--output", dest="report_file", default=sys.stdout, help='Save report to a file instead of stdout')
     parser.add_option("--validate-html", action="store_true", default=False, help="Validate HTML using tidylib")
@@ -329,9 +270,13 @@ def main():
     parser.add_option("--skip-link-re", type="string", help="Skip links whose URL matches the specified regular expression")
     parser.add_option("--save-page-list", dest="page_list", help='Save a list of URLs for HTML pages in the specified file')
     parser.add_option("--save-resource-list", dest="resource_list", help='Save a list of URLs for pages resources in the specified file')
+    parser.add_option("--concurrency", type="int", default=1, help="Run RED on this many URLs at once in worker processes (default=%default)")
+    parser.add_option("--per-host", type="int", default=2, help="Run RED on no more than this many URLs from a single host at once (default=%default)")
+    parser.add_option("--cache", dest="cache_file", help="Save results in this file and reuse them for URLs which haven't changed")
     parser.add_option("--language", default="en", help="Report using a different language than '%default'")
     parser.add_option("-l", "--log", dest="log_file", help='Specify a location other than stderr', default=None)
     parser.add_option("-v", "--verbosity", action="count", default=0, help="Log level")
+    add_client_options(parser)
 
     (options, uris) = parser.parse_args()
 
@@ -343,16 +288,25 @@ def main():
     if not isinstance(options.report_file, file):
         options.report_file = file(options.report_file, "w")
 
-    if options.validate_html and not "tidylib" in sys.modules:
-        logging.warning("Couldn't import tidylib - HTML validation is disabled. Try installing from PyPI or http://countergram.com/software/pytidylib")
-        options.validate_html = False
-
+    if options.validate_html:
+        try:
+            import tidylib
+        except ImportError:
+            logging.warning("Couldn't import tidylib - HTML validation is disabled. Try installing from PyPI or http://countergram.com/software/pytidylib")
+            options.validate_html = False
 
-    rs = REDSpider(uris,
+    rs = REDSpider(
+        language=options.language,
         validate_html=options.validate_html,
-        skip_media=options.skip_media,
-        skip_resources=options.skip_resources,
+        concurrency=options.concurrency,
+        per_host=options.per_host,
+        cache=ResultCache(options.cache_file) if options.cache_file else None,
+        max_simultaneous_connections=options.max_connections,
+        default_request_timeout=options.timeout,
+        client_options=client_options(options),
     )
+    rs.skip_media = options.skip_media
+    rs.skip_resources = options.skip_resources
 
     if options.skip_link_re:
         i = options.skip_link_re
@@ -363,7 +317,7 @@ def main():
 
         rs.skip_link_re = re.compile(i, re.IGNORECASE)
 
-    rs.run()
+    rs.run(uris)
 
     rs.report.save(format=options.report_format, output=options.report_file)
 
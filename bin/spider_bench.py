@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Measure how quickly the spider crawls a synthetic site and how much memory it uses
+
+Usage:
+
+    %prog --pages=1000,10000,100000 --output=results.json
+
+The site is generated by webtoolbox.testserver.SyntheticSiteServer in this
+process. Reported for each run: pages and URLs per second, CPU time per page,
+peak RSS, memory per URL tracked and the time spent in each processing stage.
+
+Each site size and --repeat runs in a fresh process so peak memory use isn't
+inherited from an earlier run. Results are saved as JSON; --compare prints
+the change from an earlier results file.
+"""
+
+from __future__ import division
+
+__version__ = "0.1"
+
+import json
+import logging
+import optparse
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from gevent import monkey
+monkey.patch_all()
+
+from webtoolbox.audit import CachingAudit
+from webtoolbox.client import add_client_options, client_options
+from webtoolbox.pageweight import PageWeightAnalysis
+from webtoolbox.spider import Spider
+from webtoolbox.testserver import SyntheticSite, SyntheticSiteServer
+from webtoolbox.urls import TrapDetector
+
+PROCESSORS = ("caching", "pageweight")
+
+#: Spider.stage_times keys in the order they happen:
+STAGES = ("response_processors", "header_processors", "fingerprint", "charset", "html_processors", "parse",
+          "links", "tree_processors")
+
+#: Results compared by --compare and whether a larger value is better:
+COMPARED = (("pages_per_second", True), ("cpu_per_page_ms", False), ("peak_rss_bytes", False),
+            ("bytes_per_url", False))
+
+
+class NullReport(object):
+    """Accepts the messages from the caching audit without storing them"""
+
+    def __init__(self):
+        self.messages = 0
+
+    def add(self, url=None, category=None, severity=None, title=None, details=None):
+        self.messages += 1
+
+
+class PageCounter(object):
+    """Header processor counting HTML responses"""
+
+    def __init__(self):
+        self.pages = 0
+
+    def __call__(self, url, headers):
+        if headers.get("Content-Type", "").startswith("text/html"):
+            self.pages += 1
+
+
+def peak_rss():
+    """Return the most memory this process has used, in bytes"""
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Mac OS X reports bytes and Linux kilobytes:
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def get_config(options, pages):
+    return {
+        "pages": pages,
+        "fanout": options.fanout,
+        "page_size": options.page_size,
+        "charsets": options.charsets,
+        "media_ratio": options.media_ratio,
+        "processors": options.processors,
+        "max_connections": options.max_connections,
+        "seed": options.seed,
+    }
+
+
+def run_benchmark(options, pages):
+    """Crawl a synthetic site and return the measurements"""
+
+    config = get_config(options, pages)
+
+    site = SyntheticSite(pages=pages, fanout=options.fanout, page_size=options.page_size,
+                         charsets=options.charsets.split(","), media_ratio=options.media_ratio,
+                         seed=options.seed)
+
+    # Every page matches /page/N.html so the trap detector's limit on URLs
+    # per pattern would stop a large site from being crawled:
+    spider = Spider(log_name="spider_bench", max_simultaneous_connections=options.max_connections,
+                    client_options=client_options(options), trap_detector=TrapDetector(max_urls_per_pattern=None))
+
+    counter = PageCounter()
+    spider.header_processors.append(counter)
+
+    processors = [i for i in options.processors.split(",") if i]
+
+    if "caching" in processors:
+        spider.response_processors.append(CachingAudit(NullReport()))
+
+    if "pageweight" in processors:
+        page_weight = PageWeightAnalysis(canonicalizer=spider.canonicalizer)
+        spider.response_processors.append(page_weight.process_response)
+        spider.tree_processors.append(page_weight.process_tree)
+
+    with SyntheticSiteServer(site) as server:
+        rss_before = peak_rss()
+        cpu_before = cpu_time()
+        start = time.time()
+
+        spider.run([server.url])
+
+        elapsed = time.time() - start
+        cpu = cpu_time() - cpu_before
+        rss_after = peak_rss()
+        server_time = server.busy_time
+
+    processed = spider.processed or 1
+    urls = len(spider.url_history)
+
+    results = {
+        "config": config,
+        "responses": spider.processed,
+        "pages_crawled": counter.pages,
+        "errors": spider.errors,
+        "urls": urls,
+        "elapsed": elapsed,
+        "pages_per_second": counter.pages / elapsed,
+        "responses_per_second": spider.processed / elapsed,
+        # The in-process server's share is included in cpu_seconds:
+        "cpu_seconds": cpu,
+        "server_seconds": server_time,
+        "cpu_per_page_ms": 1000 * cpu / processed,
+        "peak_rss_bytes": rss_after,
+        "bytes_per_url": (rss_after - rss_before) / urls if urls else None,
+        "stages": dict((stage, {"seconds": spider.stage_times[stage],
+                                "per_page_ms": 1000 * spider.stage_times[stage] / processed})
+                       for stage in STAGES),
+    }
+
+    if spider.errors:
+        logging.warning("%d of %d requests failed", spider.errors, spider.processed)
+
+    return results
+
+
+def run_child(options, pages):
+    """Run a benchmark in a new process and return its results"""
+
+    command = [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:] + ["--pages=%d" % pages, "--child"]
+
+    output = subprocess.check_output(command)
+
+    return json.loads(output)
+
+
+def log_results(results):
+    logging.info("%d pages (%d responses, %d URLs) in %0.1f seconds: %0.1f pages/second, %0.2f ms CPU/response,"
+                 " peak RSS %0.1f MB, %s bytes/URL",
+                 results["pages_crawled"], results["responses"], results["urls"], results["elapsed"],
+                 results["pages_per_second"], results["cpu_per_page_ms"], results["peak_rss_bytes"] / 1048576,
+                 "%0.0f" % results["bytes_per_url"] if results["bytes_per_url"] is not None else "?")
+
+    logging.info("    stages (ms/response): %s",
+                 ", ".join("%s=%0.3f" % (stage, results["stages"][stage]["per_page_ms"]) for stage in STAGES))
+
+
+def summarize(runs):
+    """Return config key → median of each compared result"""
+
+    by_config = {}
+
+    for run in runs:
+        by_config.setdefault(json.dumps(run["config"], sort_keys=True), []).append(run)
+
+    return dict((key, dict((name, median([run[name] for run in config_runs if run[name] is not None] or [0]))
+                           for name, higher_is_better in COMPARED))
+                for key, config_runs in by_config.items())
+
+
+def compare(baseline, current):
+    """Log the change in each compared result for the configurations in both sets of runs"""
+
+    old = summarize(baseline["runs"])
+    new = summarize(current["runs"])
+
+    common = [key for key in sorted(new) if key in old]
+    if not common:
+        logging.warning("The baseline has no runs with the same configuration")
+
+    for key in common:
+        logging.info("Compared to the baseline for %s:", key)
+
+        for name, higher_is_better in COMPARED:
+            before, after = old[key][name], new[key][name]
+            change = (after - before) / before * 100 if before else 0
+
+            if abs(change) < 1:
+                verdict = "unchanged"
+            elif (change > 0) == higher_is_better:
+                verdict = "better"
+            else:
+                verdict = "worse"
+
+            logging.info("    %s: %0.3f -> %0.3f (%+0.1f%%, %s)", name, before, after, change, verdict)
+
+
+def main():
+    parser = optparse.OptionParser(__doc__.strip(), version="spider_bench %s" % __version__)
+    parser.add_option("--pages", default="1000", help="Comma-separated site sizes to crawl (default=%default)")
+    parser.add_option("--fanout", type="int", default=10, help="Links from each page to other pages (default=%default)")
+    parser.add_option("--page-size", type="int", default=8192, help="Approximate bytes of HTML per page (default=%default)")
+    parser.add_option("--charsets", default="utf-8,iso-8859-1,none", help="Charsets used by successive pages; none sends UTF-8 without declaring it (default=%default)")
+    parser.add_option("--media-ratio", type="float", default=0.5, help="Images per page and distinct images per page on the site (default=%default)")
+    parser.add_option("--processors", default=",".join(PROCESSORS), help="Comma-separated processors to run: %s (default=%%default)" % ", ".join(PROCESSORS))
+    parser.add_option("--max-connections", type="int", default=6, help="Simultaneous requests (default=%default)")
+    parser.add_option("--seed", type="int", default=0, help="Generate a different site with the same settings")
+    parser.add_option("--repeat", type="int", default=1, help="Crawl each site this many times (default=%default)")
+    parser.add_option("-o", "--output", help="Save the results as JSON in this file instead of printing them")
+    parser.add_option("--compare", metavar="FILE", help="Report the change from the results saved in FILE")
+    parser.add_option("-v", "--verbose", action="store_true", default=False, help="Log every request")
+    # Used to run each benchmark in a new process:
+    parser.add_option("--child", action="store_true", default=False, help=optparse.SUPPRESS_HELP)
+    add_client_options(parser)
+
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s [%(levelname)s]: %(message)s", level=logging.INFO)
+    # The spider logs every response at INFO:
+    logging.getLogger("spider_bench").setLevel(logging.INFO if options.verbose else logging.WARNING)
+
+    try:
+        sizes = [int(i) for i in options.pages.split(",")]
+    except ValueError:
+        parser.error("--pages must be a comma-separated list of numbers")
+
+    unknown = [i for i in options.processors.split(",") if i and i not in PROCESSORS]
+    if unknown:
+        parser.error("Unknown processors: %s" % ", ".join(unknown))
+
+    if options.child:
+        json.dump(run_benchmark(options, sizes[-1]), sys.stdout)
+        return
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+
+    runs = []
+
+    for pages in sizes:
+        for i in range(options.repeat):
+            logging.info("Crawling a %d page site (run %d of %d)", pages, i + 1, options.repeat)
+
+            if len(sizes) == 1 and options.repeat == 1:
+                results = run_benchmark(options, pages)
+            else:
+                results = run_child(options, pages)
+
+            log_results(results)
+
+            # Comparing sizes is meaningless unless the whole site was crawled:
+            if results["pages_crawled"] < pages:
+                logging.error("Only %d of the %d pages were crawled", results["pages_crawled"], pages)
+                sys.exit(1)
+
+            runs.append(results)
+
+    results = {
+        "benchmark": "spider_bench",
+        "version": __version__,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "runs": runs,
+    }
+
+    if baseline is not None:
+        compare(baseline, results)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+
+
+if __name__ == '__main__':
+    main()
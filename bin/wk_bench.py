@@ -3,11 +3,16 @@
 # http://gist.github.com/128284
 
 """
-A WebKit-based site performance test
+A site performance test which measures how long pages take to load completely
 
 Usage:
 
     %prog [options] [http://example.net/ ...]
+
+Each page is loaded with all of its stylesheets, scripts, images, frames and
+the resources referenced from CSS, using up to --pool-size connections to each
+host like a browser. --webkit uses a real WebKit browser on Mac OS X instead,
+which also runs JavaScript.
 """
 
 # Inspired by Paul Hammond's http://www.paulhammond.org/webkit2png
@@ -41,6 +46,12 @@ import logging
 import random
 import time
 
+from gevent import monkey
+monkey.patch_all()
+
+from webtoolbox.client import add_client_options, client_options
+from webtoolbox.pageload import PageLoader
+
 try:
     from ExceptionHandling import NSExceptionHandler, NSLogAndHandleEveryExceptionMask
     from Foundation import NSObject, NSURL, NSURLRequest, NSMakeRect, NSURLErrorCancelled
@@ -48,159 +59,169 @@ try:
     import AppKit
     import WebKit
 except ImportError, e:
-    logging.error("FATAL ERROR: Cannot import PyObjC: %s" % e)
-    sys.exit(1)
+    # PyObjC is only needed for --webkit:
+    WebKit = None
+    PYOBJC_IMPORT_ERROR = e
 
 TEST_URL = 'http://www.youtube.com/'
 
 
-class exc_handler(NSObject):
-    """
-    This exists so we can catch exceptions raised in e.g. WebKit delegates
-    which would otherwise halt processing but not exit the runloop.
-    """
-    def exceptionHandler_shouldLogException_mask_(self, sender, exception, mask):
-        return False
+def print_summary(times):
+    if not times:
+        logging.critical("No pages loaded at all?")
+    else:
+        total_time = sum(times)
+        print "Loaded %d pages in %0.2f seconds (avg=%0.2f)" % (
+            len(times),
+            total_time,
+            total_time / len(times)
+        )
 
-    def exceptionHandler_shouldHandleException_mask_(self, sender, exc, mask):
-        logging.error(u"Exiting due to exception: %s", exc.reason())
-        AppKit.NSApplication.sharedApplication().terminate_(None)
-        return True
 
+def headless_benchmark(options, urls):
+    loader = PageLoader(timeout=options.timeout, **client_options(options))
 
-class AppDelegate (NSObject):
-    def applicationDidFinishLaunching_(self, aNotification):
-        """
-        This is fired immediately after the application starts up. We'll ask
-        the delegate to start processing URLs
-        """
+    times = []
+    current_idx = 0
 
-        webview = aNotification.object().windows()[0].contentView()
-        delegate = webview.frameLoadDelegate()
-        delegate.target_webview = webview
-        delegate.getNextURL()
+    try:
+        for i in range(options.max_requests):
+            url = urls[current_idx]
 
+            logging.debug("Loading %s" % url)
 
-class WebkitLoad (NSObject, WebKit.protocols.WebFrameLoadDelegate):
-    current_url = None
-    current_idx = 0
-    request_count = 0
-    target_webview = None
-    start_time = 0.0
-    times = []
+            page = loader.load(url)
 
-    def webView_didFailLoadWithError_forFrame_(self, webview, error, frame):
-        try:
-            name = frame.dataSource().request().URL()
-        except:
-            name = frame.name()
-
-        if frame == webview.mainFrame():
-            logging.error(u"Unable to load page %s: %s",
-                          name, error.localizedDescription())
-            self.getNextURL()
-        else:
-            if error.code() == NSURLErrorCancelled:
-                logging.warning(u"Asynchronous load of %s was cancelled", name)
+            if page.ok:
+                times.append(page.elapsed)
+                logging.info("Loaded %s in %0.1f seconds (%d resources, %d bytes, %d errors)",
+                             url, page.elapsed, len(page.resources), page.size, len(page.errors))
             else:
-                logging.warning(u"Unable to load sub-frame %s: %s",
-                                name, error.localizedDescription())
+                logging.error("Unable to load page %s: %s", url, page.document.error)
 
-    webView_didFailProvisionalLoadWithError_forFrame_ = webView_didFailLoadWithError_forFrame_
-
-    def getNextURL(self):
-        self.current_url = self.urls[self.current_idx]
+            if options.random:
+                current_idx = random.randint(0, len(urls) - 1)
+            else:
+                current_idx = (current_idx + 1) % len(urls)
+    finally:
+        loader.close()
 
-        logging.debug("Loading %s" % self.current_url)
+    print_summary(times)
 
-        self.start_time = time.time()
 
-        self.target_webview.mainFrame().loadRequest_(
-            NSURLRequest.requestWithURL_(
-                NSURL.URLWithString_(self.current_url)
-            )
-        )
+if WebKit is not None:
+    class exc_handler(NSObject):
+        """
+        This exists so we can catch exceptions raised in e.g. WebKit delegates
+        which would otherwise halt processing but not exit the runloop.
+        """
+        def exceptionHandler_shouldLogException_mask_(self, sender, exception, mask):
+            return False
 
-        if self.request_count >= self.options.max_requests:
-            if not self.times:
-                logging.critical("No pages loaded at all?")
-            else:
-                total_time = sum(self.times)
-                print "Loaded %d pages in %0.2f seconds (avg=%0.2f)" % (
-                    self.request_count,
-                    total_time,
-                    total_time / len(self.times)
-                )
+        def exceptionHandler_shouldHandleException_mask_(self, sender, exc, mask):
+            logging.error(u"Exiting due to exception: %s", exc.reason())
             AppKit.NSApplication.sharedApplication().terminate_(None)
+            return True
+
+
+    class AppDelegate (NSObject):
+        def applicationDidFinishLaunching_(self, aNotification):
+            """
+            This is fired immediately after the application starts up. We'll ask
+            the delegate to start processing URLs
+            """
+
+            webview = aNotification.object().windows()[0].contentView()
+            delegate = webview.frameLoadDelegate()
+            delegate.target_webview = webview
+            delegate.getNextURL()
+
+
+    class WebkitLoad (NSObject, WebKit.protocols.WebFrameLoadDelegate):
+        current_url = None
+        current_idx = 0
+        request_count = 0
+        target_webview = None
+        start_time = 0.0
+        times = []
+
+        def webView_didFailLoadWithError_forFrame_(self, webview, error, frame):
+            try:
+                name = frame.dataSource().request().URL()
+            except:
+                name = frame.name()
+
+            if frame == webview.mainFrame():
+                logging.error(u"Unable to load page %s: %s",
+                              name, error.localizedDescription())
+                self.getNextURL()
+            else:
+                if error.code() == NSURLErrorCancelled:
+                    logging.warning(u"Asynchronous load of %s was cancelled", name)
+                else:
+                    logging.warning(u"Unable to load sub-frame %s: %s",
+                                    name, error.localizedDescription())
 
-        self.request_count += 1
+        webView_didFailProvisionalLoadWithError_forFrame_ = webView_didFailLoadWithError_forFrame_
 
-        if self.urls[0] == TEST_URL:
-            self.urls.pop(0)
-            self.request_count -= 1
+        def getNextURL(self):
+            self.current_url = self.urls[self.current_idx]
 
-        if self.options.random:
-            i = random.randint(0, len(self.urls) - 1)
-        else:
-            i = (self.current_idx + 1) % len(self.urls)
+            logging.debug("Loading %s" % self.current_url)
 
-        self.current_idx = i
+            self.start_time = time.time()
 
-    def webView_didStartProvisionalLoadForFrame_(self, sender, frame):
-        logging.debug("Loading started for %s" % self.current_url)
-        self.start_time = time.time()
+            self.target_webview.mainFrame().loadRequest_(
+                NSURLRequest.requestWithURL_(
+                    NSURL.URLWithString_(self.current_url)
+                )
+            )
 
-    def webView_didFinishLoadForFrame_(self, webview, frame):
-        # Ignore anything but the top-level frame:
-        if frame == webview.mainFrame():
-            elapsed = time.time() - self.start_time
-            if self.current_url != TEST_URL:
-                self.times.append(elapsed)
-            logging.info("Loaded %s in %0.1f seconds" % (self.current_url, elapsed))
-            self.getNextURL()
-        else:
-            logging.debug("Sub-frame loaded")
+            if self.request_count >= self.options.max_requests:
+                print_summary(self.times)
+                AppKit.NSApplication.sharedApplication().terminate_(None)
 
+            self.request_count += 1
 
-class UIDelegate(NSObject, WebKit.protocols.WebUIDelegate):
-    def webView_runJavaScriptAlertPanelWithMessage_initiatedByFrame_(self, webview, message, frame):
-        logging.error("JavaScript alert: %s" % message)
+            if self.urls[0] == TEST_URL:
+                self.urls.pop(0)
+                self.request_count -= 1
 
-    def webView_addMessageToConsole_(self, webview, error_dict):
-        try:
-            logging.error("JavaScript error at %(sourceURL)s line %(lineNumber)d: %(message)s" % error_dict)
-        except KeyError:
-            logging.error("JavaScript error (unknown format): %s" % error_dict)
+            if self.options.random:
+                i = random.randint(0, len(self.urls) - 1)
+            else:
+                i = (self.current_idx + 1) % len(self.urls)
+
+            self.current_idx = i
+
+        def webView_didStartProvisionalLoadForFrame_(self, sender, frame):
+            logging.debug("Loading started for %s" % self.current_url)
+            self.start_time = time.time()
+
+        def webView_didFinishLoadForFrame_(self, webview, frame):
+            # Ignore anything but the top-level frame:
+            if frame == webview.mainFrame():
+                elapsed = time.time() - self.start_time
+                if self.current_url != TEST_URL:
+                    self.times.append(elapsed)
+                logging.info("Loaded %s in %0.1f seconds" % (self.current_url, elapsed))
+                self.getNextURL()
+            else:
+                logging.debug("Sub-frame loaded")
 
 
-def main():
-    cmdparser = optparse.OptionParser(__doc__.strip(), version="wk_bench %s" % __version__)
-    cmdparser.add_option("--debug", action="store_true", help="Display more progress information")
-    cmdparser.add_option("-u", "--url_list",
-                         help="Specify a list of URLs in a file rather than on the command-line")
-    cmdparser.add_option("--max-requests", type="int", default=0,
-                         help="How many requests to make")
-    cmdparser.add_option("--random", action="store_true", default=False,
-                         help="Pick URL randomly rather than in-order")
-    (options, url_list) = cmdparser.parse_args()
+    class UIDelegate(NSObject, WebKit.protocols.WebUIDelegate):
+        def webView_runJavaScriptAlertPanelWithMessage_initiatedByFrame_(self, webview, message, frame):
+            logging.error("JavaScript alert: %s" % message)
 
-    if options.url_list:
-        url_list = map(str.strip, open(options.url_list).readlines())
+        def webView_addMessageToConsole_(self, webview, error_dict):
+            try:
+                logging.error("JavaScript error at %(sourceURL)s line %(lineNumber)d: %(message)s" % error_dict)
+            except KeyError:
+                logging.error("JavaScript error (unknown format): %s" % error_dict)
 
-    if not url_list:
-        cmdparser.print_usage()
-        sys.exit(1)
-
-    logging.basicConfig(format="%(asctime)s [%(levelname)s]: %(message)s",
-                        level=logging.DEBUG if options.debug else logging.INFO)
-
-    if not options.max_requests:
-        options.max_requests = len(url_list)
-
-    if options.max_requests < len(url_list):
-        logging.warn("request limit %d is smaller than the provided %d URLs",
-                     options.max_requests, len(url_list))
 
+def webkit_benchmark(options, url_list):
     # Insert a URL which will be used to get all of the actual WebKit
     # initialization out of the way before we load the test sites
     url_list.insert(0, TEST_URL)
@@ -248,5 +269,47 @@ def main():
 
     AppHelper.runEventLoop(installInterrupt=True)
 
+
+def main():
+    cmdparser = optparse.OptionParser(__doc__.strip(), version="wk_bench %s" % __version__)
+    cmdparser.add_option("--debug", action="store_true", help="Display more progress information")
+    cmdparser.add_option("-u", "--url_list",
+                         help="Specify a list of URLs in a file rather than on the command-line")
+    cmdparser.add_option("--max-requests", type="int", default=0,
+                         help="How many requests to make")
+    cmdparser.add_option("--random", action="store_true", default=False,
+                         help="Pick URL randomly rather than in-order")
+    cmdparser.add_option("--timeout", type="float", default=30,
+                         help="Seconds to wait for each resource (default=%default)")
+    cmdparser.add_option("--webkit", action="store_true", default=False,
+                         help="Load pages in WebKit using PyObjC (Mac OS X only)")
+    add_client_options(cmdparser)
+    (options, url_list) = cmdparser.parse_args()
+
+    if options.url_list:
+        url_list = map(str.strip, open(options.url_list).readlines())
+
+    if not url_list:
+        cmdparser.print_usage()
+        sys.exit(1)
+
+    if options.webkit and WebKit is None:
+        cmdparser.error("--webkit requires PyObjC: %s" % PYOBJC_IMPORT_ERROR)
+
+    logging.basicConfig(format="%(asctime)s [%(levelname)s]: %(message)s",
+                        level=logging.DEBUG if options.debug else logging.INFO)
+
+    if not options.max_requests:
+        options.max_requests = len(url_list)
+
+    if options.max_requests < len(url_list):
+        logging.warn("request limit %d is smaller than the provided %d URLs",
+                     options.max_requests, len(url_list))
+
+    if options.webkit:
+        webkit_benchmark(options, url_list)
+    else:
+        headless_benchmark(options, url_list)
+
 if __name__ == '__main__':
     main()
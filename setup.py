@@ -26,12 +26,11 @@ setup(name='WebToolbox',
     ],
     requires=[
         'lxml',
-        'requests',
         'gevent',
         'html5lib',
         'chardet'
     ],
-    packages=['webtoolbox'],
+    packages=find_packages(exclude=['bin']),
     include_package_data=True,
     zip_safe=False,
     scripts = glob.glob('bin/*.py'),
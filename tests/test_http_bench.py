@@ -0,0 +1,69 @@
+# encoding: utf-8
+"""
+Checks that http_bench's fixed-rate phases correct for coordinated omission
+
+Run with ``python -m pytest tests``; skipped if gevent isn't installed.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import itertools
+import os
+import unittest
+
+import pytest
+
+pytest.importorskip("gevent")
+
+from gevent import monkey
+monkey.patch_all()
+
+from webtoolbox.client import HTTPClient
+from webtoolbox.testserver import StallingServer
+
+
+def load_script(name):
+    """Import one of the tools in bin/, which isn't a package"""
+
+    path = os.path.join(os.path.dirname(__file__), os.pardir, "bin", name + ".py")
+
+    try:
+        from importlib.util import module_from_spec, spec_from_file_location
+    except ImportError:
+        # Python 2:
+        import imp
+        return imp.load_source(name, path)
+
+    spec = spec_from_file_location(name, path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+http_bench = load_script("http_bench")
+
+
+class CoordinatedOmissionTest(unittest.TestCase):
+    def test_corrected_latency_includes_stalls(self):
+        # A half second stall every 2 seconds delays the requests which
+        # should have been sent during it, but their raw latency is measured
+        # from when a connection became free. At 100 req/s the raw p90 is
+        # typically under 100ms and the corrected p90 over 400ms:
+        with StallingServer(stall_period=2, stall_duration=0.5) as server:
+            with HTTPClient() as client:
+                runner = http_bench.LoadRunner(client, itertools.repeat(server.url))
+                stats = runner.run_phase(10, rate=100, duration=4)
+
+        self.assertEqual(stats.errors, 0)
+        self.assertGreater(stats.total, 300)
+
+        raw_p90 = stats.latency.percentile(90)
+        corrected_p90 = stats.corrected_latency.percentile(90)
+
+        self.assertGreater(corrected_p90, 0.3)
+        self.assertGreater(corrected_p90, 2 * raw_p90)
+
+
+if __name__ == "__main__":
+    unittest.main()
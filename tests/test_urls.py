@@ -0,0 +1,43 @@
+# encoding: utf-8
+"""
+Tests for URL canonicalization of non-ASCII URLs
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import unittest
+
+from webtoolbox.urls import URLCanonicalizer
+
+
+class NonASCIITest(unittest.TestCase):
+    def setUp(self):
+        self.canonicalize = URLCanonicalizer()
+
+    def test_utf8_byte_string_path(self):
+        self.assertEqual(self.canonicalize("http://x.com/caf\xe9/a.html".encode("utf-8")),
+                         "http://x.com/caf%C3%A9/a.html")
+
+    def test_text_path_and_query(self):
+        self.assertEqual(self.canonicalize("http://x.com/caf\xe9/../men\xfc?q=cr\xe8me&a=1"),
+                         "http://x.com/men%C3%BC?a=1&q=cr%C3%A8me")
+
+    def test_latin1_byte_string_is_encoded_unchanged(self):
+        self.assertEqual(self.canonicalize(b"http://x.com/caf\xe9?q=\xe9"), "http://x.com/caf%E9?q=%E9")
+
+    def test_already_encoded_is_unchanged(self):
+        self.assertEqual(self.canonicalize("http://x.com/caf%c3%a9/a.html"), "http://x.com/caf%C3%A9/a.html")
+        self.assertEqual(self.canonicalize("http://x.com/caf\xe9"), self.canonicalize("http://x.com/caf%C3%A9"))
+
+    def test_hostname_is_idna_encoded(self):
+        self.assertEqual(self.canonicalize("http://B\xfccher.example:80/"), "http://xn--bcher-kva.example/")
+
+    def test_result_is_ascii_text(self):
+        url = self.canonicalize("http://x.com/日本?語")
+        self.assertEqual(url, "http://x.com/%E6%97%A5%E6%9C%AC?%E8%AA%9E")
+        url.encode("ascii")
+
+
+if __name__ == "__main__":
+    unittest.main()
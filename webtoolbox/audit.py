@@ -0,0 +1,234 @@
+# encoding: utf-8
+"""
+Caching and compression audit of the responses retrieved by a spider
+
+:class:`CachingAudit` is a :class:`webtoolbox.spider.Spider` response
+processor which needs nothing beyond the response the spider has already
+retrieved: it parses a handful of headers and, only for text responses sent
+without compression, compresses a sample of the body to estimate what
+compression would save. It's cheap enough to leave enabled for every crawl
+and doesn't require redbot.
+
+Every response is put into one of the :data:`CACHEABILITY` classes and
+problems such as missing validators, ``Vary: *`` or uncompressed text are
+added to a report under the ``Caching`` and ``Compression`` categories.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import time
+import zlib
+from collections import OrderedDict
+
+from webtoolbox.headers import parse_http_date
+
+#: Descriptions of the cacheability classes, from worst to best:
+CACHEABILITY = OrderedDict([
+    ("no-store", "Never stored (Cache-Control: no-store)"),
+    ("uncacheable", "Not cacheable (no freshness information or validator)"),
+    ("revalidate", "Revalidated on every use (no-cache or max-age=0)"),
+    ("private", "Only cached by browsers (Cache-Control: private)"),
+    ("heuristic", "Heuristically cacheable (Last-Modified without an expiry time)"),
+    ("short", "Cacheable for less than an hour"),
+    ("long", "Cacheable for an hour or more"),
+])
+
+#: Freshness lifetimes shorter than this many seconds are reported as short:
+SHORT_LIFETIME = 3600
+
+#: Smaller responses aren't worth compressing:
+MIN_COMPRESS_SIZE = 1024
+
+#: At most this much of each uncompressed body is compressed to estimate the savings:
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/x-javascript", "application/json",
+                      "application/xml", "application/rss+xml", "application/atom+xml",
+                      "application/xhtml+xml", "image/svg+xml", "image/x-icon", "application/vnd.ms-fontobject",
+                      "font/ttf", "font/otf", "application/x-font-ttf")
+
+
+def parse_cache_control(value):
+    """Return a dict of lower-cased Cache-Control directives and their values"""
+
+    directives = {}
+
+    for directive in (value or "").split(","):
+        name, _, argument = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+
+    return directives
+
+
+def freshness_lifetime(headers, cache_control):
+    """Return the browser freshness lifetime in seconds or None if there's no explicit lifetime"""
+
+    if "max-age" in cache_control:
+        try:
+            return max(0, int(cache_control["max-age"]))
+        except (TypeError, ValueError):
+            return 0
+
+    if "Expires" in headers:
+        expires = parse_http_date(headers["Expires"])
+        date = parse_http_date(headers.get("Date")) or time.time()
+        # Invalid dates such as "0" mean already expired:
+        if expires is None:
+            return 0
+        return max(0, expires - date)
+
+    return None
+
+
+def classify(headers):
+    """Return the :data:`CACHEABILITY` class and freshness lifetime for response headers"""
+
+    cache_control = parse_cache_control(headers.get("Cache-Control"))
+    lifetime = freshness_lifetime(headers, cache_control)
+
+    if "no-store" in cache_control:
+        cacheability = "no-store"
+    elif "no-cache" in cache_control or lifetime == 0:
+        cacheability = "revalidate"
+    elif "private" in cache_control:
+        cacheability = "private"
+    elif lifetime is None:
+        cacheability = "heuristic" if "Last-Modified" in headers else "uncacheable"
+    elif lifetime < SHORT_LIFETIME:
+        cacheability = "short"
+    else:
+        cacheability = "long"
+
+    return cacheability, lifetime
+
+
+def is_compressible(content_type):
+    content_type = (content_type or "").split(";", 1)[0].strip().lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def estimate_compressed_size(body):
+    """Estimate the gzip size of body by compressing at most the first COMPRESSION_SAMPLE_SIZE bytes"""
+
+    sample = body[:COMPRESSION_SAMPLE_SIZE]
+    compressed = len(zlib.compress(sample, 6))
+    return int(compressed * len(body) / len(sample))
+
+
+def format_bytes(size):
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if abs(size) < 1024 or unit == "GB":
+            return "%d %s" % (size, unit) if unit == "bytes" else "%0.1f %s" % (size, unit)
+        size /= 1024
+
+
+class CachingAudit(object):
+    """
+    Reports the cacheability and compression of every successful response
+
+    ``report`` needs an ``add(url, category, severity, title, details)``
+    method like :class:`check_site.SpiderReport`. Totals for the whole
+    crawl are available from :meth:`summary`.
+    """
+
+    def __init__(self, report):
+        self.report = report
+
+        self.responses = 0
+        self.counts = OrderedDict((name, 0) for name in CACHEABILITY)
+
+        #: Bytes received, before any Content-Encoding was removed:
+        self.transfer_bytes = 0
+        #: Bytes after decoding:
+        self.content_bytes = 0
+        #: Bytes which compression could save on responses sent uncompressed:
+        self.compression_savings = 0
+        #: Bytes which would be downloaded again on a repeat visit:
+        self.repeat_view_bytes = 0
+
+    def __call__(self, request, response):
+        if response.status_code != 200:
+            return
+
+        url = response.url
+        headers = response.headers
+        content = response.content or b""
+
+        transfer_size = response.transfer_size or len(content)
+
+        self.responses += 1
+        self.transfer_bytes += transfer_size
+        self.content_bytes += len(content)
+
+        cacheability, lifetime = classify(headers)
+        self.counts[cacheability] += 1
+
+        self.report.add(url, "Caching", "info", CACHEABILITY[cacheability], None)
+
+        has_validator = "ETag" in headers or "Last-Modified" in headers
+
+        if cacheability in ("no-store", "uncacheable"):
+            self.repeat_view_bytes += transfer_size
+        elif cacheability == "revalidate" and not has_validator:
+            self.repeat_view_bytes += transfer_size
+            self.report.add(url, "Caching", "bad",
+                            "Revalidated on every use but has no ETag or Last-Modified validator",
+                            "Each revalidation downloads the full response instead of a 304 Not Modified")
+
+        if "Set-Cookie" in headers and cacheability in ("heuristic", "short", "long"):
+            self.report.add(url, "Caching", "warning", "Sets a cookie on a publicly cacheable response",
+                            "Shared caches may store the cookie and send it to other users")
+
+        vary = [i.strip().lower() for i in headers.get("Vary", "").split(",") if i.strip()]
+
+        if "*" in vary:
+            self.report.add(url, "Caching", "bad", "Vary: * prevents caching", None)
+        elif "user-agent" in vary:
+            self.report.add(url, "Caching", "warning", "Vary: User-Agent fragments caches",
+                            "Each browser version needs a separate cached copy")
+        elif "cookie" in vary:
+            self.report.add(url, "Caching", "warning", "Vary: Cookie prevents sharing cached copies", None)
+
+        content_encoding = headers.get("Content-Encoding", "").strip().lower()
+
+        if content_encoding and content_encoding != "identity":
+            if "accept-encoding" not in vary and "*" not in vary:
+                self.report.add(url, "Compression", "warning",
+                                "Compressed response without Vary: Accept-Encoding",
+                                "Shared caches may send the compressed response to clients which can't decode it")
+        elif len(content) >= MIN_COMPRESS_SIZE and is_compressible(headers.get("Content-Type")):
+            savings = len(content) - estimate_compressed_size(content)
+
+            if savings > 0:
+                self.compression_savings += savings
+                # Only the first details of each title are reported, so the
+                # savings are totalled in the summary instead:
+                self.report.add(url, "Compression", "bad", "Compressible response sent without compression", None)
+
+    def merge(self, other):
+        """Add another audit's byte totals and cacheability counts to this one's"""
+
+        for name in ("responses", "transfer_bytes", "content_bytes", "compression_savings", "repeat_view_bytes"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+        for name, count in other.counts.items():
+            self.counts[name] += count
+
+    def summary(self):
+        """Return (label, value) pairs describing the entire crawl"""
+
+        summary = [
+            ("Responses audited", self.responses),
+            ("Bytes transferred", format_bytes(self.transfer_bytes)),
+            ("Bytes after decompression", format_bytes(self.content_bytes)),
+            ("Potential compression savings", format_bytes(self.compression_savings)),
+            ("Downloaded again on a repeat visit", format_bytes(self.repeat_view_bytes)),
+        ]
+
+        for name, description in CACHEABILITY.items():
+            if self.counts[name]:
+                summary.append((description, self.counts[name]))
+
+        return summary
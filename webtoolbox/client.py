@@ -0,0 +1,802 @@
+# encoding: utf-8
+"""
+Shared HTTP client used by the spiders and load generators
+
+:class:`HTTPClient` keeps a pool of persistent connections for each host,
+caches DNS lookups, sets socket options which matter for benchmarking and
+records how long each phase of every request took. It uses only blocking
+standard library sockets, so it runs concurrently under gevent once
+``gevent.monkey.patch_all()`` has been called, as all of the tools do, or in
+ordinary threads.
+
+HTTP/2 is used for ``https`` URLs when ``http2=True`` and the optional
+`hyper <https://hyper.readthedocs.io/>`_ package is installed. Requests to
+each host which negotiates HTTP/2 are then multiplexed over a single
+connection; hosts which only offer HTTP/1.1 use the connection pools.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import socket
+import ssl
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import http.client as httplib
+    from urllib.parse import urljoin, urlsplit
+except ImportError:
+    import httplib
+    from urlparse import urljoin, urlsplit
+
+try:
+    import hyper
+except ImportError:
+    hyper = None
+
+
+__all__ = ["HTTPClient", "Request", "Response", "Timings", "RequestError",
+           "add_client_options", "client_options"]
+
+DEFAULT_USER_AGENT = "https://github.com/acdha/webtoolbox"
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+#: Errors which mean a kept-alive connection was closed by the server while
+#: idle. Requests which fail this way are retried once on a new connection:
+STALE_CONNECTION_ERRORS = (httplib.HTTPException, socket.error)
+
+
+if sys.version_info[0] < 3:
+    def native_str(value):
+        """httplib on Python 2 needs byte strings to avoid mixing types"""
+        return value.encode("latin-1") if isinstance(value, unicode) else value
+else:
+    def native_str(value):
+        return value
+
+
+class RequestError(IOError):
+    """Raised when a request could not be completed"""
+
+    def __init__(self, message, request=None):
+        super(RequestError, self).__init__(message)
+        self.request = request
+
+
+class Timeout(RequestError):
+    pass
+
+
+class Headers(dict):
+    """Case-insensitive dictionary which preserves the last-seen key case"""
+
+    def __init__(self, items=()):
+        super(Headers, self).__init__()
+        self._names = {}
+
+        if hasattr(items, "items"):
+            items = items.items()
+
+        for name, value in items:
+            if name in self:
+                value = "%s, %s" % (self[name], value)
+            self[name] = value
+
+    def __setitem__(self, name, value):
+        self._names[name.lower()] = name
+        super(Headers, self).__setitem__(name.lower(), value)
+
+    def __getitem__(self, name):
+        return super(Headers, self).__getitem__(name.lower())
+
+    def __delitem__(self, name):
+        super(Headers, self).__delitem__(name.lower())
+        del self._names[name.lower()]
+
+    def __contains__(self, name):
+        return super(Headers, self).__contains__(name.lower())
+
+    def get(self, name, default=None):
+        return super(Headers, self).get(name.lower(), default)
+
+    def pop(self, name, *default):
+        self._names.pop(name.lower(), None)
+        return super(Headers, self).pop(name.lower(), *default)
+
+    def setdefault(self, name, value=None):
+        if name not in self:
+            self[name] = value
+        return self[name]
+
+    def update(self, other=(), **kwargs):
+        if hasattr(other, "original_items"):
+            other = other.original_items()
+        elif hasattr(other, "items"):
+            other = other.items()
+
+        for name, value in other:
+            self[name] = value
+
+        for name, value in kwargs.items():
+            self[name] = value
+
+    def copy(self):
+        return Headers(self.original_items())
+
+    def original_items(self):
+        """Return (name, value) pairs using the names as they were set"""
+        return [(self._names[k], v) for k, v in super(Headers, self).items()]
+
+
+class Timings(object):
+    """
+    Seconds spent in each phase of a request
+
+    ``dns``, ``connect`` and ``tls`` are ``None`` when an existing connection
+    was reused. ``ttfb`` is measured from when the request was written until
+    the response headers were received.
+    """
+
+    __slots__ = ("dns", "connect", "tls", "ttfb", "transfer", "total")
+
+    PHASES = ("dns", "connect", "tls", "ttfb", "transfer")
+
+    def __init__(self):
+        for i in self.__slots__:
+            setattr(self, i, None)
+
+    def as_dict(self):
+        return dict((i, getattr(self, i)) for i in self.__slots__)
+
+    def __repr__(self):
+        return "Timings(%s)" % ", ".join("%s=%0.4f" % (k, v) for k, v in sorted(self.as_dict().items())
+                                         if v is not None)
+
+
+class Request(object):
+    def __init__(self, method, url, headers=None, body=None, timeout=None):
+        self.method = method
+        self.url = url
+        self.headers = Headers(headers or {})
+        self.body = body
+        self.timeout = timeout
+
+    def __repr__(self):
+        return "<Request %s %s>" % (self.method, self.url)
+
+
+class Response(object):
+    """
+    The result of a request
+
+    Unless the request was made with ``stream=True`` the entire body has been
+    read and decoded into :attr:`content`. Streamed responses must be read
+    using :meth:`iter_content` or :meth:`readinto` and then closed so the
+    connection can be reused.
+    """
+
+    def __init__(self, request, status_code=None, reason=None, headers=None, error=None):
+        self.request = request
+        self.url = request.url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers if headers is not None else Headers()
+        self.error = error
+        self.timings = Timings()
+        self.history = []
+        self.http_version = None
+
+        #: Body bytes received over the network, before any Content-Encoding
+        #: was removed:
+        self.transfer_size = 0
+
+        self._content = None
+        self._raw = None
+        self._release = None
+        self._decoder = None
+        self._body_start = None
+
+    @property
+    def ok(self):
+        return self.error is None and self.status_code is not None and 200 <= self.status_code < 400
+
+    @property
+    def elapsed(self):
+        return self.timings.total
+
+    @property
+    def content(self):
+        if self._content is None:
+            if self._raw is None:
+                self._content = b""
+            else:
+                self._content = b"".join(self.iter_content())
+
+        return self._content
+
+    def iter_content(self, chunk_size=65536):
+        """Yield the body in chunks with any Content-Encoding removed"""
+
+        if self._raw is None:
+            if self._content:
+                yield self._content
+            return
+
+        try:
+            while True:
+                chunk = self._raw.read(chunk_size)
+                if not chunk:
+                    break
+
+                self.transfer_size += len(chunk)
+
+                if self._decoder:
+                    chunk = self._decoder.decompress(chunk)
+                    if not chunk:
+                        continue
+
+                yield chunk
+
+            if self._decoder:
+                tail = self._decoder.flush()
+                if tail:
+                    yield tail
+
+            self._finish(reusable=True)
+        except Exception:
+            self._finish(reusable=False)
+            raise
+
+    def readinto(self, buf):
+        """
+        Read raw body bytes directly into a writable buffer such as a
+        ``bytearray`` or ``memoryview``, returning the number of bytes read
+        or 0 at the end of the body
+
+        Unlike :meth:`iter_content` this does not remove Content-Encoding.
+        """
+
+        if self._raw is None:
+            return 0
+
+        try:
+            if hasattr(self._raw, "readinto"):
+                count = self._raw.readinto(buf)
+            else:
+                data = self._raw.read(len(buf))
+                count = len(data)
+                buf[:count] = data
+        except Exception:
+            self._finish(reusable=False)
+            raise
+
+        self.transfer_size += count
+
+        if not count:
+            self._finish(reusable=True)
+
+        return count
+
+    def close(self):
+        """Discard any unread body and release the connection"""
+        if self._raw is not None:
+            self._finish(reusable=False)
+
+    def _finish(self, reusable):
+        if self._raw is None:
+            return
+
+        self._raw = None
+
+        if self._body_start is not None:
+            now = time.time()
+            self.timings.transfer = now - self._body_start
+            self.timings.total += self.timings.transfer
+
+        if self._release:
+            release, self._release = self._release, None
+            release(reusable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return "<Response %s %s>" % (self.status_code, self.url)
+
+
+class DNSCache(object):
+    """Caches ``getaddrinfo`` results for ``ttl`` seconds"""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        key = (host, port)
+        now = time.time()
+
+        with self._lock:
+            cached = self._cache.get(key)
+
+        if cached and cached[0] > now:
+            return cached[1]
+
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+        if self.ttl:
+            with self._lock:
+                self._cache[key] = (now + self.ttl, addresses)
+
+        return addresses
+
+
+class HostPool(object):
+    """Idle connections and a limit on open connections for one host"""
+
+    def __init__(self, size):
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def checkout(self):
+        self.semaphore.acquire()
+
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+
+        return None
+
+    def checkin(self, conn):
+        if conn is not None:
+            with self.lock:
+                self.idle.append(conn)
+
+        self.semaphore.release()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for conn in idle:
+            conn.close()
+
+
+class HTTPClient(object):
+    """
+    Thread- and greenlet-safe HTTP/1.1 client with per-host connection pools
+
+    :param pool_size: maximum simultaneous connections to each host
+    :param keep_alive: reuse connections between requests
+    :param tcp_nodelay: disable Nagle's algorithm on new connections
+    :param tcp_keepalive: enable TCP keepalive probes on new connections
+    :param dns_cache_ttl: seconds to cache DNS results, 0 to disable
+    :param http2: use HTTP/2 for https URLs if the ``hyper`` package is available
+    :param max_redirects: follow up to this many redirects
+    :param decode_content: request and transparently decode gzip/deflate
+    """
+
+    def __init__(self, pool_size=6, keep_alive=True, tcp_nodelay=True,
+                 tcp_keepalive=False, dns_cache_ttl=300, http2=False,
+                 timeout=15, headers=None, max_redirects=0, decode_content=True,
+                 verify_tls=True):
+        self.log = logging.getLogger("webtoolbox.client")
+
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.tcp_nodelay = tcp_nodelay
+        self.tcp_keepalive = tcp_keepalive
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.decode_content = decode_content
+
+        self.headers = Headers({"User-Agent": DEFAULT_USER_AGENT})
+        self.headers.update(Headers(headers or {}))
+
+        self.dns = DNSCache(ttl=dns_cache_ttl)
+
+        if verify_tls:
+            self.ssl_context = ssl.create_default_context()
+        else:
+            self.ssl_context = ssl.create_default_context()
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+
+        if http2 and hyper is None:
+            self.log.warning("HTTP/2 requested but hyper is not installed: using HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+
+        self._pools = {}
+        # (host, port) → a connection which negotiated HTTP/2:
+        self._h2_connections = {}
+        # Held while the first connection to a host negotiates its protocol:
+        self._h2_probes = {}
+        # Hosts which fell back to HTTP/1.1:
+        self._http11_hosts = set()
+        self._lock = threading.Lock()
+
+    def _get_pool(self, key):
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = HostPool(self.pool_size)
+            return pool
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+            h2, self._h2_connections = list(self._h2_connections.values()), {}
+
+        for pool in pools:
+            pool.close()
+
+        for conn in h2:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def request(self, method, url, headers=None, body=None, timeout=None, stream=False):
+        return self.send(Request(method, url, headers=headers, body=body, timeout=timeout),
+                         stream=stream)
+
+    def send(self, request, stream=False):
+        """
+        Perform a :class:`Request`, following redirects if configured
+
+        Raises :class:`RequestError` if no response could be received.
+        """
+
+        history = []
+
+        while True:
+            response = self._send_one(request, stream=stream)
+
+            location = response.headers.get("Location")
+
+            if (response.status_code not in REDIRECT_CODES or not location
+                    or len(history) >= self.max_redirects):
+                break
+
+            # Redirect bodies are usually tiny so it's cheaper to read them
+            # than to throw away the connection:
+            self._read_body(response)
+            history.append(response)
+
+            method = request.method
+            if response.status_code == 303 or (response.status_code in (301, 302) and method == "POST"):
+                method = "GET"
+
+            request = Request(method, urljoin(response.url, location), headers=request.headers,
+                              body=request.body if method == request.method else None,
+                              timeout=request.timeout)
+
+        response.history = history
+
+        if not stream:
+            self._read_body(response)
+
+        return response
+
+    def _read_body(self, response):
+        try:
+            return response.content
+        except socket.timeout as exc:
+            raise Timeout("Timed out reading %s: %s" % (response.url, exc), request=response.request)
+        except (socket.error, httplib.HTTPException, zlib.error) as exc:
+            raise RequestError("Unable to read %s: %s" % (response.url, exc), request=response.request)
+
+    def _send_one(self, request, stream):
+        parsed = urlsplit(request.url)
+        scheme = parsed.scheme.lower()
+
+        if scheme not in ("http", "https"):
+            raise RequestError("Unsupported URL scheme: %s" % request.url, request=request)
+
+        host = parsed.hostname
+        port = parsed.port or (443 if scheme == "https" else 80)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+
+        headers = Headers(self.headers.original_items())
+        headers.update(request.headers)
+        if self.decode_content and not stream and "Accept-Encoding" not in headers:
+            headers["Accept-Encoding"] = "gzip, deflate"
+        if not self.keep_alive:
+            headers["Connection"] = "close"
+
+        timeout = request.timeout or self.timeout
+
+        if self.http2 and scheme == "https":
+            response = self._send_h2(request, host, port, path, headers, timeout)
+            if response is not None:
+                return response
+
+        pool = self._get_pool((scheme, host, port))
+
+        for attempt in (1, 2):
+            response = Response(request)
+            start = time.time()
+
+            conn = pool.checkout()
+            reused = conn is not None
+
+            try:
+                if not reused:
+                    conn = self._connect(scheme, host, port, timeout, response.timings)
+                else:
+                    conn.sock.settimeout(timeout)
+
+                conn.putrequest(native_str(request.method), native_str(path),
+                                skip_accept_encoding=True)
+                for name, value in headers.original_items():
+                    conn.putheader(native_str(name), native_str(value))
+                conn.endheaders(request.body)
+
+                sent = time.time()
+                raw = conn.getresponse()
+                received = time.time()
+            except socket.timeout as exc:
+                self._discard(pool, conn)
+                raise Timeout("Timed out retrieving %s: %s" % (request.url, exc), request=request)
+            except STALE_CONNECTION_ERRORS as exc:
+                self._discard(pool, conn)
+
+                if reused and attempt == 1:
+                    self.log.debug("Retrying %s after stale connection error: %s", request.url, exc)
+                    continue
+
+                raise RequestError("Unable to retrieve %s: %s" % (request.url, exc), request=request)
+            except Exception:
+                self._discard(pool, conn)
+                raise
+
+            break
+
+        response.status_code = raw.status
+        response.reason = raw.reason
+        response.http_version = "HTTP/1.1" if raw.version == 11 else "HTTP/1.0"
+        response.headers = Headers(raw.getheaders())
+        response.timings.ttfb = received - sent
+        response.timings.total = received - start
+        response._raw = raw
+        response._body_start = received
+        response._decoder = self._get_decoder(response.headers)
+
+        keep = self.keep_alive and not raw.will_close
+
+        def release(reusable, conn=conn):
+            if reusable and keep:
+                pool.checkin(conn)
+            else:
+                self._discard(pool, conn)
+
+        response._release = release
+
+        return response
+
+    def _discard(self, pool, conn):
+        if conn is not None:
+            conn.close()
+        pool.checkin(None)
+
+    def _connect(self, scheme, host, port, timeout, timings):
+        start = time.time()
+        addresses = self.dns.resolve(host, port)
+        timings.dns = time.time() - start
+
+        sock = None
+        last_error = None
+
+        start = time.time()
+
+        for family, socktype, proto, canonname, address in addresses:
+            try:
+                sock = socket.socket(family, socktype, proto)
+                sock.settimeout(timeout)
+
+                if self.tcp_nodelay:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if self.tcp_keepalive:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+                sock.connect(address)
+                break
+            except socket.error as exc:
+                last_error = exc
+                if sock is not None:
+                    sock.close()
+                sock = None
+
+        if sock is None:
+            raise last_error or socket.error("No addresses found for %s" % host)
+
+        timings.connect = time.time() - start
+
+        if scheme == "https":
+            start = time.time()
+            sock = self.ssl_context.wrap_socket(sock, server_hostname=host)
+            timings.tls = time.time() - start
+
+        # HTTPSConnection leaves the default port out of the Host header:
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host, port, timeout=timeout, context=self.ssl_context)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=timeout)
+        conn.sock = sock
+        return conn
+
+    def _get_decoder(self, headers):
+        encoding = headers.get("Content-Encoding", "").strip().lower()
+
+        if encoding == "gzip":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            return DeflateDecoder()
+        else:
+            return None
+
+    def _send_h2(self, request, host, port, path, headers, timeout):
+        """Return the response over HTTP/2 or None if the host only supports HTTP/1.1"""
+
+        key = (host, port)
+
+        with self._lock:
+            conn = self._h2_connections.get(key)
+            probe = self._h2_probes.setdefault(key, threading.Lock()) if conn is None else None
+
+        if conn is not None:
+            return self._h2_request(conn, key, request, path, headers, timeout)
+
+        # hyper negotiates HTTP/2 using ALPN but falls back to an HTTP/1.1
+        # connection which can't be shared, so only one request is sent
+        # until the protocol is known:
+        with probe:
+            with self._lock:
+                conn = self._h2_connections.get(key)
+                http11 = key in self._http11_hosts
+
+            if http11:
+                return None
+
+            if conn is None:
+                conn = hyper.HTTPConnection(host, port, secure=True, ssl_context=self.ssl_context,
+                                            timeout=timeout)
+                response = self._h2_request(conn, key, request, path, headers, timeout)
+
+                if response.http_version == "HTTP/2":
+                    with self._lock:
+                        self._h2_connections[key] = conn
+                else:
+                    self.log.info("%s:%d doesn't support HTTP/2: using HTTP/1.1", host, port)
+                    conn.close()
+                    with self._lock:
+                        self._http11_hosts.add(key)
+
+                return response
+
+        return self._h2_request(conn, key, request, path, headers, timeout)
+
+    def _h2_request(self, conn, key, request, path, headers, timeout):
+        response = Response(request)
+        start = time.time()
+
+        try:
+            # hyper connects, and switches to HTTP/2 if ALPN selects it, when
+            # the first request is sent:
+            headers.pop("Accept-Encoding", None)
+            stream_id = conn.request(request.method, path, body=request.body,
+                                     headers=dict(headers.original_items()))
+            sent = time.time()
+
+            # hyper 0.7 ignores the timeout option and connects with a fixed
+            # 5 second one, which would otherwise apply to every read:
+            sock = getattr(conn, "_sock", None)
+            if sock is not None:
+                sock.settimeout(timeout)
+
+            raw = conn.get_response(stream_id)
+            received = time.time()
+        except Exception as exc:
+            with self._lock:
+                if self._h2_connections.get(key) is conn:
+                    del self._h2_connections[key]
+            conn.close()
+            if isinstance(exc, socket.timeout):
+                raise Timeout("Timed out retrieving %s: %s" % (request.url, exc), request=request)
+            raise RequestError("Unable to retrieve %s: %s" % (request.url, exc), request=request)
+
+        response.status_code = raw.status
+        response.reason = raw.reason
+        response.http_version = "HTTP/2" if isinstance(raw, hyper.HTTP20Response) else "HTTP/1.1"
+        response.headers = Headers((k.decode("latin-1"), v.decode("latin-1")) for k, v in raw.headers.iter_raw())
+        response.timings.ttfb = received - sent
+        response.timings.total = received - start
+
+        # hyper transparently removes Content-Encoding:
+        try:
+            response._content = raw.read()
+        except socket.timeout as exc:
+            raise Timeout("Timed out reading %s: %s" % (request.url, exc), request=request)
+        response.transfer_size = len(response._content)
+        response.timings.transfer = time.time() - received
+        response.timings.total += response.timings.transfer
+
+        return response
+
+
+class DeflateDecoder(object):
+    """Handles both zlib-wrapped and raw deflate bodies, as servers vary"""
+
+    def __init__(self):
+        self._first = True
+        self._obj = zlib.decompressobj()
+
+    def decompress(self, data):
+        if self._first:
+            self._first = False
+            try:
+                return self._obj.decompress(data)
+            except zlib.error:
+                self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        return self._obj.decompress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+
+def add_client_options(parser):
+    """Add the HTTP client tuning options to an optparse or argparse parser"""
+
+    if hasattr(parser, "add_argument_group"):
+        group = parser.add_argument_group("HTTP Client")
+        add = group.add_argument
+    else:
+        import optparse
+        group = optparse.OptionGroup(parser, "HTTP Client")
+        parser.add_option_group(group)
+        add = group.add_option
+
+    add("--pool-size", type=int, default=6,
+        help="Maximum simultaneous connections to each host")
+    add("--no-keep-alive", dest="keep_alive", action="store_false", default=True,
+        help="Open a new connection for every request")
+    add("--no-tcp-nodelay", dest="tcp_nodelay", action="store_false", default=True,
+        help="Leave Nagle's algorithm enabled")
+    add("--tcp-keepalive", action="store_true", default=False,
+        help="Enable TCP keepalive probes")
+    add("--dns-cache-ttl", type=float, default=300,
+        help="Seconds to cache DNS lookups (0 disables caching)")
+    add("--http2", action="store_true", default=False,
+        help="Use HTTP/2 for https URLs (requires hyper)")
+
+    return group
+
+
+def client_options(options):
+    """Return :class:`HTTPClient` keyword arguments from parsed command-line options"""
+
+    return dict(pool_size=options.pool_size, keep_alive=options.keep_alive,
+                tcp_nodelay=options.tcp_nodelay, tcp_keepalive=options.tcp_keepalive,
+                dns_cache_ttl=options.dns_cache_ttl, http2=options.http2)
@@ -0,0 +1,175 @@
+# encoding: utf-8
+"""
+Exact and near-duplicate detection for the pages retrieved by a spider
+
+Sites commonly return the same page for many URLs: session IDs, tracking
+parameters, sort orders and faceted navigation. :class:`ContentFingerprints`
+recognizes a body which has been seen before from a hash of its bytes, which
+lets :class:`webtoolbox.spider.Spider` skip parsing it, and groups pages
+whose text is nearly identical using a 64-bit SimHash of word shingles so
+the URLs causing them can be reported and fixed.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import hashlib
+import re
+import struct
+
+TAG_RE = re.compile(r"<script\b.*?</script\s*>|<style\b.*?</style\s*>|<!--.*?-->|<[^>]*>",
+                    re.DOTALL | re.IGNORECASE)
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+#: Words in each shingle:
+SHINGLE_SIZE = 3
+
+SIMHASH_BITS = 64
+
+
+def content_hash(body):
+    """Return a digest identifying an exact response body"""
+
+    if not isinstance(body, bytes):
+        body = body.encode("utf-8")
+
+    return hashlib.sha1(body).digest()
+
+
+def simhash(html):
+    """
+    Return a 64-bit SimHash of the words in an HTML document
+
+    Markup, scripts and styles are removed with regular expressions rather
+    than a parser so this is cheap enough to run on every page. Similar
+    documents have fingerprints which differ in only a few bits.
+    """
+
+    words = WORD_RE.findall(TAG_RE.sub(" ", html).lower())
+
+    if len(words) < SHINGLE_SIZE:
+        shingles = set([" ".join(words)])
+    else:
+        shingles = set(" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1))
+
+    hashes = [format(struct.unpack(str(">Q"), hashlib.md5(i.encode("utf-8")).digest()[:8])[0], "064b")
+              for i in shingles]
+
+    # Each bit is set if it's set in more than half of the shingle hashes.
+    # Transposing the bit strings counts every column without a Python loop
+    # per bit per shingle:
+    threshold = len(hashes) / 2
+    fingerprint = 0
+
+    for column in zip(*hashes):
+        fingerprint = (fingerprint << 1) | (column.count("1") > threshold)
+
+    return fingerprint
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class ContentFingerprints(object):
+    """
+    Tracks the exact and near-duplicate pages found during a crawl
+
+    Near-duplicates are found by splitting each SimHash into ``max_distance
+    + 1`` bands: fingerprints which differ in at most ``max_distance`` bits
+    must be identical in at least one band, so only pages sharing a band are
+    compared. A page which matches is added to the matching page's cluster
+    but isn't indexed itself, which keeps the number of comparisons for a
+    large cluster down to its first few members.
+    """
+
+    def __init__(self, max_distance=3):
+        self.max_distance = max_distance
+        self.band_bits = SIMHASH_BITS // (max_distance + 1)
+
+        #: Digest → first URL with that body:
+        self.bodies = {}
+        #: First URL → every URL with the same body:
+        self.exact_duplicates = {}
+
+        # (band number, band value) → URLs indexed for near-duplicate matching:
+        self.bands = {}
+        self.simhashes = {}
+        # URL → the first URL in its near-duplicate cluster:
+        self.cluster_of = {}
+        self.clusters = {}
+
+    def add_body(self, url, digest):
+        """Return the URL which first had this body or None if it hasn't been seen before"""
+
+        original = self.bodies.get(digest)
+
+        if original is None:
+            self.bodies[digest] = url
+            return None
+
+        self.exact_duplicates.setdefault(original, [original]).append(url)
+        return original
+
+    def iter_bands(self, fingerprint):
+        mask = (1 << self.band_bits) - 1
+        for i in range(self.max_distance + 1):
+            yield i, (fingerprint >> (i * self.band_bits)) & mask
+
+    def add_simhash(self, url, fingerprint):
+        """Record a page's SimHash and return the first URL of its cluster, if it has one"""
+
+        self.simhashes[url] = fingerprint
+
+        for band in self.iter_bands(fingerprint):
+            for other in self.bands.get(band, ()):
+                if hamming_distance(fingerprint, self.simhashes[other]) <= self.max_distance:
+                    cluster = self.cluster_of.get(other, other)
+                    self.cluster_of[url] = cluster
+                    self.clusters.setdefault(cluster, [cluster]).append(url)
+                    return cluster
+
+        for band in self.iter_bands(fingerprint):
+            self.bands.setdefault(band, []).append(url)
+
+        return None
+
+    def merge(self, other):
+        """Add another instance's bodies and SimHashes, grouping duplicates found by either"""
+
+        for digest, url in other.bodies.items():
+            urls = other.exact_duplicates.get(url, [url])
+            original = self.bodies.get(digest)
+
+            if original is None:
+                self.bodies[digest] = url
+                if len(urls) > 1:
+                    self.exact_duplicates[url] = list(urls)
+            else:
+                self.exact_duplicates.setdefault(original, [original]).extend(urls)
+
+        # Replaying the fingerprints finds the clusters which span both instances:
+        for url in sorted(other.simhashes):
+            if url not in self.simhashes:
+                self.add_simhash(url, other.simhashes[url])
+
+    def duplicate_groups(self):
+        """Return sorted lists of the URLs with identical bodies, largest first"""
+        return sorted((sorted(urls) for urls in self.exact_duplicates.values()), key=lambda i: (-len(i), i))
+
+    def near_duplicate_clusters(self):
+        """
+        Return sorted lists of URLs whose pages are nearly identical, largest first
+
+        Exact duplicates are included in the cluster of the page they duplicate.
+        """
+
+        clusters = []
+
+        for urls in self.clusters.values():
+            members = set(urls)
+            for url in urls:
+                members.update(self.exact_duplicates.get(url, ()))
+            clusters.append(sorted(members))
+
+        return sorted(clusters, key=lambda i: (-len(i), i))
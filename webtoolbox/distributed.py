@@ -0,0 +1,260 @@
+# encoding: utf-8
+"""
+Crawling one site or many with several spider processes
+
+The URL space is partitioned by a hash of the host, so every URL on a host
+belongs to the same shard and per-host politeness, throttling and trap
+budgets keep working. Each worker process runs an ordinary
+:class:`webtoolbox.spider.Spider` with its own frontier and seen-set and a
+:class:`Shard`, which forwards links to URLs owned by other shards in
+batches and receives the links the other workers forward to it.
+
+:class:`SQLiteExchange` carries the forwarded links between the workers
+through a SQLite database, which is enough for the processes on one machine
+and for tests; anything which can send batches and report when every shard
+is idle could replace it. The crawl has finished once every shard is idle
+and no forwarded links are waiting.
+
+:class:`Coordinator` starts the workers, waits for them and returns their
+results, which are merged using :meth:`webtoolbox.spider.Spider.merge_state`.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import os
+import pickle
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+import zlib
+from collections import defaultdict
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+
+def shard_for(url, shards):
+    """Return the shard which owns url; the hash is stable across processes and runs"""
+
+    host = urlsplit(url).netloc.lower()
+    return (zlib.crc32(host.encode("utf-8")) & 0xFFFFFFFF) % shards
+
+
+class SQLiteExchange(object):
+    """
+    Forwards links between shards through a SQLite database
+
+    :meth:`create` initializes the database before the workers start with
+    every shard marked as busy, so the crawl can't be considered finished
+    before each worker has had a chance to start.
+    """
+
+    def __init__(self, filename, timeout=60):
+        self.filename = filename
+        # Transactions are started explicitly:
+        self.db = sqlite3.connect(filename, timeout=timeout, isolation_level=None)
+
+    @classmethod
+    def create(cls, filename, shards):
+        exchange = cls(filename)
+        db = exchange.db
+
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE links (id INTEGER PRIMARY KEY AUTOINCREMENT, shard INTEGER NOT NULL,"
+                   " url TEXT NOT NULL, depth INTEGER NOT NULL, kind TEXT NOT NULL, referrer TEXT)")
+        db.execute("CREATE INDEX links_shard ON links (shard, id)")
+        db.execute("CREATE TABLE shards (shard INTEGER PRIMARY KEY, idle INTEGER NOT NULL)")
+        db.executemany("INSERT INTO shards (shard, idle) VALUES (?, 0)", [(i, ) for i in range(shards)])
+
+        return exchange
+
+    def send(self, batches):
+        """Store a dict of shard → list of (url, depth, kind, referrer) in one transaction"""
+
+        rows = [(shard, url, depth, kind, referrer)
+                for shard, links in batches.items() for url, depth, kind, referrer in links]
+
+        with self.transaction():
+            self.db.executemany("INSERT INTO links (shard, url, depth, kind, referrer) VALUES (?, ?, ?, ?, ?)",
+                                rows)
+
+    def receive(self, shard, limit=1000):
+        """Remove and return up to limit links for shard, marking it busy if there were any"""
+
+        with self.transaction():
+            links = self.db.execute("SELECT id, url, depth, kind, referrer FROM links WHERE shard = ?"
+                                    " ORDER BY id LIMIT ?", (shard, limit)).fetchall()
+
+            if links:
+                self.db.execute("DELETE FROM links WHERE shard = ? AND id <= ?", (shard, links[-1][0]))
+                self.db.execute("UPDATE shards SET idle = 0 WHERE shard = ?", (shard, ))
+
+        return [row[1:] for row in links]
+
+    def finished(self, shard):
+        """Mark shard idle and return True if every shard is idle and no links are waiting"""
+
+        with self.transaction():
+            self.db.execute("UPDATE shards SET idle = 1 WHERE shard = ?", (shard, ))
+            waiting = self.db.execute("SELECT COUNT(*) FROM links").fetchone()[0]
+            busy = self.db.execute("SELECT COUNT(*) FROM shards WHERE idle = 0").fetchone()[0]
+
+        return not waiting and not busy
+
+    def transaction(self):
+        return Transaction(self.db)
+
+    def close(self):
+        self.db.close()
+
+
+class Transaction(object):
+    """Holds SQLite's write lock from the start so reads and writes see one consistent state"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.db.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+
+
+class Shard(object):
+    """
+    One worker's share of a distributed crawl
+
+    Pass it to :class:`webtoolbox.spider.Spider` as ``shard``. Links to other
+    shards are sent once ``batch_size`` have accumulated or
+    ``flush_interval`` seconds have passed, and whenever the spider runs out
+    of work.
+    """
+
+    def __init__(self, index, count, exchange, batch_size=100, flush_interval=1.0, poll_interval=0.5):
+        self.log = logging.getLogger("webtoolbox.distributed")
+
+        self.index = index
+        self.count = count
+        self.exchange = exchange
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+
+        self.outbox = defaultdict(list)
+        self.pending = 0
+        self.last_flush = time.time()
+
+        #: The number of links sent to and received from other shards:
+        self.sent = 0
+        self.received = 0
+
+    def owns(self, url):
+        return shard_for(url, self.count) == self.index
+
+    def forward(self, url, depth, kind, referrer=None):
+        self.outbox[shard_for(url, self.count)].append((url, depth, kind, referrer))
+        self.pending += 1
+
+        if self.pending >= self.batch_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+
+        if not self.pending:
+            return
+
+        self.exchange.send(self.outbox)
+        self.log.debug("Shard %d forwarded %d links", self.index, self.pending)
+
+        self.sent += self.pending
+        self.outbox = defaultdict(list)
+        self.pending = 0
+
+    def receive(self):
+        """Return the (url, depth, kind, referrer) links forwarded to this shard"""
+
+        links = self.exchange.receive(self.index)
+        self.received += len(links)
+        return links
+
+    def finished(self):
+        """Return True once every shard is out of work; call only when this one is"""
+
+        self.flush()
+        return self.exchange.finished(self.index)
+
+
+def save_state(state, filename):
+    with open(filename, "wb") as f:
+        pickle.dump(state, f, 2)
+
+
+def load_state(filename):
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+class Coordinator(object):
+    """
+    Runs a crawl in ``workers`` processes and returns their results
+
+    Each worker is started as ``command`` plus ``--shard=N --shards=WORKERS
+    --exchange=DATABASE --results=FILE`` and must crawl with a
+    :class:`Shard` and save its state to FILE using :func:`save_state`.
+    """
+
+    def __init__(self, workers):
+        self.log = logging.getLogger("webtoolbox.distributed")
+        self.workers = workers
+
+    def run(self, command):
+        directory = tempfile.mkdtemp(prefix="crawl-")
+
+        try:
+            exchange_filename = os.path.join(directory, "exchange.sqlite")
+            SQLiteExchange.create(exchange_filename, self.workers).close()
+
+            results = [os.path.join(directory, "shard-%d.pickle" % i) for i in range(self.workers)]
+
+            processes = [subprocess.Popen(command + ["--shard=%d" % i, "--shards=%d" % self.workers,
+                                                     "--exchange=%s" % exchange_filename,
+                                                     "--results=%s" % results[i]])
+                         for i in range(self.workers)]
+
+            self.log.info("Started %d crawl workers", self.workers)
+
+            self.wait(processes)
+
+            return [load_state(i) for i in results]
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def wait(self, processes):
+        running = list(processes)
+
+        try:
+            while running:
+                for process in list(running):
+                    status = process.poll()
+                    if status is None:
+                        continue
+
+                    running.remove(process)
+
+                    # The other shards would wait forever for its links:
+                    if status != 0:
+                        raise RuntimeError("Crawl worker %d exited with status %d" % (process.pid, status))
+
+                time.sleep(0.1)
+        finally:
+            for process in running:
+                process.terminate()
+                process.wait()
@@ -0,0 +1,185 @@
+# encoding: utf-8
+"""
+A priority-ordered crawl frontier
+
+:class:`Frontier` replaces a FIFO queue of requests with a heap so that when
+a crawl is limited by time or the number of requests the most valuable URLs
+are retrieved first. Each URL is ranked by a tuple of criteria in a
+configurable order:
+
+``type``
+    pages before stylesheets and scripts, and those before media
+``depth``
+    the number of clicks from a starting URL, so the crawl is breadth-first
+``inlinks``
+    URLs linked from more of the pages retrieved so far first, in
+    power-of-two buckets so a URL moves up only when its count doubles
+``staleness``
+    URLs never crawled before first, then the longest since they were last
+    crawled according to ``last_crawled``
+
+Ties are broken in the order the URLs were added. Priorities change when a
+URL is found at a lower depth or gains in-links; the old heap entry is left
+in place and skipped when it reaches the top.
+
+:meth:`Frontier.pop` can be given a test for whether a host may be sent a
+request now; URLs for other hosts are set aside, keeping their priority,
+until :meth:`Frontier.resume` returns them to the heap.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import heapq
+import itertools
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+CRITERIA = ("type", "depth", "inlinks", "staleness")
+
+DEFAULT_ORDER = CRITERIA
+
+#: Lower ranks are retrieved first:
+KIND_RANKS = {"page": 0, "resource": 1, "media": 2}
+
+
+def parse_order(value):
+    """Return a tuple of criteria names from a comma-separated string"""
+
+    order = tuple(i.strip() for i in value.split(",") if i.strip())
+
+    unknown = [i for i in order if i not in CRITERIA]
+    if unknown:
+        raise ValueError("Unknown frontier criteria %s: must be one of %s"
+                         % (", ".join(unknown), ", ".join(CRITERIA)))
+
+    return order
+
+
+def load_crawl_times(f):
+    """Read the URL → timestamp pairs written by :func:`save_crawl_times`"""
+
+    crawl_times = {}
+
+    for line in f:
+        url, _, timestamp = line.rstrip("\n").rpartition("\t")
+        if url:
+            crawl_times[url] = float(timestamp)
+
+    return crawl_times
+
+
+def save_crawl_times(crawl_times, f):
+    """Write URL → timestamp pairs as tab-separated values"""
+
+    for url in sorted(crawl_times):
+        f.write("%s\t%0.3f\n" % (url, crawl_times[url]))
+
+
+class Frontier(object):
+    """
+    URLs waiting to be crawled, highest priority first
+
+    :param order: the :data:`CRITERIA` to rank by, most significant first
+    :param last_crawled: a dict of URL → the time it was last crawled
+    """
+
+    def __init__(self, order=DEFAULT_ORDER, last_crawled=None):
+        unknown = [i for i in order if i not in CRITERIA]
+        if unknown:
+            raise ValueError("Unknown frontier criteria: %s" % ", ".join(unknown))
+
+        self.order = tuple(order)
+        self.last_crawled = last_crawled or {}
+
+        self.heap = []
+        # URL → [sequence number, item, depth, kind, inlinks] for every pending URL:
+        self.entries = {}
+        self.counter = itertools.count()
+        #: Host → heap entries set aside by pop() until resume():
+        self.deferred = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, url):
+        return url in self.entries
+
+    def priority(self, url, depth, kind, inlinks):
+        values = {
+            "type": KIND_RANKS.get(kind, 0),
+            "depth": depth,
+            "inlinks": -inlinks.bit_length(),
+            "staleness": self.last_crawled.get(url, 0),
+        }
+        return tuple(values[i] for i in self.order)
+
+    def push(self, url, item, depth=0, kind="page", inlinks=0):
+        """Add item, usually a request for url; use :meth:`update` for URLs already pending"""
+
+        seq = next(self.counter)
+        self.entries[url] = [seq, item, depth, kind, inlinks]
+        heapq.heappush(self.heap, (self.priority(url, depth, kind, inlinks), seq, url))
+
+    def update(self, url, depth=None, inlinks=None):
+        """Lower a pending URL's depth or raise its in-link count, reordering it if that changes its priority"""
+
+        entry = self.entries.get(url)
+        if entry is None:
+            return
+
+        seq, item, old_depth, kind, old_inlinks = entry
+
+        new_depth = old_depth if depth is None else min(depth, old_depth)
+        new_inlinks = old_inlinks if inlinks is None else max(inlinks, old_inlinks)
+
+        old_priority = self.priority(url, old_depth, kind, old_inlinks)
+        new_priority = self.priority(url, new_depth, kind, new_inlinks)
+
+        entry[2] = new_depth
+        entry[4] = new_inlinks
+
+        if new_priority != old_priority:
+            # Keeping the sequence number keeps the original order among ties:
+            heapq.heappush(self.heap, (new_priority, seq, url))
+
+    def pending(self):
+        """Return (url, depth, kind) for every pending URL in the order they were added"""
+        return [(url, entry[2], entry[3]) for url, entry in sorted(self.entries.items(), key=lambda i: i[1][0])]
+
+    def pop(self, ready=None):
+        """
+        Remove and return the highest priority item
+
+        If ``ready`` is given it's called with a URL's host and URLs for
+        hosts where it returns False are set aside until :meth:`resume`.
+        Raises :exc:`IndexError` if no URL is left which may be popped.
+        """
+
+        while self.heap:
+            priority, seq, url = heapq.heappop(self.heap)
+            entry = self.entries.get(url)
+
+            # Skip entries which were superseded by update() or already popped:
+            if entry is None or entry[0] != seq or self.priority(url, entry[2], entry[3], entry[4]) != priority:
+                continue
+
+            if ready is not None:
+                host = urlsplit(url).netloc
+                if not ready(host):
+                    self.deferred.setdefault(host, []).append((priority, seq, url))
+                    continue
+
+            del self.entries[url]
+            return entry[1]
+
+        raise IndexError("pop from an empty frontier")
+
+    def resume(self, host):
+        """Return the URLs set aside for host by :meth:`pop` to the heap"""
+
+        for heap_entry in self.deferred.pop(host, ()):
+            heapq.heappush(self.heap, heap_entry)
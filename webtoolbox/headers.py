@@ -0,0 +1,16 @@
+# encoding: utf-8
+"""
+Parsing HTTP header values shared by the audit and throttling modules
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import email.utils
+
+
+def parse_http_date(value):
+    """Return the Unix timestamp of an HTTP date such as an Expires header or None if it's invalid"""
+
+    parsed = email.utils.parsedate_tz(value) if value else None
+    return email.utils.mktime_tz(parsed) if parsed else None
@@ -0,0 +1,12 @@
+# encoding: utf-8
+"""
+Parsing for webserver access logs shared by log_to_tsv and log_replay
+"""
+
+from __future__ import absolute_import
+
+from .formats import (ALIASES, FORMATS, LogEntry, LogFormat, detect_format, get_format,
+                      register_format)
+from .filters import LogFilter
+from .index import TimestampIndex
+from .readers import LogReader
@@ -0,0 +1,207 @@
+# encoding: utf-8
+"""
+Streaming summaries of parsed log entries in bounded memory
+
+:class:`SpaceSaving` finds the most frequent paths, :class:`HyperLogLog`
+estimates the number of distinct user-agents and :class:`LogSummary` combines
+them with per-interval and status × method counts. Memory depends on the
+configured sizes and the time span of the logs, never on the number of lines.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import hashlib
+import heapq
+import math
+import struct
+import time
+from collections import defaultdict
+
+
+class SpaceSaving(object):
+    """
+    Approximate top-K counts using the Space-Saving algorithm
+
+    At most ``capacity`` items are tracked. When a new item arrives and the
+    table is full it replaces the item with the lowest count and inherits
+    that count, which is recorded as the maximum overestimate. Any item
+    whose true count is more than ``total / capacity`` is guaranteed to be
+    tracked.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # One (count, item) entry per tracked item. Counts are only updated
+        # here when an entry reaches the top of the heap:
+        self.heap = []
+        self.total = 0
+
+    def add(self, item, count=1):
+        self.total += count
+        counts = self.counts
+
+        if item in counts:
+            counts[item] += count
+            return
+
+        if len(counts) < self.capacity:
+            counts[item] = count
+            self.errors[item] = 0
+            heapq.heappush(self.heap, (count, item))
+            return
+
+        heap = self.heap
+        while True:
+            min_count, victim = heap[0]
+            if counts[victim] == min_count:
+                break
+            heapq.heapreplace(heap, (counts[victim], victim))
+
+        del counts[victim]
+        del self.errors[victim]
+
+        counts[item] = min_count + count
+        self.errors[item] = min_count
+        heapq.heapreplace(heap, (min_count + count, item))
+
+    def top(self, k=None):
+        """Return up to k (item, count, error) tuples, most frequent first"""
+
+        ranked = sorted(self.counts.items(), key=lambda i: (-i[1], i[0]))
+        return [(item, count, self.errors[item]) for item, count in ranked[:k]]
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct values using 2 ** precision one-byte
+    registers; the standard error is about 1.04 / sqrt(2 ** precision)
+    """
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+        self.alpha = 0.7213 / (1 + 1.079 / self.size)
+        # Values such as user-agents repeat constantly so their hashes are cached:
+        self.hash_cache = {}
+
+    def hash(self, value):
+        try:
+            return self.hash_cache[value]
+        except KeyError:
+            if len(self.hash_cache) > 10000:
+                self.hash_cache.clear()
+            digest = hashlib.sha1(value.encode('utf-8')).digest()
+            h = self.hash_cache[value] = struct.unpack(str('>Q'), digest[:8])[0]
+            return h
+
+    def add(self, value):
+        h = self.hash(value)
+        index = h >> (64 - self.precision)
+        remainder = (h << self.precision) & 0xFFFFFFFFFFFFFFFF
+        # The position of the leftmost 1 bit in the remaining 64 - precision bits:
+        rank = 65 - remainder.bit_length() if remainder else 65 - self.precision
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge HyperLogLogs with different precision')
+        for i, value in enumerate(other.registers):
+            if value > self.registers[i]:
+                self.registers[i] = value
+
+    def __len__(self):
+        return int(round(self.estimate()))
+
+    def estimate(self):
+        m = self.size
+        estimate = self.alpha * m * m / sum(2.0 ** -r for r in self.registers)
+
+        zeros = self.registers.count(b'\x00')
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities:
+            estimate = m * math.log(m / zeros)
+
+        return estimate
+
+
+class LogSummary(object):
+    """
+    Aggregates LogEntry rows into top paths, requests per interval, status ×
+    method counts and the number of distinct user-agents
+    """
+
+    #: Methods beyond this many distinct values are counted as OTHER so
+    #: garbage requests can't grow the table:
+    MAX_METHODS = 32
+
+    def __init__(self, top=100, bucket_size=60, include_query_string=False, capacity=None):
+        self.top = top
+        self.bucket_size = bucket_size
+        self.include_query_string = include_query_string
+
+        self.paths = SpaceSaving(capacity or max(1000, top * 10))
+        self.buckets = defaultdict(int)
+        self.status_methods = defaultdict(int)
+        self.methods = set()
+        self.user_agents = HyperLogLog()
+        self.count = 0
+
+    def add_rows(self, rows):
+        """Add rows with fields in LogEntry order"""
+
+        add_path = self.paths.add
+        add_user_agent = self.user_agents.add
+        buckets = self.buckets
+        status_methods = self.status_methods
+        bucket_size = self.bucket_size
+
+        for timestamp, method, status, path, query_string, user_agent in rows:
+            if self.include_query_string and query_string:
+                path = '%s?%s' % (path, query_string)
+
+            add_path(path)
+            buckets[int(timestamp // bucket_size) * bucket_size] += 1
+
+            if method not in self.methods:
+                if len(self.methods) < self.MAX_METHODS:
+                    self.methods.add(method)
+                else:
+                    method = 'OTHER'
+            status_methods[status, method] += 1
+
+            if user_agent:
+                add_user_agent(user_agent)
+
+        self.count += len(rows)
+
+    def write_paths(self, stream):
+        """Write the top paths as a weighted URL mix which http_bench can load"""
+
+        stream.write('# Top %d of %d requests; weights may be overestimated by up to the error\n'
+                     % (self.top, self.count))
+        stream.write('# weight\tpath\terror\n')
+        for path, count, error in self.paths.top(self.top):
+            stream.write('%d\t%s\t# %d\n' % (count, path, error) if error else '%d\t%s\n' % (count, path))
+
+    def write_time_buckets(self, stream):
+        stream.write('start\trequests\n')
+        for start in sorted(self.buckets):
+            stream.write('%s\t%d\n' % (time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(start)),
+                                       self.buckets[start]))
+
+    def write_status_methods(self, stream):
+        methods = sorted(set(method for status, method in self.status_methods))
+        stream.write('\t'.join(['status'] + methods) + '\n')
+        for status in sorted(set(status for status, method in self.status_methods)):
+            counts = [str(self.status_methods.get((status, method), 0)) for method in methods]
+            stream.write('\t'.join([str(status)] + counts) + '\n')
+
+    def write_user_agents(self, stream):
+        stream.write('requests\tdistinct_user_agents\n')
+        stream.write('%d\t%d\n' % (self.count, len(self.user_agents)))
@@ -0,0 +1,181 @@
+# encoding: utf-8
+"""
+Synthetic log corpus and parser benchmark covering every registered format
+
+Usage:
+
+    python -m webtoolbox.logs.benchmark --lines=100000
+    python -m webtoolbox.logs.benchmark --write-dir=corpus/
+
+The corpus is generated from a fixed seed so results are comparable between
+runs. Like a real log it covers a day with timestamps which are in order
+apart from a few seconds of jitter. Each format includes the awkward cases its parser has to handle, such
+as escaped quotes, missing sizes and noise lines. The files written with
+--write-dir can be fed to log_to_tsv or log_replay to benchmark the tools.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import io
+import json
+import os
+import random
+import sys
+import time
+
+from .formats import FORMATS, detect_format, get_format
+
+MONTHS = 'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()
+
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0 Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/119.0',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'curl/8.4.0',
+    'Agent with \\"escaped\\" quotes',
+]
+
+#: The first timestamp in each corpus, 2017-07-14 02:40:00 UTC:
+START_TIME = 1500000000
+
+#: Lines are logged when a request finishes so each timestamp may be up to
+# this many seconds earlier than the one before it:
+MAX_JITTER = 5
+
+IIS_FIELDS = ('date time s-ip cs-method cs-uri-stem cs-uri-query s-port cs-username c-ip'
+              ' cs(User-Agent) cs(Referer) sc-status sc-substatus sc-win32-status time-taken').split()
+
+
+def random_request(rng, timestamp):
+    method = rng.choice(('GET', 'GET', 'GET', 'POST', 'HEAD'))
+    path = '/%s/%d' % (rng.choice(('item', 'search', 'static', 'user')), rng.randint(1, 5000))
+    query = rng.choice(('', '', 'q=apple', 'page=2&sort=asc'))
+    status = rng.choice((200, 200, 200, 304, 404, 500))
+    size = '-' if status == 304 else str(rng.randint(0, 100000))
+    user_agent = rng.choice(USER_AGENTS)
+    return timestamp, method, path, query, status, size, user_agent
+
+
+def apache_time(timestamp):
+    t = time.gmtime(timestamp)
+    return '%02d/%s/%04d:%02d:%02d:%02d +0000' % (t.tm_mday, MONTHS[t.tm_mon - 1], t.tm_year,
+                                                  t.tm_hour, t.tm_min, t.tm_sec)
+
+
+def format_line(name, rng, timestamp):
+    timestamp, method, path, query, status, size, user_agent = random_request(rng, timestamp)
+    target = '%s?%s' % (path, query) if query else path
+
+    if name in ('common', 'combined', 'vhost_combined', 'nginx'):
+        line = '10.0.%d.%d - - [%s] "%s %s HTTP/1.1" %d %s' % (rng.randint(0, 255), rng.randint(0, 255),
+                                                              apache_time(timestamp), method, target,
+                                                              status, size)
+        if name != 'common':
+            line += ' "http://example.com/" "%s"' % user_agent
+        if name == 'nginx':
+            line += ' "-"'
+        if name == 'vhost_combined':
+            line = 'www.example.com:443 ' + line
+        return line
+    elif name == 'iis':
+        values = {
+            'date': time.strftime('%Y-%m-%d', time.gmtime(timestamp)),
+            'time': time.strftime('%H:%M:%S', time.gmtime(timestamp)),
+            'cs-method': method,
+            'cs-uri-stem': path,
+            'cs-uri-query': query or '-',
+            'sc-status': str(status),
+            'cs(User-Agent)': user_agent.replace(' ', '+').replace('\\"', ''),
+        }
+        return ' '.join(values.get(i, '-') for i in IIS_FIELDS)
+    elif name == 'json':
+        return json.dumps({
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp)),
+            'request_method': method, 'uri': path, 'args': query, 'status': status,
+            'body_bytes_sent': size, 'http_user_agent': user_agent,
+        }, sort_keys=True)
+    else:
+        raise ValueError('No corpus generator for %s' % name)
+
+
+def generate_corpus(name, count=10000, seed=0, noise_interval=1000):
+    """Return ``count`` lines in the named format, with noise lines mixed in"""
+
+    rng = random.Random(seed)
+    lines = []
+
+    if name == 'iis':
+        lines.extend(['#Software: Microsoft Internet Information Services 10.0',
+                      '#Version: 1.0',
+                      '#Date: 2017-07-14 00:00:00',
+                      '#Fields: %s' % ' '.join(IIS_FIELDS)])
+
+    for i in range(count):
+        if noise_interval and i % noise_interval == noise_interval - 1:
+            lines.append('this is not a log line')
+        else:
+            timestamp = START_TIME + 86400 * i // count - rng.randint(0, MAX_JITTER)
+            lines.append(format_line(name, rng, timestamp))
+
+    return lines
+
+
+def benchmark(name, lines, repeat=3):
+    """Return the detected format, the number of parsed rows and the best lines/second"""
+
+    detected = detect_format(lines)
+
+    best = None
+    for i in range(repeat):
+        log_format = get_format(name)
+        start = time.time()
+        rows = log_format.parse_lines(lines, log_noise=False)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return detected.name, len(rows), len(lines) / best if best else float('inf')
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the log format parsers on a synthetic corpus')
+    parser.add_argument('--lines', type=int, default=100000, help='Lines per format')
+    parser.add_argument('--repeat', type=int, default=3, help='Keep the best of this many runs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--write-dir', help='Write each corpus to FORMAT.log in this directory and exit')
+    parser.add_argument('formats', metavar='FORMAT', nargs='*', help='Formats to test (default: all)')
+    args = parser.parse_args()
+
+    names = args.formats or list(FORMATS)
+
+    if args.write_dir and not os.path.isdir(args.write_dir):
+        try:
+            os.makedirs(args.write_dir)
+        except OSError as exc:
+            parser.error("Unable to create %s: %s" % (args.write_dir, exc))
+
+    mismatched = False
+
+    for name in names:
+        lines = generate_corpus(name, count=args.lines, seed=args.seed)
+
+        if args.write_dir:
+            filename = os.path.join(args.write_dir, '%s.log' % name)
+            with io.open(filename, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            print('Wrote %d lines to %s' % (len(lines), filename))
+            continue
+
+        detected, parsed, rate = benchmark(name, lines, repeat=args.repeat)
+        mismatched = mismatched or detected != name
+
+        print('{0:16} detected as {1:16} {2:8d} of {3:8d} lines parsed {4:12,.0f} lines/sec'.format(
+              name, detected, parsed, len(lines), rate))
+
+    return 1 if mismatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
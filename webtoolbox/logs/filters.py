@@ -0,0 +1,89 @@
+# encoding: utf-8
+"""
+Time range and path filters which reject lines before they are parsed
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import re
+
+from .formats import parse_iso_time
+
+# Patterns using these, or lookarounds, only make sense against the path
+# itself so they can't be used to reject whole lines:
+ANCHORS_RE = re.compile(r'\^|\$|\\[AZbB]|\(\?[<=!]')
+
+
+def parse_time(value):
+    """
+    Convert a command-line time to a UTC timestamp
+
+    Accepts POSIX timestamps and ISO 8601 dates or times such as
+    ``2017-07-14``, ``2017-07-14 14:00`` or ``2017-07-14T14:00:00-04:00``.
+    Times without an offset are UTC, like the timestamps in LogEntry.
+    """
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    value = value.strip()
+
+    if len(value) == 10:
+        value += 'T00:00:00'
+    elif len(value) == 16 or (len(value) > 16 and value[16] in '+-Zz'):
+        value = value[:16] + ':00' + value[16:]
+
+    return parse_iso_time(value)
+
+
+class LogFilter(object):
+    """
+    Accepts entries from ``since`` (inclusive) until ``until`` (exclusive)
+    whose path matches ``path_re``
+
+    :meth:`accept_line` rejects most other lines using only the cheap
+    timestamp extraction provided by the format and, for patterns which
+    aren't anchored, a search of the raw line. :meth:`accept` makes the
+    exact check once the line has been parsed.
+    """
+
+    def __init__(self, since=None, until=None, path_re=None):
+        self.since = since
+        self.until = until
+        if path_re is not None and not hasattr(path_re, 'search'):
+            path_re = re.compile(path_re)
+        self.path_re = path_re
+
+        if self.path_re is not None and not ANCHORS_RE.search(self.path_re.pattern):
+            self.line_re = self.path_re
+        else:
+            self.line_re = None
+
+    def __bool__(self):
+        return self.since is not None or self.until is not None or self.path_re is not None
+
+    __nonzero__ = __bool__
+
+    def in_range(self, timestamp):
+        return ((self.since is None or timestamp >= self.since)
+                and (self.until is None or timestamp < self.until))
+
+    def accept_line(self, line, log_format):
+        if log_format.is_directive(line):
+            return True
+
+        if self.line_re is not None and not self.line_re.search(line):
+            return False
+
+        if self.since is not None or self.until is not None:
+            timestamp = log_format.line_timestamp(line)
+            if timestamp is not None and not self.in_range(timestamp):
+                return False
+
+        return True
+
+    def accept(self, row):
+        return self.in_range(row[0]) and (self.path_re is None or self.path_re.search(row[3]) is not None)
@@ -0,0 +1,505 @@
+# encoding: utf-8
+"""
+Webserver log formats
+
+Every format turns a line of text into a tuple with the fields of
+:class:`LogEntry` or returns None for lines it doesn't recognize. Formats
+register themselves by name so tools can offer them as choices and
+:func:`detect_format` can try each of them against the start of a log.
+
+Timestamps are POSIX timestamps in UTC: the offset in Apache-style logs is
+honored and IIS logs are always written in UTC.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import calendar
+import json
+import logging
+import re
+from collections import namedtuple, OrderedDict
+
+
+LogEntry = namedtuple('LogEntry', ['timestamp', 'method', 'status', 'path', 'query_string', 'user_agent'])
+
+MONTH_NAMES = {
+    'Jan': 1,
+    'Feb': 2,
+    'Mar': 3,
+    'Apr': 4,
+    'May': 5,
+    'Jun': 6,
+    'Jul': 7,
+    'Aug': 8,
+    'Sep': 9,
+    'Oct': 10,
+    'Nov': 11,
+    'Dec': 12
+}
+
+#: Registered formats in the order detect_format tries them:
+FORMATS = OrderedDict()
+
+#: Older names which are still accepted by get_format:
+ALIASES = {
+    'apache': 'combined',
+}
+
+#: Number of lines detect_format examines:
+DETECTION_LINES = 20
+
+_HOUR_CACHE = {}
+_OFFSET_CACHE = {}
+
+
+def hour_timestamp(year, month, day, hour):
+    """
+    Return the UTC timestamp for the start of an hour
+
+    Log lines arrive in roughly chronological order so nearly every line
+    hits the cache and avoids any date arithmetic.
+    """
+
+    key = (year, month, day, hour)
+
+    try:
+        return _HOUR_CACHE[key]
+    except KeyError:
+        if len(_HOUR_CACHE) > 4096:
+            _HOUR_CACHE.clear()
+        value = _HOUR_CACHE[key] = calendar.timegm((year, month, day, hour, 0, 0))
+        return value
+
+
+def utc_offset(offset):
+    """Convert a ±HHMM or ±HH:MM offset to seconds"""
+
+    try:
+        return _OFFSET_CACHE[offset]
+    except KeyError:
+        digits = offset.replace(':', '')
+        if len(digits) != 5 or digits[0] not in '+-' or not digits[1:].isdigit():
+            raise ValueError('Invalid UTC offset %r' % offset)
+        seconds = int(digits[1:3]) * 3600 + int(digits[3:5]) * 60
+        value = _OFFSET_CACHE[offset] = -seconds if digits[0] == '-' else seconds
+        return value
+
+
+def parse_apache_time(when):
+    """Convert ``10/Oct/2000:13:55:36 -0700`` to a UTC timestamp"""
+
+    if when[2] != '/' or when[6] != '/' or when[11] != ':':
+        raise ValueError('Invalid timestamp %r' % when)
+
+    return (hour_timestamp(int(when[7:11]), MONTH_NAMES[when[3:6]], int(when[0:2]), int(when[12:14]))
+            + int(when[15:17]) * 60 + int(when[18:20]) - utc_offset(when[21:].strip() or '+0000'))
+
+
+def parse_iso_time(when):
+    """Convert ``2000-10-10T13:55:36.123-07:00`` or ``2000-10-10 13:55:36Z`` to a UTC timestamp"""
+
+    if len(when) < 19 or when[4] != '-' or when[7] != '-' or when[10] not in 'T ':
+        raise ValueError('Invalid timestamp %r' % when)
+
+    timestamp = (hour_timestamp(int(when[0:4]), int(when[5:7]), int(when[8:10]), int(when[11:13]))
+                 + int(when[14:16]) * 60 + int(when[17:19]))
+
+    rest = when[19:]
+    if rest.startswith('.'):
+        digits = rest[1:].lstrip('0123456789')
+        timestamp += float('0' + rest[:len(rest) - len(digits)])
+        rest = digits
+
+    if rest and rest not in ('Z', 'z'):
+        timestamp -= utc_offset(rest)
+
+    return timestamp
+
+
+def split_query(target):
+    if '?' in target:
+        return target.split('?', 1)
+    return target, ''
+
+
+def register_format(cls):
+    """Class decorator which makes a format available by its ``name``"""
+
+    FORMATS[cls.name] = cls
+    return cls
+
+
+def get_format(name, **kwargs):
+    try:
+        return FORMATS[ALIASES.get(name, name)](**kwargs)
+    except KeyError:
+        raise ValueError('Unknown log format %r: expected one of %s' % (name, ', '.join(FORMATS)))
+
+
+def detect_format(lines):
+    """
+    Return an instance of the registered format which parses the most of the
+    provided lines
+
+    Formats which read directives, such as IIS ``#Fields`` headers, keep the
+    state from those lines so the returned instance is ready to parse the
+    rest of the file.
+    """
+
+    sample = [l for l in lines if l.strip()][:DETECTION_LINES]
+
+    best, best_count = None, 0
+
+    for cls in FORMATS.values():
+        log_format = cls()
+        count = len(log_format.parse_lines(sample, log_noise=False))
+        if count > best_count:
+            best, best_count = log_format, count
+
+    if best is None:
+        raise ValueError('Unable to detect the log format from %d lines' % len(sample))
+
+    logging.debug('Detected %s format (%d of %d lines parsed)', best.name, best_count, len(sample))
+
+    return best
+
+
+class LogFormat(object):
+    """
+    Base class for log formats
+
+    Subclasses implement :meth:`parse`. Formats are pickled when logs are
+    parsed in worker processes so any state must be plain data.
+    """
+
+    name = None
+    description = None
+
+    def parse(self, line):
+        """Return a LogEntry-ordered tuple or None if the line isn't recognized"""
+        raise NotImplementedError
+
+    def is_directive(self, line):
+        """True for lines which configure the parser rather than record a request"""
+        return False
+
+    def read_directives(self, text):
+        """
+        Apply the directives in a block of text without parsing its entries
+
+        Used with the start of a file so that a parser for any later part of
+        it, such as a byte range parsed by another process, uses the columns
+        declared in the header.
+        """
+
+    def line_timestamp(self, line):
+        """
+        Return the timestamp of a line without parsing the rest of it, or
+        None if the format can't do that cheaply
+        """
+        return None
+
+    def parse_lines(self, lines, label='', log_noise=True, log_filter=None):
+        """
+        Return a list of tuples for every line which could be parsed and, if
+        provided, is accepted by the :class:`~webtoolbox.logs.filters.LogFilter`
+        """
+
+        rows = []
+        append = rows.append
+        parse = self.parse
+
+        for line in lines:
+            if log_filter is not None and not log_filter.accept_line(line, self):
+                continue
+
+            row = parse(line)
+
+            if row is None:
+                if log_noise and line.strip():
+                    logging.debug('Skipping noise line in %s: %s', label, line.strip())
+                continue
+
+            if log_filter is not None and not log_filter.accept(row):
+                continue
+
+            append(row)
+
+        return rows
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.name)
+
+
+class ApacheFormat(LogFormat):
+    """
+    The family of formats derived from the NCSA common log format
+
+    Lines are split on their fixed delimiters, which is several times faster
+    than a regular expression. Anything unusual, such as escaped quotes in
+    a user-agent, falls back to the precompiled regular expression.
+    """
+
+    #: Space-separated fields before the timestamp:
+    prefix_fields = 3
+    #: Quoted fields after the response size:
+    quoted_fields = 0
+
+    def __init__(self):
+        self.separators = ('',) + (' ',) * (self.quoted_fields - 1) + ('',) if self.quoted_fields else ()
+
+        quoted = r'\s+"(?P<referer>(?:[^"\\]|\\.)*)"\s+"(?P<user_agent>(?:[^"\\]|\\.)*)"' if self.quoted_fields else ''
+        extra = r'(?:\s+"(?:[^"\\]|\\.)*")' * max(0, self.quoted_fields - 2)
+
+        self.regex = re.compile(r"""
+            ^
+            %s
+            (?P<client_ip>\S+)\s+
+            (?P<username>\S+)\s+
+            (?P<remote_user>\S+)\s+
+            \[(?P<timestamp>[^]]+)\]\s+
+            "(?P<method>\S+)\s+
+            (?P<target>\S+)
+            (?:\s+(?P<protocol>[^"]+))?"\s+
+            (?P<status>\d{3})\s+
+            (?P<response_bytes>\d+|-)
+            %s%s
+            \s*$
+        """ % (r'(?P<virtual_host>\S+)\s+' if self.prefix_fields > 3 else '', quoted, extra),
+            re.IGNORECASE | re.VERBOSE)
+
+    def parse(self, line):
+        try:
+            prefix, rest = line.split(' [', 1)
+            when, rest = rest.split('] "', 1)
+            request, rest = rest.split('" ', 1)
+            method, target, protocol = request.split(' ')
+        except ValueError:
+            return self.parse_regex(line)
+
+        fields = rest.rstrip('\r\n').split(' ', 2)
+        quoted = fields[2].split('"') if len(fields) == 3 else []
+
+        # The text between the quoted fields must be single spaces:
+        if (prefix.count(' ') != self.prefix_fields - 1 or len(fields) < 2
+                or tuple(quoted[::2]) != self.separators
+                or len(fields[0]) != 3 or not fields[0].isdigit()
+                or not (fields[1].isdigit() or fields[1] == '-')):
+            return self.parse_regex(line)
+
+        try:
+            timestamp = parse_apache_time(when)
+        except (KeyError, ValueError, IndexError):
+            return None
+
+        path, qs = split_query(target)
+
+        return (timestamp, method, int(fields[0]), path, qs, quoted[3] if self.quoted_fields else '')
+
+    def line_timestamp(self, line):
+        start = line.find(' [') + 2
+        end = line.find(']', start)
+
+        if start < 2 or end < 0:
+            return None
+
+        try:
+            return parse_apache_time(line[start:end])
+        except (KeyError, ValueError, IndexError):
+            return None
+
+    def parse_regex(self, line):
+        m = self.regex.match(line)
+
+        if not m:
+            return None
+
+        try:
+            timestamp = parse_apache_time(m.group('timestamp'))
+        except (KeyError, ValueError, IndexError):
+            return None
+
+        path, qs = split_query(m.group('target'))
+        user_agent = m.group('user_agent').replace('\\"', '"') if self.quoted_fields else ''
+
+        return (timestamp, m.group('method'), int(m.group('status')), path, qs, user_agent)
+
+
+@register_format
+class VirtualHostCombinedFormat(ApacheFormat):
+    name = 'vhost_combined'
+    description = 'Apache vhost_combined: %v:%p %h %l %u %t "%r" %>s %O "%{Referer}i" "%{User-Agent}i"'
+    prefix_fields = 4
+    quoted_fields = 2
+
+
+@register_format
+class NginxFormat(ApacheFormat):
+    name = 'nginx'
+    description = 'nginx main: combined followed by "$http_x_forwarded_for"'
+    quoted_fields = 3
+
+
+@register_format
+class CombinedFormat(ApacheFormat):
+    name = 'combined'
+    description = 'Apache or nginx combined: %h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i"'
+    quoted_fields = 2
+
+
+@register_format
+class CommonFormat(ApacheFormat):
+    name = 'common'
+    description = 'NCSA common: %h %l %u %t "%r" %>s %b'
+
+
+@register_format
+class IISFormat(LogFormat):
+    """
+    W3C extended logs as written by IIS
+
+    The columns are read from each ``#Fields:`` directive. Logs which
+    don't have one are assumed to use :attr:`DEFAULT_FIELDS`.
+    """
+
+    name = 'iis'
+    description = 'IIS W3C extended, using the #Fields directive'
+
+    DEFAULT_FIELDS = ('date time c-ip cs-username s-ip s-port cs-method cs-uri-stem cs-uri-query'
+                      ' sc-status sc-bytes cs-bytes cs(User-Agent) cs(Referer)').split()
+
+    REQUIRED_FIELDS = ('date', 'time', 'cs-method', 'cs-uri-stem', 'sc-status')
+
+    def __init__(self, fields=None):
+        self.set_fields(fields or self.DEFAULT_FIELDS)
+
+    def set_fields(self, fields):
+        fields = [i.lower() for i in fields]
+
+        missing = [i for i in self.REQUIRED_FIELDS if i not in fields]
+        if missing:
+            raise ValueError('IIS log fields do not include %s' % ', '.join(missing))
+
+        self.fields = fields
+        self.field_count = len(fields)
+        self.indexes = tuple(fields.index(i) if i in fields else None
+                             for i in ('date', 'time', 'cs-method', 'cs-uri-stem', 'cs-uri-query',
+                                       'sc-status', 'cs(user-agent)'))
+
+    def is_directive(self, line):
+        return line.startswith('#')
+
+    def read_directives(self, text):
+        if text.startswith('#') or '\n#' in text:
+            for line in text.split('\n'):
+                if line.startswith('#'):
+                    self.parse(line)
+
+    def line_timestamp(self, line):
+        date_index, time_index = self.indexes[:2]
+        values = line.split(None, max(date_index, time_index) + 1)
+
+        try:
+            date, time = values[date_index], values[time_index]
+            return (hour_timestamp(int(date[0:4]), int(date[5:7]), int(date[8:10]), int(time[0:2]))
+                    + int(time[3:5]) * 60 + int(time[6:8]))
+        except (IndexError, ValueError):
+            return None
+
+    def parse(self, line):
+        if line.startswith('#'):
+            if line.startswith('#Fields:'):
+                try:
+                    self.set_fields(line[8:].split())
+                except ValueError as exc:
+                    logging.warning('Ignoring IIS directive %r: %s', line.strip(), exc)
+            return None
+
+        values = line.split()
+
+        if len(values) != self.field_count:
+            return None
+
+        date, time, method, stem, query, status, user_agent = [values[i] if i is not None else '-'
+                                                               for i in self.indexes]
+
+        if len(status) != 3 or not status.isdigit() or len(date) != 10 or len(time) < 8:
+            return None
+
+        try:
+            timestamp = (hour_timestamp(int(date[0:4]), int(date[5:7]), int(date[8:10]), int(time[0:2]))
+                         + int(time[3:5]) * 60 + int(time[6:8]))
+        except ValueError:
+            return None
+
+        return (timestamp, method, int(status), stem,
+                '' if query == '-' else query,
+                '' if user_agent == '-' else user_agent)
+
+
+@register_format
+class JSONFormat(LogFormat):
+    """
+    One JSON object per line, as produced by nginx ``escape=json`` formats,
+    Caddy and most log shippers
+
+    Each field is read from the first of several common key names. The
+    timestamp may be a number, an ISO 8601 string or an Apache-style string.
+    """
+
+    name = 'json'
+    description = 'One JSON object per line'
+
+    KEYS = {
+        'timestamp': ('timestamp', 'time', '@timestamp', 'ts', 'time_iso8601', 'time_local'),
+        'method': ('method', 'request_method', 'verb'),
+        'path': ('path', 'uri', 'request_uri', 'url'),
+        'query_string': ('query_string', 'args', 'query'),
+        'status': ('status', 'status_code', 'response'),
+        'user_agent': ('user_agent', 'http_user_agent', 'agent', 'userAgent'),
+        'request': ('request',),
+    }
+
+    def __init__(self, keys=None):
+        self.keys = dict(self.KEYS, **(keys or {}))
+
+    def get(self, data, field):
+        for key in self.keys[field]:
+            value = data.get(key)
+            if value is not None:
+                return value
+        return None
+
+    def parse(self, line):
+        if not line.startswith('{'):
+            return None
+
+        try:
+            data = json.loads(line)
+            when = self.get(data, 'timestamp')
+            status = int(self.get(data, 'status'))
+
+            if isinstance(when, (int, float)):
+                # Milliseconds since the epoch are common from JavaScript loggers:
+                timestamp = when / 1000 if when > 1e11 else when
+            elif '/' in when:
+                timestamp = parse_apache_time(when)
+            else:
+                timestamp = parse_iso_time(when)
+        except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+            return None
+
+        method = self.get(data, 'method')
+        target = self.get(data, 'path')
+
+        if target is None or method is None:
+            request = (self.get(data, 'request') or '').split(' ')
+            if len(request) < 2:
+                return None
+            method, target = request[0], request[1]
+
+        path, qs = split_query(target)
+        qs = self.get(data, 'query_string') or qs
+
+        return (timestamp, method, status, path, qs.lstrip('?'), self.get(data, 'user_agent') or '')
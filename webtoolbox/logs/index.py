@@ -0,0 +1,162 @@
+# encoding: utf-8
+"""
+Sparse byte offset → timestamp index for uncompressed logs
+
+The index records the timestamp of the first line after every ``interval``
+bytes. Building it only reads a few lines per interval so even very large
+logs are indexed in seconds. It is saved beside the log as ``LOG.tsidx`` and
+rebuilt whenever the log's size or modification time changes.
+
+Log lines are usually written when a request finishes rather than when it
+starts, so timestamps are only roughly in order. :meth:`TimestampIndex.byte_range`
+widens the requested range by ``slack`` seconds to allow for that and the
+caller must still check the timestamp of each line. If the sampled
+timestamps go backwards by more than ``slack`` the log isn't ordered well
+enough to skip any of it and the whole file is read.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import io
+import json
+import logging
+import os
+from bisect import bisect_left, bisect_right
+
+DEFAULT_INTERVAL = 1024 * 1024
+
+#: Allow for lines which are this many seconds out of order:
+DEFAULT_SLACK = 300
+
+#: Give up looking for a timestamp after this many lines in an interval:
+MAX_PROBE_LINES = 64
+
+
+class TimestampIndex(object):
+    SUFFIX = '.tsidx'
+    VERSION = 2
+
+    def __init__(self, log_filename, entries, size, mtime, interval=DEFAULT_INTERVAL):
+        self.log_filename = log_filename
+        self.entries = entries
+        self.size = size
+        self.mtime = mtime
+        self.interval = interval
+
+        timestamps = [ts for offset, ts in entries]
+
+        # Running bounds make the timestamps monotonic so they can be searched
+        # with bisect even though the log is only roughly in order:
+        self.prefix_max = []
+        for ts in timestamps:
+            self.prefix_max.append(max(ts, self.prefix_max[-1]) if self.prefix_max else ts)
+
+        self.suffix_min = []
+        for ts in reversed(timestamps):
+            self.suffix_min.append(min(ts, self.suffix_min[-1]) if self.suffix_min else ts)
+        self.suffix_min.reverse()
+
+        #: The most seconds any sampled timestamp is earlier than one before it:
+        self.disorder = max([peak - ts for peak, ts in zip(self.prefix_max, timestamps)] or [0])
+
+    @property
+    def index_filename(self):
+        return self.log_filename + self.SUFFIX
+
+    @classmethod
+    def build(cls, log_filename, log_format, interval=DEFAULT_INTERVAL):
+        stat = os.stat(log_filename)
+        entries = []
+
+        with io.open(log_filename, mode='rb') as f:
+            for offset in range(0, stat.st_size, interval):
+                f.seek(offset)
+                if offset:
+                    # Skip the rest of the line which spans the boundary:
+                    f.readline()
+
+                for i in range(MAX_PROBE_LINES):
+                    line_offset = f.tell()
+                    if line_offset >= stat.st_size or (entries and line_offset <= entries[-1][0]):
+                        break
+
+                    timestamp = log_format.line_timestamp(f.readline().decode('utf-8', 'replace'))
+                    if timestamp is not None:
+                        entries.append((line_offset, timestamp))
+                        break
+
+        logging.debug('Indexed %s with %d entries', log_filename, len(entries))
+
+        return cls(log_filename, entries, stat.st_size, stat.st_mtime, interval=interval)
+
+    @classmethod
+    def load(cls, log_filename):
+        """Return the saved index or None if it's missing or out of date"""
+
+        try:
+            with io.open(log_filename + cls.SUFFIX, encoding='utf-8') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        stat = os.stat(log_filename)
+
+        if (data.get('version') != cls.VERSION or data.get('size') != stat.st_size
+                or data.get('mtime') != stat.st_mtime):
+            return None
+
+        return cls(log_filename, [tuple(i) for i in data['entries']], data['size'], data['mtime'],
+                   interval=data['interval'])
+
+    @classmethod
+    def load_or_build(cls, log_filename, log_format, interval=DEFAULT_INTERVAL, save=True):
+        index = cls.load(log_filename)
+
+        if index is None:
+            index = cls.build(log_filename, log_format, interval=interval)
+
+            if save:
+                try:
+                    index.save()
+                except (IOError, OSError) as exc:
+                    logging.warning('Unable to save %s: %s', index.index_filename, exc)
+
+        return index
+
+    def save(self):
+        data = json.dumps({'version': self.VERSION, 'size': self.size, 'mtime': self.mtime,
+                           'interval': self.interval, 'entries': self.entries})
+
+        temp_filename = '%s.tmp' % self.index_filename
+        with io.open(temp_filename, 'w', encoding='utf-8') as f:
+            f.write(data if not isinstance(data, bytes) else data.decode('utf-8'))
+        os.rename(temp_filename, self.index_filename)
+
+    def byte_range(self, since=None, until=None, slack=DEFAULT_SLACK):
+        """Return (start, end) byte offsets which contain every line in the time range"""
+
+        start, end = 0, self.size
+
+        if not self.entries:
+            return start, end
+
+        if self.disorder > slack:
+            logging.warning('%s is out of order by up to %d seconds, more than the %d allowed:'
+                            ' reading the whole file', self.log_filename, self.disorder, slack)
+            return start, end
+
+        if since is not None:
+            # Every entry before i is more than slack seconds earlier than since
+            # but lines between entry i - 1 and entry i may not be:
+            i = bisect_left(self.prefix_max, since - slack)
+            if i > 0:
+                start = self.entries[i - 1][0]
+
+        if until is not None:
+            # Every line from entry j onwards is after the end of the range:
+            j = bisect_right(self.suffix_min, until + slack)
+            if j < len(self.entries):
+                end = self.entries[j][0]
+
+        return start, max(start, end)
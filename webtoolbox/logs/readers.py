@@ -0,0 +1,282 @@
+# encoding: utf-8
+"""
+Streaming readers for plain and compressed logs
+
+The compression is identified from the first bytes of the file rather than
+the filename so logs piped to stdin (``-``) are handled the same way as files
+on disk. gzip, bzip2 and ZIP archives are always supported; xz needs the
+``lzma`` module and Zstandard needs the ``zstandard`` package. Concatenated
+streams, such as the output of ``pigz`` or ``cat a.gz b.gz``, and every
+member of a ZIP archive are read in turn.
+
+Data is read in large blocks which always end on a line boundary. With
+``threaded=True`` the reading and decompression happen on a background
+thread which stays up to ``queue_size`` blocks ahead of the consumer. zlib,
+bz2 and lzma release the GIL while they work, so parsing and decompression
+overlap.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import bz2
+import io
+import logging
+import sys
+import threading
+import zipfile
+import zlib
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+MAGIC_NUMBERS = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'PK\x03\x04', 'zip'),
+)
+
+
+def open_binary(filename):
+    """Open a file, or stdin for ``-``, as a buffered binary stream which supports peek()"""
+
+    if filename == '-':
+        return io.open(sys.stdin.fileno(), mode='rb', closefd=False)
+    else:
+        return io.open(filename, mode='rb')
+
+
+def detect_compression(raw):
+    """Return the compression used by a stream without consuming any of it"""
+
+    head = raw.peek(8)[:8]
+
+    for magic, name in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return name
+
+    return None
+
+
+def is_splittable(filename):
+    """True if the file can be read in independent byte ranges"""
+
+    if filename == '-':
+        return False
+
+    with open_binary(filename) as raw:
+        return detect_compression(raw) is None
+
+
+def decompress_stream(raw, make_decompressor, block_size=DEFAULT_BLOCK_SIZE):
+    """Yield decompressed data from every concatenated stream in raw"""
+
+    decompressor = make_decompressor()
+
+    while True:
+        data = raw.read(block_size)
+        if not data:
+            break
+
+        while data:
+            output = decompressor.decompress(data)
+            if output:
+                yield output
+
+            # unused_data is only set once a stream has ended:
+            data = decompressor.unused_data
+            if data:
+                decompressor = make_decompressor()
+
+
+def read_stream(raw, block_size=DEFAULT_BLOCK_SIZE, length=None):
+    while length is None or length > 0:
+        data = raw.read(block_size if length is None else min(block_size, length))
+        if not data:
+            break
+        if length is not None:
+            length -= len(data)
+        yield data
+
+
+class LogReader(object):
+    """
+    Reads a log as decoded text blocks or lines
+
+    Use :meth:`iter_blocks` to hand large pieces of text to worker
+    processes or :meth:`iter_lines` to process one line at a time. With
+    ``members=True`` :meth:`iter_blocks` yields (member, block) pairs, where
+    member is the name of the ZIP archive member the block came from or
+    None, because each member may be a log in a different format.
+
+    Uncompressed files can be limited to the bytes from ``start`` to
+    ``end``, which should be line boundaries such as those returned by
+    :meth:`webtoolbox.logs.index.TimestampIndex.byte_range`.
+    """
+
+    def __init__(self, filename, block_size=DEFAULT_BLOCK_SIZE, threaded=True, queue_size=8,
+                 encoding='utf-8', start=0, end=None):
+        self.filename = filename
+        self.start = start
+        self.end = end
+        self.block_size = block_size
+        self.threaded = threaded
+        self.queue_size = queue_size
+        self.encoding = encoding
+        self.compression = None
+        #: The ZIP archive member being read:
+        self.member = None
+
+    def iter_chunks(self):
+        """Yield decompressed byte strings of arbitrary length from every member"""
+
+        with open_binary(self.filename) as raw:
+            self.compression = compression = detect_compression(raw)
+
+            if (self.start or self.end is not None) and compression is not None:
+                raise ValueError('Only uncompressed files can be read from an offset')
+
+            if compression is None:
+                if self.start:
+                    raw.seek(self.start)
+                length = self.end - self.start if self.end is not None else None
+                chunks = read_stream(raw, self.block_size, length)
+            elif compression == 'gzip':
+                # 32 + MAX_WBITS accepts both gzip and zlib headers:
+                chunks = decompress_stream(raw, lambda: zlib.decompressobj(32 + zlib.MAX_WBITS), self.block_size)
+            elif compression == 'bz2':
+                chunks = decompress_stream(raw, bz2.BZ2Decompressor, self.block_size)
+            elif compression == 'xz':
+                if lzma is None:
+                    raise IOError('%s is xz-compressed but the lzma module is not available' % self.filename)
+                chunks = decompress_stream(raw, lzma.LZMADecompressor, self.block_size)
+            elif compression == 'zstd':
+                if zstandard is None:
+                    raise IOError('%s is Zstandard-compressed: pip install zstandard' % self.filename)
+                reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+                chunks = read_stream(reader, self.block_size)
+            else:
+                chunks = self.iter_zip_members(raw)
+
+            for chunk in chunks:
+                yield chunk
+
+    def iter_zip_members(self, raw):
+        if not raw.seekable():
+            logging.info('Buffering %s in memory to read the ZIP directory', self.filename)
+            raw = io.BytesIO(raw.read())
+
+        with zipfile.ZipFile(raw) as archive:
+            for info in archive.infolist():
+                if info.filename.endswith('/'):
+                    continue
+
+                logging.debug('Reading %s from %s', info.filename, self.filename)
+                self.member = info.filename
+
+                with archive.open(info) as member:
+                    for chunk in read_stream(member, self.block_size):
+                        yield chunk
+
+                # Members are independent files so they must not share a partial line:
+                yield None
+
+    def read_blocks(self, members=False):
+        """Yield decoded text blocks which each end at the end of a line"""
+
+        # iter_chunks runs on this thread so self.member is the member each
+        # block came from, including the last block of a member when the
+        # end-of-member marker arrives:
+        for block in self._read_blocks():
+            yield (self.member, block) if members else block
+
+    def _read_blocks(self):
+        pending = []
+        pending_size = 0
+
+        for chunk in self.iter_chunks():
+            if chunk is None:
+                if pending:
+                    yield b''.join(pending).decode(self.encoding, 'replace')
+                pending, pending_size = [], 0
+                continue
+
+            pending.append(chunk)
+            pending_size += len(chunk)
+
+            if pending_size < self.block_size:
+                continue
+
+            data = b''.join(pending)
+            end = data.rfind(b'\n') + 1
+
+            if not end:
+                # A single line longer than the block size:
+                pending, pending_size = [data], len(data)
+                continue
+
+            yield data[:end].decode(self.encoding, 'replace')
+
+            remainder = data[end:]
+            pending, pending_size = ([remainder], len(remainder)) if remainder else ([], 0)
+
+        if pending:
+            yield b''.join(pending).decode(self.encoding, 'replace')
+
+    def iter_blocks(self, members=False):
+        if not self.threaded:
+            for block in self.read_blocks(members):
+                yield block
+            return
+
+        queue = Queue(maxsize=self.queue_size)
+        finished = object()
+
+        def produce():
+            try:
+                for block in self.read_blocks(members):
+                    queue.put(block)
+            except Exception as exc:
+                queue.put(exc)
+            queue.put(finished)
+
+        thread = threading.Thread(target=produce, name='LogReader(%s)' % self.filename)
+        # The consumer may stop early, leaving the thread blocked on a full queue:
+        thread.daemon = True
+        thread.start()
+
+        while True:
+            block = queue.get()
+            if block is finished:
+                break
+            elif isinstance(block, Exception):
+                raise block
+            yield block
+
+    def iter_lines(self):
+        for block in self.iter_blocks():
+            lines = block.split('\n')
+            if not lines[-1]:
+                lines.pop()
+            for line in lines:
+                yield line
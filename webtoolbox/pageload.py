@@ -0,0 +1,213 @@
+# encoding: utf-8
+"""
+Headless page loads which fetch subresources the way a browser does
+
+:class:`PageLoader` retrieves an HTML page and then, concurrently, everything
+needed to display it: stylesheets, scripts, images and other media, frames
+and the ``@import`` and ``url()`` references in stylesheets and ``<style>``
+elements, using up to ``pool_size`` (6 by default, like browsers)
+connections to each host. A page has finished loading once every resource
+has been retrieved, which corresponds to WebKit's ``didFinishLoadForFrame``
+for the main frame.
+
+Unlike a browser no JavaScript is run, so resources which scripts would load
+aren't retrieved, and every ``url()`` in a stylesheet is retrieved whether or
+not any element uses it. Each load starts with an empty cache but
+connections are reused between pages, as a browser would.
+
+The loader uses blocking sockets and greenlets, so
+``gevent.monkey.patch_all()`` must be called before it's used.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import re
+import time
+
+try:
+    from urllib.parse import urljoin
+except ImportError:
+    from urlparse import urljoin
+
+import gevent.pool
+import lxml.etree
+import lxml.html
+
+from webtoolbox.client import HTTPClient, RequestError, Request, Response
+from webtoolbox.pageweight import find_subresources
+
+CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.DOTALL)
+CSS_IMPORT_RE = re.compile(r"""@import\s+(?:url\(\s*)?(['"]?)([^'")\s;]+)\1""", re.IGNORECASE)
+CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)([^'")]+?)\1\s*\)""", re.IGNORECASE)
+
+
+def find_css_references(css, base_url):
+    """Return (url, kind) for every @import and url() in a stylesheet"""
+
+    css = CSS_COMMENT_RE.sub("", css)
+    references = []
+    imports = set()
+
+    for match in CSS_IMPORT_RE.finditer(css):
+        url = urljoin(base_url, match.group(2).strip())
+        imports.add(url)
+        references.append((url, "stylesheet"))
+
+    for match in CSS_URL_RE.finditer(css):
+        url = urljoin(base_url, match.group(2).strip())
+        if url not in imports:
+            references.append((url, "media"))
+
+    return [(url, kind) for url, kind in references if url.startswith(("http:", "https:"))]
+
+
+class ResourceLoad(object):
+    """Timing for one resource, in seconds since the page load started"""
+
+    __slots__ = ("url", "kind", "status_code", "start", "end", "size", "error")
+
+    def __init__(self, url, kind, start):
+        self.url = url
+        self.kind = kind
+        self.start = start
+        self.end = None
+        self.status_code = None
+        self.size = 0
+        self.error = None
+
+    def __repr__(self):
+        return "<ResourceLoad %s %s %s %0.3f-%0.3f>" % (self.kind, self.status_code, self.url,
+                                                       self.start, self.end or 0)
+
+
+class PageLoad(object):
+    """The result of :meth:`PageLoader.load`"""
+
+    def __init__(self, url):
+        self.url = url
+        self.start_time = time.time()
+        #: Seconds until the page and every resource had been retrieved:
+        self.elapsed = None
+        self.resources = []
+
+    @property
+    def document(self):
+        return self.resources[0] if self.resources else None
+
+    @property
+    def ok(self):
+        document = self.document
+        return document is not None and document.error is None and 200 <= (document.status_code or 0) < 400
+
+    @property
+    def errors(self):
+        return [i for i in self.resources if i.error is not None]
+
+    @property
+    def size(self):
+        return sum(i.size for i in self.resources)
+
+
+class PageLoader(object):
+    """
+    Loads pages and their subresources using a shared :class:`webtoolbox.client.HTTPClient`
+
+    :param max_frame_depth: how deeply nested frames and iframes are loaded
+    :param client_options: keyword arguments for the HTTPClient
+    """
+
+    def __init__(self, timeout=30, max_frame_depth=2, max_redirects=5, **client_options):
+        self.log = logging.getLogger("webtoolbox.pageload")
+        self.max_frame_depth = max_frame_depth
+        self.client = HTTPClient(timeout=timeout, max_redirects=max_redirects, **client_options)
+
+    def close(self):
+        self.client.close()
+
+    def load(self, url):
+        """Retrieve a page and all of its resources and return a :class:`PageLoad`"""
+
+        page = PageLoad(url)
+        seen = set([url])
+        group = gevent.pool.Group()
+
+        self.load_resource(page, group, seen, url, "document", 0)
+        group.join()
+
+        page.elapsed = time.time() - page.start_time
+
+        return page
+
+    def fetch(self, page, url, kind):
+        resource = ResourceLoad(url, kind, time.time() - page.start_time)
+        page.resources.append(resource)
+
+        try:
+            response = self.client.send(Request("GET", url))
+        except RequestError as exc:
+            response = Response(Request("GET", url), error=exc)
+
+        resource.end = time.time() - page.start_time
+        resource.status_code = response.status_code
+        resource.size = response.transfer_size
+
+        if response.error is not None:
+            resource.error = str(response.error)
+        elif not response.ok:
+            resource.error = "HTTP %s" % response.status_code
+
+        if resource.error:
+            self.log.warning("Unable to load %s %s: %s", kind, url, resource.error)
+        else:
+            self.log.debug("Loaded %s %s in %0.3f seconds", kind, url, resource.end - resource.start)
+
+        return response
+
+    def load_resource(self, page, group, seen, url, kind, depth):
+        response = self.fetch(page, url, kind)
+
+        if not response.ok:
+            return
+
+        content_type = response.headers.get("Content-Type", "").lower()
+
+        if kind == "document" and content_type.startswith(("text/html", "application/xhtml")):
+            references = self.find_html_references(response, depth)
+        elif kind == "stylesheet" or content_type.startswith("text/css"):
+            references = find_css_references(response.content.decode("utf-8", "replace"), response.url)
+        else:
+            return
+
+        for ref_url, ref_kind in references:
+            if ref_url in seen:
+                continue
+            seen.add(ref_url)
+            group.spawn(self.load_resource, page, group, seen, ref_url, ref_kind,
+                        depth + 1 if ref_kind == "document" else depth)
+
+    def find_html_references(self, response, depth):
+        try:
+            tree = lxml.html.document_fromstring(response.content)
+        except (ValueError, lxml.etree.ParserError) as exc:
+            self.log.warning("Unable to parse %s: %s", response.url, exc)
+            return []
+
+        tree.make_links_absolute(response.url, resolve_base_href=True)
+
+        references = [(i.url, i.kind) for i in find_subresources(tree)]
+
+        if depth < self.max_frame_depth:
+            for element in tree.iter("frame", "iframe"):
+                src = element.get("src")
+                if src and src.startswith(("http:", "https:")):
+                    references.append((src.split("#", 1)[0], "document"))
+
+        for style in tree.iter("style"):
+            references.extend(find_css_references(style.text or "", response.url))
+
+        for element in tree.xpath("//*[@style]"):
+            references.extend(find_css_references(element.get("style"), response.url))
+
+        return references
@@ -0,0 +1,308 @@
+# encoding: utf-8
+"""
+Page weight and load time estimates from the data collected by a crawl
+
+:class:`PageWeightAnalysis` records the size and server response time of
+every URL the spider retrieves and the subresources each page references.
+Once the crawl has finished it estimates how each page would load over a
+:class:`NetworkProfile` without making any further requests:
+
+#. The HTML is requested on a new connection
+#. Once the HTML has arrived, every subresource is requested, with the
+   render-blocking stylesheets and scripts in ``<head>`` first, using up to
+   ``connections_per_host`` connections to each host
+#. Each request waits for one round trip plus the server time the crawl
+   measured, then shares the available bandwidth with the other downloads
+
+Rendering can start once the HTML and the blocking resources have arrived
+and the page has loaded once everything has. The model ignores TCP slow
+start, script execution and resources referenced from CSS, so the
+estimates are best used to compare pages and track changes over time.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import re
+from collections import namedtuple
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+from webtoolbox.audit import format_bytes
+from webtoolbox.urls import URLCanonicalizer
+
+
+class NetworkProfile(namedtuple("NetworkProfile", "name bandwidth rtt connections_per_host")):
+    """
+    ``bandwidth`` is in bytes per second and ``rtt`` is in seconds
+    """
+
+    @classmethod
+    def parse(cls, value):
+        """Return a profile from :data:`NETWORK_PROFILES` or a KBITS_PER_SECOND/RTT_MS string"""
+
+        if value in NETWORK_PROFILES:
+            return NETWORK_PROFILES[value]
+
+        match = re.match(r"^(\d+(?:\.\d+)?)/(\d+(?:\.\d+)?)$", value)
+        if not match:
+            raise ValueError("Network profiles must be one of %s or KBITS_PER_SECOND/RTT_MS, not %r"
+                             % (", ".join(sorted(NETWORK_PROFILES)), value))
+
+        return cls(value, float(match.group(1)) * 1000 / 8, float(match.group(2)) / 1000, 6)
+
+
+NETWORK_PROFILES = dict((profile.name, profile) for profile in (
+    NetworkProfile("3g", 1600 * 1000 / 8, 0.3, 6),
+    NetworkProfile("4g", 9000 * 1000 / 8, 0.17, 6),
+    NetworkProfile("cable", 5000 * 1000 / 8, 0.028, 6),
+    NetworkProfile("fiber", 100000 * 1000 / 8, 0.005, 6),
+))
+
+
+Subresource = namedtuple("Subresource", "url kind blocking")
+
+
+PageWeight = namedtuple("PageWeight", "url requests bytes unmeasured blocking_requests blocking_bytes "
+                                      "start_render load_time")
+
+
+def find_subresources(tree, canonicalizer=None):
+    """
+    Return the Subresources an lxml tree with absolute links would load, in document order
+
+    Links are passed through ``canonicalizer`` so they match the URLs the
+    spider requested.
+    """
+
+    resources = []
+    seen = set()
+
+    for element, attribute, link, pos in tree.iterlinks():
+        tag = element.tag
+        in_head = any(True for i in element.iterancestors("head"))
+
+        if tag == "link":
+            rel = (element.get("rel") or "").lower().split()
+            if "stylesheet" in rel:
+                kind = "stylesheet"
+                blocking = in_head and (element.get("media") or "all").lower() not in ("print", "speech")
+            elif "icon" in rel or "preload" in rel:
+                kind = "other"
+                blocking = False
+            else:
+                # Links to other documents such as rel=canonical aren't loaded:
+                continue
+        elif tag == "script" and attribute == "src":
+            kind = "script"
+            blocking = (in_head and element.get("async") is None and element.get("defer") is None
+                        and (element.get("type") or "").lower() != "module")
+        elif tag in ("img", "embed", "object", "audio", "video", "source", "input") and attribute != "href":
+            kind = "media"
+            blocking = False
+        else:
+            continue
+
+        link = canonicalizer(link) if canonicalizer is not None else link.split("#", 1)[0]
+        if not link.startswith(("http:", "https:")) or link in seen:
+            continue
+
+        seen.add(link)
+        resources.append(Subresource(link, kind, blocking))
+
+    return resources
+
+
+def connection_time(url, profile):
+    """DNS, TCP and, for https, a TLS handshake on a new connection"""
+    return profile.rtt * (4 if url.startswith("https:") else 2)
+
+
+def simulate(requests, profile, start=0.0, connections=None):
+    """
+    Return the finish time of each request
+
+    ``requests`` is a list of (url, size, server_time) in the order the
+    browser would send them. Requests wait for a free connection to their
+    host, then for a round trip and the server time, and then share the
+    bandwidth equally with every other download in progress.
+
+    ``connections`` maps hosts to the number of connections which are
+    already open. It's updated so it can be passed to the next call.
+    """
+
+    finish = [None] * len(requests)
+    hosts = [urlsplit(url).netloc for url, size, server_time in requests]
+
+    if connections is None:
+        connections = {}
+    # Every connection is idle at the start:
+    idle = dict(connections)
+    pending = list(range(len(requests)))
+    waiting = {}            # request index -> time its first byte arrives
+    downloading = {}        # request index -> bytes remaining
+    now = start
+
+    while pending or waiting or downloading:
+        for i in list(pending):
+            host = hosts[i]
+            url, size, server_time = requests[i]
+
+            if idle.get(host):
+                idle[host] -= 1
+                setup = 0
+            elif connections.get(host, 0) < profile.connections_per_host:
+                connections[host] = connections.get(host, 0) + 1
+                setup = connection_time(url, profile)
+            else:
+                continue
+
+            pending.remove(i)
+            waiting[i] = now + setup + profile.rtt + (server_time or 0)
+
+        share = profile.bandwidth / len(downloading) if downloading else 0
+
+        next_event = min(list(waiting.values())
+                         + [now + remaining / share for remaining in downloading.values()])
+        elapsed = next_event - now
+        now = next_event
+
+        for i in list(downloading):
+            downloading[i] -= share * elapsed
+            if downloading[i] <= 1e-6:
+                del downloading[i]
+                finish[i] = now
+                idle[hosts[i]] = idle.get(hosts[i], 0) + 1
+
+        for i, first_byte in list(waiting.items()):
+            if first_byte <= now:
+                del waiting[i]
+                if requests[i][1]:
+                    downloading[i] = requests[i][1]
+                else:
+                    finish[i] = now
+                    idle[hosts[i]] = idle.get(hosts[i], 0) + 1
+
+    return finish
+
+
+class PageWeightAnalysis(object):
+    """
+    Collects sizes and page structure during a crawl
+
+    Install :meth:`process_response` in
+    :attr:`webtoolbox.spider.Spider.response_processors` and
+    :meth:`process_tree` in :attr:`webtoolbox.spider.Spider.tree_processors`,
+    then call :meth:`analyze` when the crawl has finished.
+
+    ``canonicalizer`` should be the spider's so subresource links are
+    matched with the URLs it retrieved.
+    """
+
+    def __init__(self, profile=NETWORK_PROFILES["3g"], canonicalizer=None):
+        self.profile = profile
+        self.canonicalizer = canonicalizer if canonicalizer is not None else URLCanonicalizer()
+
+        #: URL → (bytes transferred, server time in seconds):
+        self.sizes = {}
+        #: Page URL → list of Subresources:
+        self.pages = {}
+
+    def process_response(self, request, response):
+        if response.status_code != 200:
+            return
+
+        server_time = response.timings.ttfb if response.timings is not None else None
+        self.sizes[response.url] = (response.transfer_size or len(response.content or b""), server_time)
+
+    def process_tree(self, url, tree):
+        self.pages[url] = find_subresources(tree, self.canonicalizer)
+
+    def merge(self, other):
+        """Add another analysis's response sizes and the subresources of its pages"""
+
+        self.sizes.update(other.sizes)
+        self.pages.update(other.pages)
+
+    def analyze_page(self, url):
+        resources = self.pages[url]
+
+        page_size, page_server_time = self.sizes.get(url, (0, None))
+        connections = {}
+        html_done = simulate([(url, page_size, page_server_time)], self.profile, connections=connections)[0]
+
+        # Blocking resources are requested first since browsers give them the highest priority:
+        ordered = [r for r in resources if r.blocking] + [r for r in resources if not r.blocking]
+
+        requests = []
+        unmeasured = 0
+        for resource in ordered:
+            size, server_time = self.sizes.get(resource.url, (None, None))
+            if size is None:
+                unmeasured += 1
+            requests.append((resource.url, size or 0, server_time))
+
+        finish = simulate(requests, self.profile, start=html_done, connections=connections)
+
+        blocking = [i for i, resource in enumerate(ordered) if resource.blocking]
+
+        return PageWeight(
+            url=url,
+            requests=1 + len(resources),
+            bytes=page_size + sum(size for u, size, server_time in requests),
+            unmeasured=unmeasured,
+            blocking_requests=len(blocking),
+            blocking_bytes=sum(requests[i][1] for i in blocking),
+            start_render=max([html_done] + [finish[i] for i in blocking]),
+            load_time=max([html_done] + finish),
+        )
+
+    def analyze(self):
+        """Return a PageWeight for every page, sorted by URL"""
+        return [self.analyze_page(url) for url in sorted(self.pages)]
+
+    def update_report(self, report, results, max_bytes=2 * 1024 * 1024, max_blocking=4, max_load_time=10):
+        """Add messages for pages over the thresholds and return (label, value) summary pairs"""
+
+        profile = self.profile.name
+
+        for page in results:
+            if page.bytes > max_bytes:
+                report.add(page.url, "Page Weight", "warning",
+                           "Pages larger than %s" % format_bytes(max_bytes), None)
+            if page.blocking_requests > max_blocking:
+                report.add(page.url, "Page Weight", "bad",
+                           "More than %d render-blocking stylesheets and scripts in <head>" % max_blocking, None)
+            if page.load_time > max_load_time:
+                report.add(page.url, "Page Weight", "warning",
+                           "Estimated load time over %d seconds on %s" % (max_load_time, profile), None)
+
+        if not results:
+            return []
+
+        def median(values):
+            values = sorted(values)
+            return values[len(values) // 2]
+
+        largest = max(results, key=lambda i: i.bytes)
+
+        return [
+            ("Median page weight", format_bytes(median(i.bytes for i in results))),
+            ("Largest page", "%s (%s)" % (format_bytes(largest.bytes), largest.url)),
+            ("Median requests per page", median(i.requests for i in results)),
+            ("Median estimated start render on %s" % profile,
+             "%0.2f seconds" % median(i.start_render for i in results)),
+            ("Median estimated load time on %s" % profile,
+             "%0.2f seconds" % median(i.load_time for i in results)),
+        ]
+
+    @staticmethod
+    def save(results, output):
+        """Write the results as tab-separated values"""
+
+        output.write("\t".join(PageWeight._fields) + "\n")
+        for page in results:
+            output.write("\t".join("%0.3f" % v if isinstance(v, float) else "%s" % v for v in page) + "\n")
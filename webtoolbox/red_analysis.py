@@ -0,0 +1,394 @@
+# encoding: utf-8
+"""
+RED cacheability analysis as a :class:`webtoolbox.spider.Spider` response processor
+
+:class:`REDProcessor` receives every response the spider has already fetched
+and adds the messages from `redbot <http://mnot.github.com/redbot/>`_'s
+``ResourceExpertDroid`` to a report. The spider's status, headers and body
+are replayed into RED instead of letting it request the URI again; RED still
+sends the conditional, range and content negotiation requests it uses to
+test validators. Its results are cached by a fingerprint of the headers they
+depend on, so a response which matches the cached fingerprint is reported
+without sending RED's requests at all.
+
+RED runs its own event loop and does a fair amount of CPU work for each
+response, so with ``concurrency`` > 1 it runs in separate worker processes
+which are fed URIs over a pipe and reply with JSON. Those pipes are
+cooperative under gevent, unlike a :class:`multiprocessing.Pool`, so the
+crawl continues while RED works.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import zlib
+from collections import defaultdict
+from urlparse import urlparse
+
+import gevent.lock
+import gevent.pool
+import gevent.queue
+
+# Response headers which RED's analysis depends on. Date and Expires usually
+# change on every request so they're replaced by the freshness lifetime and
+# Set-Cookie is ignored because session cookies would defeat the cache:
+FINGERPRINT_HEADERS = ('etag', 'last-modified', 'content-type', 'content-encoding', 'content-language',
+                       'cache-control', 'pragma', 'vary', 'location')
+
+
+def response_fingerprint(uri, status, headers, language="en"):
+    """
+    Returns a hash of everything RED's messages for a response depend on
+
+    Returns None for responses without an ETag or Last-Modified header since
+    nothing would reliably tell us that they haven't changed.
+    """
+
+    values = defaultdict(list)
+
+    for name, value in headers:
+        name = name.lower()
+        if name in FINGERPRINT_HEADERS or name in ('date', 'expires'):
+            values[name].append(value.strip())
+
+    if not values['etag'] and not values['last-modified']:
+        return None
+
+    lifetime = ", ".join(values['expires']) or None
+
+    if values['date'] and values['expires']:
+        date = email.utils.parsedate_tz(values['date'][0])
+        expires = email.utils.parsedate_tz(values['expires'][0])
+        if date and expires:
+            lifetime = email.utils.mktime_tz(expires) - email.utils.mktime_tz(date)
+
+    key = [uri, str(status), language, lifetime]
+    key.extend(", ".join(values[name]) for name in FINGERPRINT_HEADERS)
+
+    return hashlib.sha1(json.dumps(key)).hexdigest()
+
+
+def localize(red_dict, language):
+    """Return the preferred language version of a message returned by RED"""
+    return red_dict.get(language, red_dict['en'])
+
+
+def fetched_response(response):
+    """
+    Return the (status, reason, headers, body) of a spider response in a
+    form which can be sent to a worker process as JSON
+
+    The client decodes compressed bodies, so they're compressed again to
+    match the Content-Encoding header RED will check them against.
+    """
+
+    body = response.content or b""
+    encoding = response.headers.get("Content-Encoding", "").strip().lower()
+
+    if encoding in ("gzip", "x-gzip"):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(body) + compressor.flush()
+    elif encoding == "deflate":
+        body = zlib.compress(body)
+
+    return (response.status_code, response.reason or "", response.headers.original_items(),
+            base64.b64encode(body))
+
+
+def to_bytes(value):
+    return value if isinstance(value, bytes) else value.encode("iso-8859-1", "replace")
+
+
+#: The RedFetcher methods which FetchedResourceDroid replaces or calls:
+FETCHER_HOOKS = ('_run', '_response_start', '_response_body', '_response_done')
+
+_droid_class = None
+
+
+def get_droid_class():
+    """
+    Return a ResourceExpertDroid subclass which analyzes a response the
+    spider already has, or None if this version of RED can't be given one
+    """
+
+    global _droid_class
+
+    if _droid_class is not None:
+        return _droid_class or None
+
+    from red import ResourceExpertDroid
+
+    missing = [i for i in FETCHER_HOOKS if not hasattr(ResourceExpertDroid, i)]
+    if missing:
+        logging.warning("This version of RED has no %s: it will request every URI again",
+                        ", ".join(missing))
+        _droid_class = False
+        return None
+
+    class FetchedResourceDroid(ResourceExpertDroid):
+        """Replays a response received by the spider instead of sending RED's GET"""
+
+        def __init__(self, uri, fetched, **kwargs):
+            self.fetched = fetched
+            ResourceExpertDroid.__init__(self, uri, **kwargs)
+
+        def _run(self):
+            status, reason, headers, body = self.fetched
+
+            # RED expects byte strings, as its own HTTP client would provide:
+            self._response_start(b"1.1", str(status), to_bytes(reason),
+                                 [(to_bytes(name), to_bytes(value)) for name, value in headers],
+                                 lambda paused: None)
+            if body:
+                self._response_body(base64.b64decode(body))
+            self._response_done(None)
+
+    _droid_class = FetchedResourceDroid
+    return _droid_class
+
+
+def analyze_uri(uri, language="en", fetched=None):
+    """
+    Runs RED against a single URI and returns a JSON-serializable summary
+
+    ``fetched`` is the :func:`fetched_response` of the spider's response,
+    which RED analyzes instead of requesting the URI itself. The messages
+    are localized here so the worker processes don't need to send RED's
+    message objects back to the spider.
+    """
+
+    from red import ResourceExpertDroid
+
+    result = {'uri': uri, 'status': None, 'complete': False, 'messages': [], 'error': None}
+
+    try:
+        droid_class = get_droid_class() if fetched is not None else None
+
+        if droid_class is not None:
+            red = droid_class(uri, fetched, status_cb=logging.debug)
+        else:
+            red = ResourceExpertDroid(uri, status_cb=logging.debug)
+
+        result['status'] = red.res_status
+        result['complete'] = red.res_complete
+
+        for msg in red.messages:
+            title = localize(msg.summary, language) % msg.vars
+
+            if title.startswith("The resource last changed"):
+                continue
+
+            details = localize(msg.text, language) % msg.vars
+            result['messages'].append((msg.level, msg.category, title, details))
+    except Exception, e:
+        logging.exception("Unable to analyze %s", uri)
+        result['error'] = "%s: %s" % (e.__class__.__name__, e)
+
+    return result
+
+
+class ResultCache(object):
+    """
+    Persistent map of URI → (fingerprint, RED result) stored as JSON
+    """
+
+    VERSION = 2
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError), e:
+            if os.path.exists(filename):
+                logging.warning("Ignoring unreadable result cache %s: %s", filename, e)
+            return
+
+        if data.get('version') == self.VERSION:
+            self.entries = data['entries']
+
+    def fingerprint(self, uri):
+        entry = self.entries.get(uri)
+        return entry['fingerprint'] if entry else None
+
+    def get(self, uri):
+        self.hits += 1
+        return dict(self.entries[uri]['result'])
+
+    def put(self, uri, fingerprint, result):
+        self.misses += 1
+
+        if fingerprint and not result['error']:
+            self.entries[uri] = {'fingerprint': fingerprint, 'result': result}
+        else:
+            self.entries.pop(uri, None)
+
+    def save(self):
+        temp_filename = "%s.tmp" % self.filename
+
+        with open(temp_filename, "w") as f:
+            json.dump({'version': self.VERSION, 'entries': self.entries}, f)
+
+        os.rename(temp_filename, self.filename)
+
+
+class REDWorker(object):
+    """A child process which runs :func:`analyze_uri` for each URI it's sent"""
+
+    def __init__(self):
+        env = dict(os.environ)
+        # Make sure the child imports the same copy of webtoolbox:
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+
+        self.process = subprocess.Popen([sys.executable, "-m", "webtoolbox.red_analysis"],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+
+    def analyze(self, uri, language, fetched=None):
+        self.process.stdin.write(json.dumps([uri, language, fetched]) + "\n")
+        self.process.stdin.flush()
+
+        line = self.process.stdout.readline()
+
+        if not line:
+            raise IOError("RED worker %d exited with status %s" % (self.process.pid, self.process.wait()))
+
+        return json.loads(line)
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class REDProcessor(object):
+    """
+    Adds RED's messages for every response the spider retrieves to ``report``
+
+    Install it in :attr:`webtoolbox.spider.Spider.response_processors` and
+    call :meth:`join` after :meth:`webtoolbox.spider.Spider.run` returns.
+    ``report`` needs an ``add(url, category, severity, title, details)``
+    method like the check_site and red_spider reports. The report is built
+    in URI order once everything has finished so it doesn't depend on the
+    order in which the analysis completed.
+
+    :param cache: a :class:`ResultCache`, which is saved by :meth:`join`
+    :param concurrency: the number of RED worker processes; 1 runs RED in
+                        this process
+    :param per_host: the maximum number of simultaneous analyses of URIs on
+                     any one host, since each sends several requests
+    """
+
+    def __init__(self, report, language="en", cache=None, concurrency=1, per_host=2):
+        self.report = report
+        self.language = language
+        self.cache = cache
+        self.concurrency = max(1, concurrency)
+        self.per_host = max(1, per_host)
+
+        self.results = []
+        self.greenlets = gevent.pool.Group()
+        # RED isn't safe to run in more than one greenlet at a time so even
+        # in-process analysis needs a limit:
+        self.slots = gevent.lock.BoundedSemaphore(self.concurrency)
+        self.host_slots = defaultdict(lambda: gevent.lock.BoundedSemaphore(self.per_host))
+
+        self.workers = []
+        self.idle_workers = gevent.queue.Queue()
+
+    def __call__(self, request, response):
+        uri = response.url
+
+        fingerprint = response_fingerprint(uri, response.status_code, response.headers.original_items(),
+                                           language=self.language)
+
+        if self.cache is not None and fingerprint and self.cache.fingerprint(uri) == fingerprint:
+            logging.debug("Using cached RED results for unchanged URI: %s", uri)
+            self.results.append(self.cache.get(uri))
+            return
+
+        self.greenlets.spawn(self.analyze, uri, fingerprint, fetched_response(response))
+
+    def get_worker(self):
+        if self.idle_workers.empty():
+            worker = REDWorker()
+            self.workers.append(worker)
+            return worker
+
+        return self.idle_workers.get()
+
+    def analyze(self, uri, fingerprint, fetched):
+        with self.host_slots[urlparse(uri).netloc], self.slots:
+            if self.concurrency == 1:
+                result = analyze_uri(uri, self.language, fetched)
+            else:
+                worker = self.get_worker()
+                try:
+                    result = worker.analyze(uri, self.language, fetched)
+                except (IOError, ValueError), e:
+                    logging.error("Unable to analyze %s: %s", uri, e)
+                    self.workers.remove(worker)
+                    result = {'uri': uri, 'status': None, 'complete': False, 'messages': [],
+                              'error': str(e)}
+                else:
+                    self.idle_workers.put(worker)
+
+        if self.cache is not None:
+            self.cache.put(uri, fingerprint, result)
+
+        self.results.append(result)
+
+    def join(self):
+        """Wait for every analysis to finish and add the results to the report"""
+
+        self.greenlets.join()
+
+        for worker in self.workers:
+            worker.close()
+
+        for result in sorted(self.results, key=lambda r: r['uri']):
+            uri = result['uri']
+
+            if result['error']:
+                self.report.add(uri, "General", "error", "Unable to analyze resource", result['error'])
+
+            for severity, category, title, details in result['messages']:
+                self.report.add(uri, category, severity, title, details)
+
+        if self.cache is not None:
+            logging.info("Reused cached RED results for %d of %d URIs", self.cache.hits,
+                         self.cache.hits + self.cache.misses)
+            self.cache.save()
+
+
+def main():
+    """Worker process loop used by :class:`REDWorker`"""
+
+    output = sys.stdout
+    # Anything RED prints must not be mistaken for a result:
+    sys.stdout = sys.stderr
+
+    logging.basicConfig(level=logging.WARNING, format="[red_worker] [%(levelname)s]: %(message)s")
+
+    try:
+        for line in iter(sys.stdin.readline, ""):
+            uri, language, fetched = json.loads(line)
+            output.write(json.dumps(analyze_uri(uri, language, fetched)) + "\n")
+            output.flush()
+    except KeyboardInterrupt:
+        # The spider handles Ctrl-C and will close our pipes:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 # encoding: utf-8
 """
 HTTP clients designed for easy tool building
+
+The spider uses blocking sockets and greenlets, so
+``gevent.monkey.patch_all()`` must be called before it's used.
 """
 
 
-from urlparse import urlparse, urlunparse, urldefrag
-from collections import defaultdict, deque
+from urlparse import urlparse
+from collections import OrderedDict, defaultdict
 
 import logging
 import re
@@ -17,20 +20,35 @@ try:
 except ImportError:
     import pdb
 
-from requests import async, session
+import gevent
+from gevent.pool import Pool
 import chardet
 import lxml.html
 
+from webtoolbox.client import HTTPClient, Request, RequestError, Response
+from webtoolbox.dedup import ContentFingerprints, content_hash, simhash
+from webtoolbox.frontier import Frontier
+from webtoolbox.throttle import HostThrottle, RetryPolicy
+from webtoolbox.urls import TrapDetector, URLCanonicalizer
+
 
 #: Light-weight class used for reporting purposes
 class URLStatus(object):
     code = None
     time = None
+    #: :class:`webtoolbox.client.Timings` for the request:
+    timings = None
+    #: Clicks from the nearest starting URL:
+    depth = None
 
     #: Referrers list will be populated as we encounter them:
-    referrers = set()
+    referrers = None
     #: Link list will be populated during the link walk stage:
-    links = set()
+    links = None
+
+    def __init__(self):
+        self.referrers = set()
+        self.links = set()
 
 
 class Spider(object):
@@ -47,14 +65,28 @@ class Spider(object):
     #: Logger used to report progress & errors
     log = None
 
-    #: Queue containing requests which have not yet been processed:
-    request_queue = deque()
-    response_processors = list()
+    #: :class:`webtoolbox.frontier.Frontier` containing requests which have
+    # not yet been processed, highest priority first:
+    request_queue = None
+
+    #: Stop sending new requests after this many (None for no limit):
+    max_urls = None
+    #: Stop sending new requests after this many seconds (None for no limit):
+    max_time = None
+
+    #: If true, each host gets a :class:`webtoolbox.throttle.HostThrottle`
+    # which adapts the number of simultaneous requests to its latency and
+    # errors and pauses requests to a failing host:
+    throttle_hosts = True
+
+    #: Response processors will be called with (Request, Response) for every
+    # successful response, before any of the other processors:
+    response_processors = None
 
     #: This will be automatically populated from the inital batch of URLs
     # passed to :meth:`run` and will be used to determine whether to follow
     # links or simply record them.
-    allowed_hosts = set()
+    allowed_hosts = None
 
     #: This is the default time in seconds which we'll wait to receive a response:
     default_request_timeout = 15
@@ -65,8 +97,8 @@ class Spider(object):
     follow_offsite_redirects = False
 
     #: All urls processed by this spider as a URL-keyed list of :class:URLStatus elements
-    site_structure = defaultdict(URLStatus)
-    url_history = set()
+    site_structure = None
+    url_history = None
 
     #: URLs whose path matches this regular expression won't be followed:
     skip_link_re = re.compile("^$")
@@ -76,17 +108,28 @@ class Spider(object):
     #: If true, don't process non-media components (i.e. stylesheets or CSS)
     skip_resources = False
 
-    #: Header processors will be called with (URL, HTTP Headers)
-    header_processors = list()
+    #: Header processors will be called with (URL, HTTP Headers) for every
+    # successful response, whatever its content type
+    header_processors = None
 
     #: HTML processors will be called with unprocessed HTML as a UTF-8 string
     #  processors can return a string to *REPLACE* the provided HTML for all
     #  subsequent processors, including *ALL* tree processors
-    html_processors = list()
+    html_processors = None
 
     #: Tree processors will be called with the full lxml tree, which can be
     # modified to affect subsequent tree processors. Caution is advised!
-    tree_processors = list()
+    tree_processors = None
+
+    #: If true, HTML bodies which have already been processed at a URL with
+    # the same path are not parsed or passed to the HTML or tree processors
+    # again; their links are reused instead. Exact and near-duplicate pages
+    # are recorded in :attr:`content_fingerprints` either way:
+    skip_duplicate_content = True
+
+    #: The most pages whose links are kept for :attr:`skip_duplicate_content`;
+    # the least recently used are discarded first:
+    link_cache_size = 1000
 
     # Used to extract the charset for HTML responses:
     HTTP_CONTENT_TYPE_CHARSET_RE = re.compile("text/html;.*charset=(?P<charset>[^ ]+)", re.IGNORECASE)
@@ -100,72 +143,371 @@ class Spider(object):
     # non-problematic codes
     CONTROL_CHAR_RE = re.compile('[%s]' % "".join(re.escape(unichr(c)) for c in range(0, 8) + range(14, 31) + range(127, 160)))
 
-    redirect_map = {}
+    redirect_map = None
 
     def __init__(self, log_name="Spider", debug=False,
                  default_request_timeout=15,
-                 max_simultaneous_connections=6, **kwargs):
-        """Create a new Spider, optionally with a custom logging name"""
+                 max_simultaneous_connections=6, client_options=None,
+                 canonicalizer=None, trap_detector=None, frontier=None, retry_policy=None, shard=None,
+                 **kwargs):
+        """
+        Create a new Spider, optionally with a custom logging name
+
+        ``client_options`` are passed to :class:`webtoolbox.client.HTTPClient`
+        to tune the connection pool, DNS caching, etc.
+
+        ``canonicalizer``, ``trap_detector``, ``frontier`` and
+        ``retry_policy`` default to a :class:`webtoolbox.urls.URLCanonicalizer`,
+        a :class:`webtoolbox.urls.TrapDetector`, a
+        :class:`webtoolbox.frontier.Frontier` and a
+        :class:`webtoolbox.throttle.RetryPolicy` with their default settings.
+
+        ``shard`` is a :class:`webtoolbox.distributed.Shard` when this spider
+        crawls part of a site as one of several processes.
+        """
         super(Spider, self).__init__(**kwargs)
 
         self.log = logging.getLogger(log_name)
         self.debug = debug
 
         self.queued = 0
+        self.dispatched = 0
         self.processed = 0
         self.errors = 0
+        self.retried = 0
+        self.start_time = None
+
+        # Each spider has its own queue, processors and results. Class-level
+        # containers would be shared by every instance:
+        self.request_queue = frontier if frontier is not None else Frontier()
+        self.allowed_hosts = set()
+        self.site_structure = defaultdict(URLStatus)
+        self.url_history = set()
+        self.redirect_map = {}
+        #: URL → the time its request was sent, which can be passed to the
+        # next crawl's Frontier as last_crawled:
+        self.crawl_times = {}
+
+        #: Called with every URL to return its canonical form:
+        self.canonicalizer = canonicalizer if canonicalizer is not None else URLCanonicalizer()
+        #: Rejects new URLs which look like crawler traps; None disables it:
+        self.trap_detector = trap_detector if trap_detector is not None else TrapDetector()
+        #: Decides which failed requests are repeated; None disables retries:
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        #: Host → :class:`webtoolbox.throttle.HostThrottle`:
+        self.host_throttles = {}
+        #: (request, attempt) for retries waiting for a paused host:
+        self.deferred_retries = []
+        #: URLs owned by other shards are forwarded to them rather than queued:
+        self.shard = shard
+
+        #: :class:`webtoolbox.dedup.ContentFingerprints` for every HTML page:
+        self.content_fingerprints = ContentFingerprints()
+        # (body digest, URL without the query) → ((link, tag), …) so
+        # duplicates can be skipped. Relative links resolve identically when
+        # only the query string differs. Ordered from least to most recently
+        # used so it can be limited to link_cache_size:
+        self.link_cache = OrderedDict()
+        #: The number of duplicate pages which weren't parsed:
+        self.duplicates_skipped = 0
+
+        #: Stage → total seconds spent processing responses, for profiling:
+        # charset detection and decoding, fingerprinting, parsing, queuing
+        # links and each kind of processor:
+        self.stage_times = defaultdict(float)
+
+        self.response_processors = []
+        self.header_processors = []
+        self.html_processors = []
+        self.tree_processors = []
 
         self.default_request_timeout = default_request_timeout
         self.max_simultaneous_connections = max_simultaneous_connections
 
-        self.session = session(headers={"User-Agent": "https://github.com/acdha/webtoolbox"},
-                               config={'keep_alive': True, 'decode_unicode': False},
-                               hooks={'pre_request': self.process_request,
-                                      'response': self.process_response},
-                               timeout=self.default_request_timeout)
+        client_options = dict(client_options or {})
+        client_options.setdefault("pool_size", max_simultaneous_connections)
+        self.client = HTTPClient(timeout=self.default_request_timeout, **client_options)
 
         self.response_processors.append(self.process_full_response)
 
     @property
     def completed(self):
         print self.processed, self.queued
-        return self.processed == self.queued
+        # URLs left in the frontier by max_urls or max_time weren't requested:
+        return self.processed + len(self.request_queue) == self.queued
+
+    def budget_exhausted(self):
+        if self.max_urls and self.dispatched >= self.max_urls:
+            return True
+        if self.max_time and time.time() - self.start_time >= self.max_time:
+            return True
+        return False
 
     def run(self, urls):
         """
         Start the spider with the provided list of URLs
 
-        Block until the spider has crawled the entire site
+        Block until the spider has crawled the entire site or reached
+        :attr:`max_urls` or :attr:`max_time`
         """
 
+        self.start_time = time.time()
+
         for url in urls:
+            url = self.canonicalizer(url)
             parsed_url = urlparse(url)
 
             # We add any hostname specified in the initial run to the list of hostnames we'll spider:
             self.allowed_hosts.add(parsed_url.netloc)
 
-            self.queue(url)
+            # Every shard is given the same URLs; each starts with its own:
+            if self.shard is None or self.shard.owns(url):
+                self.queue(url, depth=0)
+
+        pool = Pool(self.max_simultaneous_connections)
 
-        while self.queued > self.processed:
-            async.map(self.request_queue,
-                      size=self.max_simultaneous_connections)
+        while True:
+            request, attempt = self.next_request()
+
+            if request is not None:
+                # This will block until a slot is available:
+                pool.spawn(self.fetch, request, attempt)
+            elif pool.free_count() < pool.size or self.paused_hosts():
+                # Wait for a running request to complete and possibly queue
+                # more, or for a paused host to resume:
+                self.wait_for_hosts(pool)
+            elif not self.wait_for_work():
+                break
+
+        if self.request_queue:
+            self.log.warning("Stopped after %d requests in %0.1f seconds with %d URLs left in the frontier",
+                             self.dispatched, time.time() - self.start_time, len(self.request_queue))
+
+    def host_ready(self, host):
+        return not self.throttle_hosts or self.get_throttle(host).ready()
+
+    def paused_hosts(self):
+        """Return the hosts with requests set aside until they resume"""
+
+        hosts = set(urlparse(request.url).netloc for request, attempt in self.deferred_retries)
+
+        # Unsent URLs are abandoned with the rest of the frontier once the budget runs out:
+        if not self.budget_exhausted():
+            hosts.update(self.request_queue.deferred)
+
+        return hosts
+
+    def next_request(self):
+        """
+        Return the next (request, attempt) to send or (None, None)
+
+        Requests for hosts which are paused or whose circuit breaker is open
+        are set aside rather than given a connection slot to wait in.
+        Retries were already counted against the budget.
+        """
+
+        for i, (request, attempt) in enumerate(self.deferred_retries):
+            if self.host_ready(urlparse(request.url).netloc):
+                del self.deferred_retries[i]
+                return request, attempt
+
+        if not self.request_queue or self.budget_exhausted():
+            return None, None
+
+        for host in list(self.request_queue.deferred):
+            if self.host_ready(host):
+                self.request_queue.resume(host)
+
+        try:
+            request = self.request_queue.pop(ready=self.host_ready)
+        except IndexError:
+            return None, None
 
-    def queue(self, url, **kwargs):
-        """Add a URL to the queue to be retrieved"""
+        self.dispatched += 1
+        return request, 0
+
+    def wait_for_hosts(self, pool):
+        """Wait until a running request completes or the first paused host resumes"""
+
+        now = time.time()
+        resume_times = [self.get_throttle(host).resume_time for host in self.paused_hosts()]
+        # A host waiting for its circuit breaker's probe resumes when a request completes:
+        resume_times = [i for i in resume_times if i > now]
+        timeout = min(resume_times) - now if resume_times else None
+
+        if pool.free_count() < pool.size:
+            gevent.wait(list(pool.greenlets), count=1, timeout=timeout)
+        else:
+            gevent.sleep(timeout if timeout is not None else 1)
+
+    def queue(self, url, depth=0, kind="page", **kwargs):
+        """
+        Add a URL to the frontier to be retrieved
+
+        ``depth`` is the number of clicks from a starting URL and ``kind`` is
+        page, resource or media; both are used to prioritize the URL.
+        """
+
+        url = self.canonicalizer(url)
 
         if url in self.url_history:
+            if url in self.request_queue:
+                self.site_structure[url].depth = min(depth, self.site_structure[url].depth)
+                self.request_queue.update(url, depth=depth, inlinks=len(self.site_structure[url].referrers))
             return
 
         self.url_history.add(url)
 
-        req = async.get(url, session=self.session,
-                        timeout=kwargs.pop("timeout", self.default_request_timeout),
-                        **kwargs)
+        if self.shard is not None and not self.shard.owns(url):
+            self.shard.forward(url, depth, kind, (kwargs.get("headers") or {}).get("Referer"))
+            return
+
+        if self.trap_detector is not None:
+            reason = self.trap_detector.check(url)
+            if reason is not None:
+                self.log.info("Not queuing %s: %s", url, reason)
+                return
+
+        req = Request("GET", url, headers=kwargs.pop("headers", None),
+                      timeout=kwargs.pop("timeout", self.default_request_timeout))
 
-        self.request_queue.append(req)
+        self.site_structure[url].depth = depth
+        self.request_queue.push(url, req, depth=depth, kind=kind,
+                                inlinks=len(self.site_structure[url].referrers))
 
         self.queued += 1
 
+    def wait_for_work(self):
+        """
+        Called when the frontier is empty and no requests are in progress
+
+        Returns True if the spider should continue, after queuing any links
+        forwarded by other shards, or False once the crawl has finished.
+        """
+
+        if self.shard is None:
+            return False
+
+        links = self.shard.receive()
+
+        if links:
+            for url, depth, kind, referrer in links:
+                self.queue(url, depth=depth, kind=kind, headers={"Referer": referrer} if referrer else None)
+            return True
+
+        if self.shard.finished():
+            return False
+
+        gevent.sleep(self.shard.poll_interval)
+        return True
+
+    def get_state(self):
+        """Return the picklable results of a crawl, which :meth:`merge_state` can combine"""
+
+        return {
+            "allowed_hosts": self.allowed_hosts,
+            "site_structure": dict(self.site_structure),
+            "redirect_map": self.redirect_map,
+            "crawl_times": self.crawl_times,
+            "counters": dict((i, getattr(self, i)) for i in ("queued", "dispatched", "processed", "errors",
+                                                             "retried", "duplicates_skipped")),
+            "stage_times": dict(self.stage_times),
+            "frontier": self.request_queue.pending(),
+            "content_fingerprints": self.content_fingerprints,
+            "trap_detector": self.trap_detector,
+            "throttle_trips": dict((host, throttle.trips) for host, throttle in self.host_throttles.items()
+                                   if throttle.trips),
+        }
+
+    def merge_state(self, state):
+        """Add the results from :meth:`get_state` of another spider, such as one crawling another shard"""
+
+        self.allowed_hosts.update(state["allowed_hosts"])
+
+        for url, other in state["site_structure"].items():
+            status = self.site_structure[url]
+
+            for name, value in vars(other).items():
+                if name in ("referrers", "links"):
+                    getattr(status, name).update(value)
+                elif name == "depth" and status.depth is not None and value is not None:
+                    status.depth = min(status.depth, value)
+                elif value is not None and getattr(status, name, None) is None:
+                    setattr(status, name, value)
+
+        self.redirect_map.update(state["redirect_map"])
+        self.crawl_times.update(state["crawl_times"])
+
+        for name, value in state["counters"].items():
+            setattr(self, name, getattr(self, name) + value)
+
+        for stage, seconds in state["stage_times"].items():
+            self.stage_times[stage] += seconds
+
+        # URLs which weren't requested before a budget ran out:
+        for url, depth, kind in state["frontier"]:
+            if url not in self.request_queue:
+                self.url_history.add(url)
+                self.request_queue.push(url, None, depth=depth, kind=kind)
+
+        self.content_fingerprints.merge(state["content_fingerprints"])
+
+        if self.trap_detector is not None and state["trap_detector"] is not None:
+            self.trap_detector.merge(state["trap_detector"])
+
+        for host, trips in state["throttle_trips"].items():
+            self.get_throttle(host).trips += trips
+
+    def get_throttle(self, host):
+        throttle = self.host_throttles.get(host)
+
+        if throttle is None:
+            throttle = self.host_throttles[host] = HostThrottle(
+                host, max_concurrency=self.max_simultaneous_connections)
+
+        return throttle
+
+    def fetch(self, request, attempt=0):
+        """Retrieve a queued request, retrying transient failures, and process the response"""
+
+        throttle = self.get_throttle(urlparse(request.url).netloc) if self.throttle_hosts else None
+
+        while True:
+            if throttle is not None:
+                throttle.acquire()
+
+            self.process_request(request)
+            self.crawl_times[request.url] = request.start_time
+
+            try:
+                response = self.client.send(request)
+            except RequestError as exc:
+                response = Response(request, error=exc)
+                response.timings.total = time.time() - request.start_time
+
+            if throttle is not None:
+                throttle.release(response, time.time() - request.start_time)
+
+            if self.retry_policy is None or not self.retry_policy.should_retry(response, attempt):
+                break
+
+            delay = self.retry_policy.delay(response, attempt)
+            attempt += 1
+            self.retried += 1
+
+            if throttle is not None and not throttle.ready():
+                # Give up the connection slot until the host resumes:
+                self.log.warning("Retrying %s once %s resumes after %s", request.url, throttle.host,
+                                 response.error or "HTTP %s" % response.status_code)
+                self.deferred_retries.append((request, attempt))
+                return
+
+            self.log.warning("Retrying %s in %0.1f seconds after %s", request.url, delay,
+                             response.error or "HTTP %s" % response.status_code)
+            gevent.sleep(delay)
+
+        self.process_response(response)
+
     def guess_charset(self, response):
         """
         Does the ugly business of attempting to figure out how to decode the
@@ -205,7 +547,9 @@ class Spider(object):
         Rough sequence:
             #. Process errors and redirects
             #. Process non-HTML content
+            #. Queue the cached links of HTML which duplicates a processed page
             #. Convert retrieved HTML to UTF-8
+            #. Record a SimHash to find near-duplicate pages
             #. Process HTML through the defined :attr:`html_processors`
             #. Create an ``lxml`` tree
             #. Convert all links to absolute URLs
@@ -220,19 +564,22 @@ class Spider(object):
 
         self.log.info("Retrieved %s (elapsed=%0.2f, status=%s)", request.url,
                       response.elapsed_time, response.status_code)
+        self.log.debug("%s: %r", request.url, response.timings)
 
         if not response.ok:
             self.errors += 1
 
             # TODO: Replace this by passing extra= to logging & formatting appropriately
             if "Referer" in response.request.headers:
-                self.log.error("Unable to retrieve %s (referer=%s) HTTP %d:  %s", request.url,
+                self.log.error("Unable to retrieve %s (referer=%s) HTTP %s:  %s", request.url,
                                response.request.headers['Referer'], response.status_code, response.error)
             else:
-                self.log.error("Unable to retrieve %s HTTP %d: %s", request.url,
+                self.log.error("Unable to retrieve %s HTTP %s: %s", request.url,
                                response.status_code, response.error)
         else:
             for p in self.response_processors:
+                started = time.time()
+
                 try:
                     p(request, response)
                 except Exception as exc:
@@ -242,8 +589,13 @@ class Spider(object):
                     if self.debug:
                         pdb.post_mortem(tb)
 
+                # process_full_response records its own stages:
+                if p != self.process_full_response:
+                    self.stage_times["response_processors"] += time.time() - started
+
     def process_full_response(self, request, response):
-        url = response.url
+        # Redirects which the client followed may end at a non-canonical URL:
+        url = self.canonicalizer(response.url)
 
         # These will be used for new requests based on this page's links:
         new_req_headers = {
@@ -252,7 +604,7 @@ class Spider(object):
 
         # If follow_redirects=False, our effective_url won't be automatically updated:
         if response.status_code in (301, 302):
-            url = response.headers['Location']
+            url = self.canonicalizer(response.headers['Location'])
             self.redirect_map[request.url] = url
 
             assert not url in self.redirect_map or self.redirect_map[url] != request.url, "Circular redirect: %s %s" % (url, self.redirect_map[url])
@@ -261,6 +613,7 @@ class Spider(object):
 
         self.site_structure[url].status_code = response.status_code
         self.site_structure[url].time = response.elapsed_time
+        self.site_structure[url].timings = response.timings
 
         if not parsed_url.scheme == "http":
             self.log.error("Skipping %s: can't handle non HTTP URLs", url)
@@ -268,9 +621,9 @@ class Spider(object):
 
         if url != request.url:
             if not parsed_url.netloc or parsed_url.netloc in self.allowed_hosts:
-                self.queue(url, headers=new_req_headers)
+                self.queue(url, headers=new_req_headers, depth=self.site_structure[request.url].depth or 0)
             elif self.follow_offsite_redirects:
-                self.queue(url, headers=new_req_headers)
+                self.queue(url, headers=new_req_headers, depth=self.site_structure[request.url].depth or 0)
             else:
                 self.log.info("Not following external redirect from %s to %s", request.url, url)
             return
@@ -288,6 +641,18 @@ class Spider(object):
             self.log.warning("%s: possible partial content: Content-Length = %d, body length = %d",
                              url, content_length, len(response.content))
 
+        started = time.time()
+
+        # Header processors see every response, not just HTML:
+        for p in self.header_processors:
+            try:
+                p(url, response.headers)
+            except:
+                self.log.exception("Header processor %s: unhandled exception", p)
+                raise
+
+        self.stage_times["header_processors"] += time.time() - started
+
         content_type = response.headers.get('Content-Type', None)
 
         if not content_type:
@@ -299,12 +664,27 @@ class Spider(object):
             self.log.info("Done processing %s resource %s", content_type, url)
             return
 
-        for p in self.header_processors:
-            try:
-                p(url, response.headers)
-            except:
-                self.log.exception("Header processor %s: unhandled exception", p)
-                raise
+        started = time.time()
+
+        digest = content_hash(response.content)
+        original = self.content_fingerprints.add_body(url, digest)
+        link_cache_key = (digest, urlparse(url)[:4])
+
+        self.stage_times["fingerprint"] += time.time() - started
+
+        if original is not None and self.skip_duplicate_content and link_cache_key in self.link_cache:
+            self.log.info("%s: skipping processing - same content as %s", url, original)
+            self.duplicates_skipped += 1
+
+            # Move it to the most recently used end:
+            links = self.link_cache[link_cache_key] = self.link_cache.pop(link_cache_key)
+
+            started = time.time()
+            self.process_links(url, links, new_req_headers)
+            self.stage_times["links"] += time.time() - started
+            return
+
+        started = time.time()
 
         charset = self.guess_charset(response) or "latin-1"
 
@@ -321,6 +701,18 @@ class Spider(object):
         if junk_count:
             self.log.warning("%s: stripped %d non-printable control characters", url, junk_count)
 
+        self.stage_times["charset"] += time.time() - started
+
+        if original is None:
+            started = time.time()
+            cluster = self.content_fingerprints.add_simhash(url, simhash(html))
+            self.stage_times["fingerprint"] += time.time() - started
+
+            if cluster is not None:
+                self.log.info("%s: nearly the same content as %s", url, cluster)
+
+        started = time.time()
+
         for p in self.html_processors:
             try:
                 html = p(url, html) or html
@@ -328,8 +720,12 @@ class Spider(object):
                 self.log.exception("HTML processor %s: unhandled exception", p)
                 raise
 
+        self.stage_times["html_processors"] += time.time() - started
+
         self.log.debug("%s: Parsing %d bytes of HTML", url, len(html))
 
+        started = time.time()
+
         try:
             tree = lxml.html.document_fromstring(html)
         except ValueError, e:
@@ -340,46 +736,63 @@ class Spider(object):
 
         tree.make_links_absolute(url, resolve_base_href=True)
 
+        links = []
+
         for element, attribute, link, pos in tree.iterlinks():
-            link_p = urlparse(link)
+            # Equivalent forms such as http://Example.com:80/a/../foo?b=2&a=1#top
+            # and http://example.com/foo?a=1&b=2 are considered to be the same:
+            links.append((self.canonicalizer(link), element.tag))
+
+        self.link_cache[link_cache_key] = tuple(links)
+        if len(self.link_cache) > self.link_cache_size:
+            self.link_cache.popitem(last=False)
 
-            # Reconstruct the URL to remove fragments and normalize alternate
-            # forms which are equivalent. e.g. http://example.com/foo? and
-            # http://example.com/foo are considered to be the same
+        self.stage_times["parse"] += time.time() - started
+        started = time.time()
 
-            # Avoid wasting time reprocessing anchors, which are a browser-level behaviour:
-            normalized_url = urldefrag(urlunparse((
-             link_p.scheme, link_p.netloc, link_p.path, link_p.params, link_p.query, ""
-            )))[0]
+        self.process_links(url, links, new_req_headers)
+
+        self.stage_times["links"] += time.time() - started
+        started = time.time()
+
+        for p in self.tree_processors:
+            try:
+                p(url, tree)
+            except:
+                self.log.exception("Tree processor %s: unhandled exception", p)
+                raise
+
+        self.stage_times["tree_processors"] += time.time() - started
+
+    def process_links(self, url, links, headers):
+        """Record and queue the (normalized URL, element tag) pairs found on a page"""
+
+        depth = (self.site_structure[url].depth or 0) + 1
+
+        for normalized_url, tag in links:
+            link_p = urlparse(normalized_url)
 
             self.site_structure[url].links.add(normalized_url)
 
             if link_p.netloc and not link_p.netloc in self.allowed_hosts:
-                self.log.debug("Skipping external resource: %s", link)
+                self.log.debug("Skipping external resource: %s", normalized_url)
                 continue
 
             self.site_structure[normalized_url].referrers.add(url)
 
             if self.skip_link_re.match(link_p.path):
-                self.log.debug("Link matched skip_link_re - skipping %s", link)
+                self.log.debug("Link matched skip_link_re - skipping %s", normalized_url)
                 continue
 
             if not link_p.scheme.startswith("http"):
-                self.log.debug("Skipping non-HTTP link: %s", link)
+                self.log.debug("Skipping non-HTTP link: %s", normalized_url)
                 continue
 
-            if element.tag in ('a', 'frame', 'iframe'):
-                self.queue(normalized_url, headers=new_req_headers)
-            elif element.tag in ('link', 'script'):
+            if tag in ('a', 'frame', 'iframe'):
+                self.queue(normalized_url, headers=headers, depth=depth, kind="page")
+            elif tag in ('link', 'script'):
                 if not self.skip_resources:
-                    self.queue(normalized_url, headers=new_req_headers)
+                    self.queue(normalized_url, headers=headers, depth=depth, kind="resource")
             else:
                 if not self.skip_media:
-                    self.queue(normalized_url, headers=new_req_headers)
-
-        for p in self.tree_processors:
-            try:
-                p(url, tree)
-            except:
-                self.log.exception("Tree processor %s: unhandled exception", p)
-                raise
+                    self.queue(normalized_url, headers=headers, depth=depth, kind="media")
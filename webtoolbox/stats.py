@@ -0,0 +1,106 @@
+# encoding: utf-8
+"""
+Fixed-memory statistics used by the load generators
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import math
+
+
+class LatencyHistogram(object):
+    """
+    Log-bucketed histogram of durations in seconds
+
+    Each recorded value is assigned to a bucket whose width is a constant
+    fraction of its lower bound so percentiles are accurate to within
+    ``precision`` regardless of the magnitude. Memory use depends only on the
+    range of values seen, not on how many were recorded, which allows a
+    benchmark to run for hours without growing.
+    """
+
+    def __init__(self, precision=0.01, lowest=0.0001):
+        self.precision = precision
+        self.lowest = lowest
+        self._log_base = math.log(1 + precision)
+
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        if value <= self.lowest:
+            return 0
+        return int(math.log(value / self.lowest) / self._log_base) + 1
+
+    def _bucket_value(self, idx):
+        """Returns the upper bound for the provided bucket"""
+        if idx == 0:
+            return self.lowest
+        return self.lowest * math.exp(idx * self._log_base)
+
+    def record(self, value, count=1):
+        idx = self._bucket(value)
+        self.buckets[idx] = self.buckets.get(idx, 0) + count
+
+        self.count += count
+        self.total += value * count
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add all of the values recorded in another histogram to this one"""
+        assert other.precision == self.precision and other.lowest == self.lowest
+
+        for idx, count in other.buckets.items():
+            self.buckets[idx] = self.buckets.get(idx, 0) + count
+
+        self.count += other.count
+        self.total += other.total
+
+        for attr, pick in (('min', min), ('max', max)):
+            theirs = getattr(other, attr)
+            if theirs is not None:
+                ours = getattr(self, attr)
+                setattr(self, attr, theirs if ours is None else pick(ours, theirs))
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, pct):
+        """Return the value below which ``pct`` percent of values fall"""
+
+        if not self.count:
+            return 0.0
+
+        threshold = self.count * pct / 100.0
+        seen = 0
+
+        for idx in sorted(self.buckets):
+            seen += self.buckets[idx]
+            if seen >= threshold:
+                return min(self._bucket_value(idx), self.max)
+
+        return self.max
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+        """Return a dictionary of commonly reported values in milliseconds"""
+
+        result = {
+            "count": self.count,
+            "min": (self.min or 0.0) * 1000,
+            "mean": self.mean * 1000,
+            "max": (self.max or 0.0) * 1000,
+        }
+
+        for pct in percentiles:
+            result["p%s" % ("%g" % pct).replace(".", "_")] = self.percentile(pct) * 1000
+
+        return result
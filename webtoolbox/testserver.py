@@ -0,0 +1,333 @@
+# encoding: utf-8
+"""
+Local stand-in HTTP servers for exercising the tools without a real site
+
+:class:`StallingServer` returns the same small response with periodic
+stalls for the load generators. :class:`SiteServer` serves a fixed set of
+pages and resources for the spiders and page-load benchmarks and
+:class:`SyntheticSiteServer` generates a site of any size for the spider
+benchmark.
+
+Usage:
+
+    python -m webtoolbox.testserver --port=8000 --stall-period=10 --stall-duration=2
+
+The server runs in a background thread so it can also be started from
+benchmark or test code::
+
+    with StallingServer(stall_period=5, stall_duration=1) as server:
+        run_benchmark(server.url)
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # Load tests open many connections at once:
+    request_queue_size = 1024
+
+
+class QuietRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.getLogger("testserver").debug(format, *args)
+
+    def send_body(self, body, content_type="text/plain", status=200, headers=None):
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+
+class StallingRequestHandler(QuietRequestHandler):
+    """
+    Responds immediately except during a stall window, when every request
+    blocks until the window ends as if the server had paused for garbage
+    collection or a database lock
+    """
+
+    def do_GET(self):
+        server = self.server
+
+        if server.stall_period:
+            offset = (time.time() - server.start_time) % server.stall_period
+            if offset < server.stall_duration:
+                time.sleep(server.stall_duration - offset)
+
+        self.send_body(server.response_body)
+
+    do_HEAD = do_GET
+
+
+class SiteRequestHandler(QuietRequestHandler):
+    """Serves the server's ``files`` after waiting for its ``latency``"""
+
+    def do_GET(self):
+        server = self.server
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        path = self.path.split("?", 1)[0]
+
+        if path not in server.files:
+            self.send_body("Not found\n", status=404)
+            return
+
+        content_type, body = server.files[path]
+        self.send_body(body, content_type=content_type)
+
+    do_HEAD = do_GET
+
+
+class SyntheticSiteRequestHandler(QuietRequestHandler):
+    """Serves the pages and media generated by the server's ``site``"""
+
+    def do_GET(self):
+        server = self.server
+        started = time.time()
+
+        response = server.site.render(self.path.split("?", 1)[0])
+
+        if response is None:
+            self.send_body("Not found\n", status=404)
+        else:
+            content_type, body = response
+            self.send_body(body, content_type=content_type)
+
+        # Lets benchmarks running the server in-process subtract its share:
+        server.busy_time += time.time() - started
+
+    do_HEAD = do_GET
+
+
+class SyntheticSite(object):
+    """
+    A site of numbered pages which are generated on request
+
+    Every page is reachable from ``/`` because page N links to pages
+    ``N * fanout + 1`` to ``N * fanout + fanout``; pages near the bottom of
+    that tree link to random pages instead so each has ``fanout`` links.
+    Pages also embed ``media_ratio`` images each on average, drawn from
+    ``pages * media_ratio`` distinct images. The same ``seed`` always
+    produces the same site.
+
+    Each page uses the next of ``charsets`` in turn: a charset name is
+    declared in the Content-Type header and ``none`` sends UTF-8 without
+    declaring it, so the client has to detect it.
+
+    :param page_size: the approximate size of each page in bytes
+    """
+
+    TEXT = "Un café crème et une brûlée à Zürich, ¿señor? "
+
+    #: A 1×1 transparent GIF:
+    MEDIA_BODY = (b"GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00"
+                  b"\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;")
+
+    def __init__(self, pages=1000, fanout=10, page_size=8192, charsets=("utf-8", ), media_ratio=0.5, seed=0):
+        self.pages = pages
+        self.fanout = fanout
+        self.page_size = page_size
+        self.charsets = tuple(charsets)
+        self.media_ratio = media_ratio
+        self.seed = seed
+        self.media = int(pages * media_ratio)
+
+    def page_url(self, number):
+        return "/" if number == 0 else "/page/%d.html" % number
+
+    def links(self, number):
+        rng = random.Random(self.seed * self.pages + number)
+
+        links = [i for i in range(number * self.fanout + 1, number * self.fanout + self.fanout + 1)
+                 if i < self.pages]
+
+        while len(links) < self.fanout and self.pages > 1:
+            links.append(rng.randrange(self.pages))
+
+        images = int(self.media_ratio) + (rng.random() < self.media_ratio % 1)
+        media = [rng.randrange(self.media) for i in range(images)] if self.media else []
+
+        return links, media
+
+    def render_page(self, number):
+        charset = self.charsets[number % len(self.charsets)]
+        links, media = self.links(number)
+
+        parts = ["<!DOCTYPE html>\n<html><head><title>Page %d</title></head><body>\n<h1>Page %d</h1>\n"
+                 % (number, number)]
+        parts.extend('<p><a href="%s">Page %d</a></p>\n' % (self.page_url(i), i) for i in links)
+        parts.extend('<img src="/media/%d.gif" alt="">\n' % i for i in media)
+
+        # Padding with text whose words vary keeps pages from looking like near-duplicates:
+        rng = random.Random(number)
+        size = sum(len(i) for i in parts)
+        while size < self.page_size:
+            paragraph = "<p>%s %d</p>\n" % (self.TEXT * 4, rng.getrandbits(32))
+            parts.append(paragraph)
+            size += len(paragraph)
+
+        parts.append("</body></html>\n")
+        html = "".join(parts)
+
+        if charset == "none":
+            return "text/html", html.encode("utf-8")
+
+        # Charsets which can't represent the sample text get character references:
+        return "text/html; charset=%s" % charset, html.encode(charset, "xmlcharrefreplace")
+
+    def render(self, path):
+        """Return the content type and body for path or None if it doesn't exist"""
+
+        if path == "/":
+            return self.render_page(0)
+
+        if path.startswith("/page/") and path.endswith(".html"):
+            number = path[6:-5]
+            if number.isdigit() and 0 < int(number) < self.pages:
+                return self.render_page(int(number))
+
+        if path.startswith("/media/") and path.endswith(".gif"):
+            number = path[7:-4]
+            if number.isdigit() and int(number) < self.media:
+                return "image/gif", self.MEDIA_BODY
+
+        return None
+
+
+class LocalServer(object):
+    """Runs a request handler on a loopback port in a background thread"""
+
+    handler_class = QuietRequestHandler
+
+    def __init__(self, host="127.0.0.1", port=0, handler_class=None):
+        self.httpd = ThreadedHTTPServer((host, port), handler_class or self.handler_class)
+        self.httpd.start_time = time.time()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://%s:%d/" % (host, port)
+
+    def start(self):
+        self.httpd.start_time = time.time()
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class StallingServer(LocalServer):
+    """
+    Stalls for ``stall_duration`` seconds at the start of every
+    ``stall_period`` seconds, which is what a load generator needs to
+    demonstrate coordinated omission
+    """
+
+    handler_class = StallingRequestHandler
+
+    def __init__(self, stall_period=10, stall_duration=1, response_body=b"OK\n", **kwargs):
+        super(StallingServer, self).__init__(**kwargs)
+        self.httpd.stall_period = stall_period
+        self.httpd.stall_duration = stall_duration
+        self.httpd.response_body = response_body
+
+
+class SiteServer(LocalServer):
+    """
+    Serves a fixed set of files, such as a page and its resources
+
+    ``files`` maps paths such as ``/index.html`` to (content type, body)
+    pairs. Every response is delayed by ``latency`` seconds to simulate a
+    slow network or server.
+    """
+
+    handler_class = SiteRequestHandler
+
+    def __init__(self, files, latency=0, **kwargs):
+        super(SiteServer, self).__init__(**kwargs)
+        self.httpd.files = files
+        self.httpd.latency = latency
+
+
+class SyntheticSiteServer(LocalServer):
+    """
+    Serves a :class:`SyntheticSite`
+
+    :attr:`busy_time` is the total time spent handling requests.
+    """
+
+    handler_class = SyntheticSiteRequestHandler
+
+    def __init__(self, site, **kwargs):
+        super(SyntheticSiteServer, self).__init__(**kwargs)
+        self.httpd.site = site
+        self.httpd.busy_time = 0.0
+
+    @property
+    def busy_time(self):
+        return self.httpd.busy_time
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a local HTTP server which periodically stalls")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--stall-period", type=float, default=10,
+                        help="Seconds between the start of each stall (0 to disable)")
+    parser.add_argument("--stall-duration", type=float, default=1,
+                        help="Seconds each stall lasts")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    server = StallingServer(port=args.port, stall_period=args.stall_period,
+                            stall_duration=args.stall_duration)
+    logging.info("Serving on %s", server.url)
+
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
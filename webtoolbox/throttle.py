@@ -0,0 +1,223 @@
+# encoding: utf-8
+"""
+Retries and per-host flow control for crawlers
+
+:class:`RetryPolicy` decides whether a failed request is worth repeating and
+how long to wait first: the server's ``Retry-After`` if it sent one,
+otherwise exponential backoff with full jitter so that many clients don't
+retry in lockstep.
+
+:class:`HostThrottle` limits the requests in progress to one host. The limit
+grows additively while responses are fast and successful and is halved when
+a host responds slowly, with an error or says it's overloaded (AIMD). After
+``failure_threshold`` consecutive failures the circuit breaker opens and no
+requests are sent for ``cooldown`` seconds; then a single probe request
+decides whether to resume or wait twice as long.
+
+Waiting is done with gevent so only the greenlets talking to a struggling
+host are held up. A crawler with a fixed number of connection slots should
+check :meth:`HostThrottle.ready` before giving a request a slot, so that
+requests to a paused host don't wait in every slot.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import random
+import time
+
+import gevent.event
+
+from webtoolbox.headers import parse_http_date
+
+#: Responses with these status codes are worth retrying:
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+#: Responses with these status codes mean the server wants us to slow down:
+OVERLOAD_STATUS_CODES = (429, 503)
+
+
+def parse_retry_after(value, now=None):
+    """Return the seconds to wait from a Retry-After header, which may be a delay or an HTTP date"""
+
+    if not value:
+        return None
+
+    value = value.strip()
+
+    if value.isdigit():
+        return int(value)
+
+    date = parse_http_date(value)
+    if date is None:
+        return None
+
+    return max(0, date - (now or time.time()))
+
+
+def is_failure(response):
+    """Connection errors, timeouts and 5xx or 429 responses count against a host"""
+    return (response.error is not None or response.status_code is None
+            or response.status_code >= 500 or response.status_code == 429)
+
+
+class RetryPolicy(object):
+    """
+    :param retries: how many times a request may be repeated
+    :param backoff: the base delay in seconds, doubled after each attempt
+    :param max_delay: the longest delay, including any Retry-After
+    """
+
+    def __init__(self, retries=2, backoff=1.0, max_delay=60, status_codes=RETRY_STATUS_CODES):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.status_codes = status_codes
+
+    def should_retry(self, response, attempt):
+        """``attempt`` counts from 0 for the first request"""
+
+        if attempt >= self.retries:
+            return False
+
+        return response.error is not None or response.status_code in self.status_codes
+
+    def delay(self, response, attempt):
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+
+        return random.uniform(0, min(self.max_delay, self.backoff * 2 ** attempt))
+
+
+class HostThrottle(object):
+    """
+    Adaptive concurrency limit and circuit breaker for one host
+
+    Call :meth:`acquire` before sending a request, which waits until the
+    host may receive another one, and :meth:`release` with the response.
+
+    :param max_concurrency: the starting and largest limit
+    :param slow_factor: responses slower than this multiple of the fastest
+                        response seen from the host, and at least
+                        ``min_slow_latency`` seconds, count as congestion
+    """
+
+    def __init__(self, host, max_concurrency=6, min_concurrency=1, failure_threshold=5, cooldown=30,
+                 max_cooldown=300, slow_factor=4, min_slow_latency=0.5):
+        self.log = logging.getLogger("webtoolbox.throttle")
+
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.failure_threshold = failure_threshold
+        self.initial_cooldown = self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.slow_factor = slow_factor
+        self.min_slow_latency = min_slow_latency
+
+        #: The current concurrency limit, which AIMD adjusts:
+        self.limit = float(max_concurrency)
+        self.active = 0
+        self.consecutive_failures = 0
+        #: The number of times the circuit breaker has opened:
+        self.trips = 0
+
+        self.min_latency = None
+        self.last_decrease = 0
+        # Requests wait until both of these have passed:
+        self.paused_until = 0
+        self.open_until = 0
+
+        self.wakeup = gevent.event.Event()
+
+    @property
+    def is_open(self):
+        return self.consecutive_failures >= self.failure_threshold
+
+    @property
+    def resume_time(self):
+        """The time after which a paused host may be sent requests again"""
+        return max(self.paused_until, self.open_until)
+
+    def ready(self):
+        """
+        Whether :meth:`acquire` could return without waiting for a pause,
+        a cooldown or the circuit breaker's probe to finish
+
+        The concurrency limit isn't checked: those waits are as short as the
+        host's own requests.
+        """
+
+        if self.resume_time > time.time():
+            return False
+
+        return not (self.is_open and self.active)
+
+    def acquire(self):
+        while True:
+            now = time.time()
+            wait = self.resume_time - now
+
+            # Once the breaker's cooldown has passed a single probe is allowed:
+            allowed = 1 if self.is_open else max(self.min_concurrency, int(self.limit))
+
+            if wait <= 0 and self.active < allowed:
+                self.active += 1
+                return
+
+            self.wakeup.clear()
+            self.wakeup.wait(timeout=wait if wait > 0 else None)
+
+    def release(self, response, latency):
+        self.active -= 1
+        now = time.time()
+
+        if is_failure(response):
+            self.consecutive_failures += 1
+            self.decrease(now)
+
+            # Requests which were already in progress when the breaker opened
+            # don't extend the cooldown; a failed probe does:
+            if self.is_open and now >= self.open_until:
+                self.trip(now)
+        else:
+            if self.is_open:
+                self.log.warning("Resuming requests to %s", self.host)
+                self.cooldown = self.initial_cooldown
+            self.consecutive_failures = 0
+
+            if self.min_latency is None or latency < self.min_latency:
+                self.min_latency = latency
+
+            if latency > max(self.min_slow_latency, self.min_latency * self.slow_factor):
+                self.decrease(now)
+            else:
+                # Grows by about one per limit's worth of successful responses:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+        if response.status_code in OVERLOAD_STATUS_CODES:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"), now=now)
+            if retry_after:
+                self.log.info("Pausing requests to %s for %d seconds as requested by Retry-After",
+                              self.host, retry_after)
+                self.paused_until = max(self.paused_until, now + min(retry_after, self.max_cooldown))
+
+        self.wakeup.set()
+
+    def decrease(self, now):
+        # Every response from one burst reports the same congestion, so the
+        # limit is only halved once per second:
+        if now - self.last_decrease >= 1:
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            self.last_decrease = now
+            self.log.debug("Reduced the concurrency limit for %s to %0.1f", self.host, self.limit)
+
+    def trip(self, now):
+        self.trips += 1
+        self.open_until = now + self.cooldown
+        self.log.warning("Pausing requests to %s for %d seconds after %d consecutive failures",
+                         self.host, self.cooldown, self.consecutive_failures)
+        self.cooldown = min(self.max_cooldown, self.cooldown * 2)
@@ -0,0 +1,208 @@
+# encoding: utf-8
+"""
+Weighted, templated URL generation for load tests
+
+A mix file contains one URL per line, optionally preceded by a weight. This
+is the format produced by ``uniq -c`` or ``log_to_tsv --aggregate=paths``::
+
+    # weight  URL template
+    120       /
+    35        /search?q={choice:apple,banana,cherry}
+    20        /item/{int:1-50000}
+    5         /user/{file:usernames.txt}
+
+Templates are expanded as each request is generated:
+
+``{int:LOW-HIGH}``
+    A uniformly distributed integer in the inclusive range
+``{choice:A,B,C}``
+    One of the comma-separated values
+``{file:PATH}``
+    A random line from PATH, which is read once and shared by every template
+
+Weighted sampling uses Vose's alias method so each request costs O(1) time
+and memory no matter how many requests are generated.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import io
+import random
+import re
+
+try:
+    from urllib.parse import urljoin
+except ImportError:
+    from urlparse import urljoin
+
+
+TEMPLATE_RE = re.compile(r"\{(?P<kind>int|choice|file):(?P<arg>[^}]+)\}")
+
+
+class AliasSampler(object):
+    """Draws indexes in proportion to the provided weights in constant time"""
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = float(sum(weights))
+
+        if not count or total <= 0:
+            raise ValueError("At least one positive weight is required")
+
+        scaled = [w * count / total for w in weights]
+
+        self.count = count
+        self.probability = [1.0] * count
+        self.alias = list(range(count))
+
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+
+        while small and large:
+            s, l = small.pop(), large.pop()
+
+            self.probability[s] = scaled[s]
+            self.alias[s] = l
+
+            scaled[l] += scaled[s] - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+
+    def sample(self, rng=random):
+        i = int(rng.random() * self.count)
+        return i if rng.random() < self.probability[i] else self.alias[i]
+
+
+class URLTemplate(object):
+    """A URL with zero or more placeholders which are filled on each expansion"""
+
+    def __init__(self, template, base_url=None, file_cache=None):
+        if base_url:
+            template = urljoin(base_url, template)
+
+        self.template = template
+        self.parts = []
+
+        file_cache = file_cache if file_cache is not None else {}
+
+        offset = 0
+        for m in TEMPLATE_RE.finditer(template):
+            self.parts.append(template[offset:m.start()])
+            self.parts.append(self._make_generator(m.group("kind"), m.group("arg"), file_cache))
+            offset = m.end()
+        self.parts.append(template[offset:])
+
+    def _make_generator(self, kind, arg, file_cache):
+        if kind == "int":
+            try:
+                low, high = map(int, arg.split("-", 1))
+            except ValueError:
+                raise ValueError("Invalid integer range %r in %s" % (arg, self.template))
+            return lambda rng: "%d" % rng.randint(low, high)
+        elif kind == "choice":
+            values = arg.split(",")
+            return lambda rng: rng.choice(values)
+        else:
+            if arg not in file_cache:
+                with io.open(arg, encoding="utf-8") as f:
+                    file_cache[arg] = [l.strip() for l in f if l.strip()]
+                if not file_cache[arg]:
+                    raise ValueError("%s does not contain any values" % arg)
+            values = file_cache[arg]
+            return lambda rng: rng.choice(values)
+
+    @property
+    def is_template(self):
+        return len(self.parts) > 1
+
+    def expand(self, rng=random):
+        if not self.is_template:
+            return self.template
+
+        return "".join(p(rng) if callable(p) else p for p in self.parts)
+
+    def __repr__(self):
+        return "URLTemplate(%r)" % self.template
+
+
+class RequestMix(object):
+    """
+    A collection of weighted URL templates which can generate an endless
+    stream of requests without materializing the list
+    """
+
+    def __init__(self, base_url=None):
+        self.base_url = base_url
+        self.templates = []
+        self.weights = []
+        self._file_cache = {}
+        self._sampler = None
+
+    def __len__(self):
+        return len(self.templates)
+
+    @property
+    def weighted(self):
+        return any(w != self.weights[0] for w in self.weights)
+
+    def add(self, template, weight=1):
+        if weight <= 0:
+            raise ValueError("Weights must be positive: %s" % weight)
+
+        self.templates.append(URLTemplate(template, base_url=self.base_url,
+                                          file_cache=self._file_cache))
+        self.weights.append(weight)
+        self._sampler = None
+
+    def load(self, filename):
+        """Add every entry from a mix file or plain list of URLs"""
+
+        with io.open(filename, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                fields = line.split()
+
+                if not fields or fields[0].startswith("#"):
+                    continue
+
+                if len(fields) == 1:
+                    self.add(fields[0])
+                    continue
+
+                try:
+                    weight = float(fields[0])
+                except ValueError:
+                    raise ValueError("%s line %d: expected WEIGHT URL, not %r"
+                                     % (filename, line_number, line.strip()))
+
+                self.add(fields[1], weight=weight)
+
+    def sample(self, rng=random):
+        if self._sampler is None:
+            self._sampler = AliasSampler(self.weights)
+
+        return self.templates[self._sampler.sample(rng)].expand(rng)
+
+    def generate(self, count=None, randomize=False, rng=random):
+        """
+        Yield ``count`` URLs or, if count is None, an endless stream
+
+        Unweighted mixes are returned in order unless ``randomize`` is set.
+        Weighted mixes are always sampled so the weights are honored.
+        """
+
+        if not self.templates:
+            return
+
+        generated = 0
+
+        if randomize or self.weighted:
+            while count is None or generated < count:
+                yield self.sample(rng)
+                generated += 1
+        else:
+            while True:
+                for template in self.templates:
+                    if count is not None and generated >= count:
+                        return
+                    yield template.expand(rng)
+                    generated += 1
@@ -0,0 +1,284 @@
+# encoding: utf-8
+"""
+URL canonicalization and crawler trap detection
+
+:class:`URLCanonicalizer` reduces the many spellings of a URL to one so a
+spider retrieves each resource once: the scheme and host are lower-cased,
+default ports and ``.`` and ``..`` path segments are removed, percent
+encoding is normalized, and query parameters are sorted with tracking and
+session parameters removed. Canonical URLs are always ASCII: non-ASCII
+hostnames are IDNA-encoded and other non-ASCII characters are
+percent-encoded as UTF-8.
+
+:class:`TrapDetector` limits the URLs a spider will queue so that
+calendars, endlessly nested relative links and other infinite URL spaces
+can't keep a crawl running forever. URLs are rejected when their paths are
+too deep or repeat a segment too often. A limit on the URLs which share a
+pattern (the host and path with every number replaced by ``N`` plus the
+names of the query parameters) can be enabled too, but it also stops
+ordinary pages such as ``/product/N`` so it's off by default.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import fnmatch
+import re
+from collections import Counter, OrderedDict
+
+try:
+    from urllib.parse import unquote_plus, urlsplit, urlunsplit
+except ImportError:
+    from urllib import unquote_plus
+    from urlparse import urlsplit, urlunsplit
+
+#: Query and path parameters which only track visitors or sessions and never
+# change the content. Shell-style wildcards are allowed:
+DEFAULT_STRIP_PARAMS = ("utm_*", "gclid", "dclid", "fbclid", "msclkid", "mc_cid", "mc_eid", "_ga", "_gl",
+                        "jsessionid", "phpsessid", "aspsessionid*", "sid", "sessionid", "session_id",
+                        "cfid", "cftoken")
+
+DEFAULT_PORTS = {"http": "80", "https": "443"}
+
+PERCENT_ENCODING_RE = re.compile(r"%([0-9A-Fa-f]{2})")
+
+# RFC 3986 unreserved characters never need to be percent-encoded:
+UNRESERVED = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~")
+
+NUMBER_RE = re.compile(r"\d+")
+
+NON_ASCII_RE = re.compile(r"[^\x00-\x7f]+")
+
+
+def encode_non_ascii(value):
+    """Percent-encode the non-ASCII characters in a text string as UTF-8"""
+
+    return NON_ASCII_RE.sub(lambda m: "".join("%%%02X" % i for i in bytearray(m.group(0).encode("utf-8"))),
+                            value)
+
+
+def encode_host(netloc):
+    userinfo, at, hostport = netloc.rpartition("@")
+
+    try:
+        hostport = hostport.encode("idna").decode("ascii")
+    except UnicodeError:
+        hostport = encode_non_ascii(hostport)
+
+    return "%s%s%s" % (encode_non_ascii(userinfo), at, hostport)
+
+
+def to_ascii(url):
+    """
+    Return url as an ASCII text string with non-ASCII characters encoded
+
+    Python 2 byte strings which aren't UTF-8, such as a latin-1 Location
+    header, have their non-ASCII bytes percent-encoded unchanged.
+    """
+
+    if isinstance(url, bytes):
+        try:
+            url = url.decode("utf-8")
+        except UnicodeDecodeError:
+            return re.sub(br"[\x80-\xff]", lambda m: b"%%%02X" % bytearray(m.group(0))[0], url).decode("ascii")
+
+    if NON_ASCII_RE.search(url) is None:
+        return url
+
+    scheme, netloc, path, query, fragment = urlsplit(url)
+
+    return urlunsplit((scheme, encode_host(netloc), encode_non_ascii(path), encode_non_ascii(query),
+                       encode_non_ascii(fragment)))
+
+
+def normalize_percent_encoding(value):
+    """Decode percent-encoded unreserved characters and upper-case the remaining escapes"""
+
+    def replace(match):
+        char = chr(int(match.group(1), 16))
+        return char if char in UNRESERVED else "%" + match.group(1).upper()
+
+    return PERCENT_ENCODING_RE.sub(replace, value) if "%" in value else value
+
+
+def remove_dot_segments(path):
+    """Resolve ``.`` and ``..`` segments as described in RFC 3986 section 5.2.4"""
+
+    if "." not in path:
+        return path
+
+    output = []
+    segments = path.split("/")
+
+    for i, segment in enumerate(segments):
+        last = i == len(segments) - 1
+
+        if segment == ".":
+            if last:
+                output.append("")
+        elif segment == "..":
+            if len(output) > 1:
+                output.pop()
+            if last:
+                output.append("")
+        else:
+            output.append(segment)
+
+    return "/".join(output)
+
+
+class URLCanonicalizer(object):
+    """
+    Returns the canonical form of a URL when called
+
+    :param strip_params: names or shell-style patterns of the query and
+                         ``;name=value`` path parameters to remove,
+                         compared case-insensitively
+    :param sort_params: sort query parameters by name; the values of a
+                        repeated parameter keep their order
+    """
+
+    def __init__(self, strip_params=DEFAULT_STRIP_PARAMS, sort_params=True):
+        self.strip_params = tuple(strip_params)
+        self.sort_params = sort_params
+
+        if self.strip_params:
+            self.strip_re = re.compile("|".join(fnmatch.translate(i.lower()) for i in self.strip_params))
+        else:
+            self.strip_re = None
+
+    def is_stripped(self, name):
+        return self.strip_re is not None and self.strip_re.match(unquote_plus(name).lower()) is not None
+
+    def canonicalize_netloc(self, scheme, netloc):
+        userinfo, at, hostport = netloc.rpartition("@")
+
+        host, port = hostport, ""
+        # Bracketed IPv6 addresses contain colons too:
+        if ":" in hostport and not hostport.endswith("]"):
+            host, _, port = hostport.rpartition(":")
+
+        host = host.lower().rstrip(".")
+
+        if port and port != DEFAULT_PORTS.get(scheme):
+            host = "%s:%s" % (host, port)
+
+        return "%s%s%s" % (userinfo, at, host)
+
+    def canonicalize_path(self, path):
+        if ";" in path and self.strip_re is not None:
+            segments = []
+            for segment in path.split("/"):
+                if ";" in segment:
+                    parts = segment.split(";")
+                    segment = ";".join([parts[0]] + [i for i in parts[1:]
+                                                     if not self.is_stripped(i.partition("=")[0])])
+                segments.append(segment)
+            path = "/".join(segments)
+
+        return remove_dot_segments(normalize_percent_encoding(path)) or "/"
+
+    def canonicalize_query(self, query):
+        params = [i for i in query.split("&") if i and not self.is_stripped(i.partition("=")[0])]
+
+        if self.sort_params:
+            # sort() is stable so repeated parameters keep their order:
+            params.sort(key=lambda i: i.partition("=")[0])
+
+        return normalize_percent_encoding("&".join(params))
+
+    def __call__(self, url):
+        scheme, netloc, path, query, fragment = urlsplit(to_ascii(url))
+        scheme = scheme.lower()
+
+        if scheme not in DEFAULT_PORTS:
+            # Only remove the fragment from mailto:, javascript: and other URLs:
+            return urlunsplit((scheme, netloc, path, query, ""))
+
+        return urlunsplit((scheme, self.canonicalize_netloc(scheme, netloc), self.canonicalize_path(path),
+                           self.canonicalize_query(query) if query else "", ""))
+
+
+class TrapDetector(object):
+    """
+    Decides whether a spider should queue a URL
+
+    Call :meth:`check` once for every new canonical URL. Rejected URLs are
+    counted in :attr:`rejected` by reason, with up to ``max_examples``
+    example URLs for each.
+
+    :param max_depth: the most path segments a URL may have
+    :param max_repetitions: the most times any one path segment may appear
+    :param max_urls_per_pattern: the most URLs accepted for each pattern or
+                                 None for no limit. Large sites have far
+                                 more than this many articles or products
+                                 matching one pattern, so only set it for
+                                 sites with unbounded query spaces
+    """
+
+    def __init__(self, max_depth=16, max_repetitions=3, max_urls_per_pattern=None, max_examples=5):
+        self.max_depth = max_depth
+        self.max_repetitions = max_repetitions
+        self.max_urls_per_pattern = max_urls_per_pattern
+        self.max_examples = max_examples
+
+        #: Pattern → the number of URLs accepted:
+        self.pattern_counts = Counter()
+        #: Reason → [rejected URL count, example URLs]:
+        self.rejected = OrderedDict()
+
+    @staticmethod
+    def pattern(url):
+        """Return the host and path with numbers replaced by N plus the sorted query parameter names"""
+
+        scheme, netloc, path, query, fragment = urlsplit(url)
+
+        names = sorted(set(i.partition("=")[0] for i in query.split("&") if i))
+
+        return "%s%s%s" % (netloc, NUMBER_RE.sub("N", path), "?" + "&".join(names) if names else "")
+
+    def trap_reason(self, url):
+        segments = [i for i in urlsplit(url).path.split("/") if i]
+
+        if self.max_depth and len(segments) > self.max_depth:
+            return "Path deeper than %d segments" % self.max_depth
+
+        if self.max_repetitions and segments:
+            segment, count = Counter(segments).most_common(1)[0]
+            if count > self.max_repetitions:
+                return "Path repeats a segment more than %d times" % self.max_repetitions
+
+        if self.max_urls_per_pattern:
+            pattern = self.pattern(url)
+            if self.pattern_counts[pattern] >= self.max_urls_per_pattern:
+                return "More than %d URLs matching %s" % (self.max_urls_per_pattern, pattern)
+            self.pattern_counts[pattern] += 1
+
+        return None
+
+    def check(self, url):
+        """Return None if url should be crawled or the reason it looks like a trap"""
+
+        reason = self.trap_reason(url)
+
+        if reason is not None:
+            entry = self.rejected.setdefault(reason, [0, []])
+            entry[0] += 1
+            if len(entry[1]) < self.max_examples:
+                entry[1].append(url)
+
+        return reason
+
+    def merge(self, other):
+        """Add another detector's pattern counts and rejections, keeping max_examples examples"""
+
+        self.pattern_counts.update(other.pattern_counts)
+
+        for reason, (count, examples) in other.rejected.items():
+            entry = self.rejected.setdefault(reason, [0, []])
+            entry[0] += count
+            entry[1].extend(examples[:self.max_examples - len(entry[1])])
+
+    @property
+    def rejected_count(self):
+        return sum(count for count, examples in self.rejected.values())